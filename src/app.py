@@ -15,7 +15,7 @@ import flask
 from flask_cors import CORS
 
 import requests
-from flask          import Flask, request, make_response, send_file
+from flask          import Flask, request, make_response, send_file, Response, stream_with_context
 from flask_socketio import SocketIO
 from openai         import OpenAI
 from awq            import AutoAWQForCausalLM
@@ -27,10 +27,17 @@ from lib.app import multimodal_munger as mmm
 import lib.utils.util              as du
 import lib.utils.util_stopwatch    as sw
 import lib.utils.util_xml          as dux
-from lib.memory.input_and_output_table import InputAndOutputTable
+from lib.memory.lancedb_registry       import get_lancedb_registry
+from lib.memory.embedding_cache        import get_embedding_cache
+from lib.memory.lancedb_maintenance    import LanceDbMaintenanceScheduler
+from lib.memory.embedding_provider     import get_embedding_provider_by_name, set_embedding_provider
+from lib.memory.embedding_client       import configure_embedding_client, get_embedding_client
 
+from lib.memory.solution_snapshot     import SolutionSnapshot
 from lib.memory.solution_snapshot_mgr import SolutionSnapshotManager
-from lib.app.fifo_queue               import FifoQueue
+from lib.app.finished_fifo_queue      import FinishedFifoQueue, FinishedJobStore, FinishedJob
+from lib.app.job_journal              import JobJournal
+from lib.app.metrics_registry         import get_metrics_registry, get_stage_seconds_histogram
 from lib.app.running_fifo_queue       import RunningFifoQueue
 from lib.app.todo_fifo_queue          import TodoFifoQueue
 from lib.app.configuration_manager    import ConfigurationManager
@@ -95,7 +102,32 @@ def init_configuration( refresh=False ):
     path_to_snapshots_dir_wo_root      = config_mgr.get( "path_to_snapshots_dir_wo_root" )
     tts_local_url_template             = config_mgr.get( "tts_local_url_template" )
     
-    io_tbl = InputAndOutputTable( debug=app_debug, verbose=app_verbose )
+    # Snapshots that are (re)written from here on out will use this format. Both formats can always be read
+    SolutionSnapshot.default_storage_format = config_mgr.get( "snapshot_storage_format", default="json" )
+    
+    # ¡OJO! Tables and snapshot indexes are tied to the provider they were opened with, so it can't change on refresh
+    if not refresh:
+        provider_name = config_mgr.get( "embedding_provider", default="openai" )
+        if provider_name == "local":
+            model_path = du.get_project_root() + config_mgr.get( "embedding_provider_local_model_path_wo_root", default="/src/conf/models/all-MiniLM-L6-v2" )
+            set_embedding_provider( get_embedding_provider_by_name( "local", model_path=model_path, debug=app_debug ) )
+        else:
+            set_embedding_provider( get_embedding_provider_by_name( provider_name, debug=app_debug ) )
+    
+        configure_embedding_client(
+            batch_window_ms=config_mgr.get( "embedding_client_batch_window_ms", default=10, return_type="int" ),
+            max_batch_size=config_mgr.get( "embedding_client_max_batch_size", default=64, return_type="int" ),
+            max_retries=config_mgr.get( "embedding_client_max_retries", default=5, return_type="int" ),
+            debug=app_debug
+        )
+    
+    # Database handles are shared process wide. On refresh, they're dropped and reopened w/ the new configuration
+    registry         = get_lancedb_registry()
+    registry.debug   = app_debug
+    registry.verbose = app_verbose
+    if refresh: registry.refresh()
+    io_tbl = registry.get_input_and_output_table()
+    if refresh: register_db_maintenance_tables()
     
 init_configuration()
 
@@ -119,16 +151,66 @@ socketio = SocketIO( app, cors_allowed_origins='*' )
 app.config[ 'SERVER_NAME' ] = app_config_server_name
 
 path_to_snapshots = du.get_project_root() + path_to_snapshots_dir_wo_root
-snapshot_mgr = SolutionSnapshotManager( path_to_snapshots, debug=app_debug, verbose=app_verbose )
+snapshot_mgr = SolutionSnapshotManager(
+    path_to_snapshots,
+    similarity_backend=config_mgr.get( "snapshot_similarity_backend", default="exact" ),
+    similarity_nprobe=config_mgr.get( "snapshot_similarity_ivf_nprobe", default=8, return_type="int" ),
+    similarity_ef=config_mgr.get( "snapshot_similarity_hnsw_ef", default=64, return_type="int" ),
+    exact_search_threshold=config_mgr.get( "snapshot_similarity_exact_search_threshold", default=10000, return_type="int" ),
+    load_workers=config_mgr.get( "snapshot_load_workers", default=4, return_type="int" ),
+    debug=app_debug, verbose=app_verbose
+)
+
+# Compacts fragments and prunes old versions of the LanceDB tables, once they get too fragmented or too much time has passed
+db_maintenance = LanceDbMaintenanceScheduler(
+    max_fragments=config_mgr.get( "db_maintenance_max_fragments", default=64, return_type="int" ),
+    max_interval_secs=config_mgr.get( "db_maintenance_max_interval_secs", default=86400, return_type="int" ),
+    check_interval_secs=config_mgr.get( "db_maintenance_check_interval_secs", default=300, return_type="int" ),
+    keep_versions_secs=config_mgr.get( "db_maintenance_keep_versions_secs", default=3600, return_type="int" ),
+    debug=app_debug, verbose=app_verbose
+)
+def register_db_maintenance_tables():
+    
+    db_maintenance.register_table( "input_and_output_tbl", io_tbl.get_table(), "input_type", on_compacted=io_tbl.rebuild_indexes )
+    db_maintenance.register_table( "question_embeddings_tbl", io_tbl.get_question_embeddings_table().get_table(), "question" )
+
+register_db_maintenance_tables()
 
 """
 Globally visible queue objects
 """
+# Finished jobs are written through to disk, and only the latest ones are kept in memory
+finished_jobs   = FinishedJobStore( du.get_project_root() + config_mgr.get( "jobs_finished_db_path_wo_root", default="/src/conf/long-term-memory/finished-jobs.sqlite" ) )
 jobs_todo_queue = TodoFifoQueue( socketio, snapshot_mgr, app, config_mgr, debug=app_debug, verbose=app_verbose, silent=app_silent )
-jobs_done_queue = FifoQueue()
-jobs_dead_queue = FifoQueue()
+jobs_done_queue = FinishedFifoQueue( finished_jobs, "done", max_size=config_mgr.get( "jobs_done_max_in_memory", default=100, return_type="int" ) )
+jobs_dead_queue = FinishedFifoQueue( finished_jobs, "dead", max_size=config_mgr.get( "jobs_done_max_in_memory", default=100, return_type="int" ) )
 jobs_run_queue  = RunningFifoQueue( app, socketio, snapshot_mgr, jobs_todo_queue, jobs_done_queue, jobs_dead_queue, config_mgr=config_mgr )
 
+# Replays the todo and run queue transitions journaled before the last shutdown, then keeps journaling them
+job_journal = JobJournal(
+    du.get_project_root() + config_mgr.get( "jobs_journal_path_wo_root", default="/src/conf/long-term-memory/jobs-journal.jsonl" ),
+    fsync=config_mgr.get( "jobs_journal_fsync", default=True, return_type="boolean" )
+)
+job_journal.attach( "todo", jobs_todo_queue )
+# Jobs accepted from clients are on disk before /push returns. The run loop doesn't wait on the disk: a job whose move
+# from todo to run is lost in a crash is simply recovered from todo
+job_journal.attach( "run",  jobs_run_queue, wait_for_pushes=False )
+
+# ¡OJO! Jobs that were running when we went down are NOT rerun, since they may have been partway through changing
+# something, e.g. adding a todo item. They're filed under dead instead, so at least they show up
+for entry in job_journal.take_recovered( "run" ):
+    jobs_dead_queue.push( FinishedJob( entry[ "id_hash" ], question=entry[ "question" ], last_question_asked=entry[ "last_question_asked" ], run_date=entry[ "run_date" ] ) )
+    job_journal.record_pop( "run", entry[ "id_hash" ] )
+
+def replay_recovered_todo_jobs():
+    
+    # Jobs that were still waiting when we went down are pushed again, from the top, as if they'd just been asked.
+    # That may need the routing LLM, so this waits until it's been loaded
+    for entry in job_journal.take_recovered( "todo" ):
+        print( f"Replaying journaled todo job [{entry[ 'last_question_asked' ]}]..." )
+        jobs_todo_queue.push_job( entry[ "last_question_asked" ] )
+        job_journal.record_pop( "todo", entry[ "id_hash" ] )
+
 def enter_clock_loop():
     
     print( "enter_clock_loop..." )
@@ -168,6 +250,7 @@ def get_tts_url( tts_text ):
 def get_tts_audio_file( tts_text ):
     
     du.print_banner( f"TTS text [{tts_text}] )", prepend_nl=True )
+    tts_start = time.perf_counter()
     tts_generation_strategy = config_mgr.get( "tts_generation_strategy", default="local" )
     
     if tts_generation_strategy == "openai":
@@ -204,6 +287,8 @@ def get_tts_audio_file( tts_text ):
             print( f"Failed to get UPDATED audio file: {response.status_code}" )
             path = du.get_project_root() + "/io/failed-to-fetch-tts-file.wav"
     
+    get_stage_seconds_histogram().observe( time.perf_counter() - tts_start, stage="tts" )
+    
     return send_file( path, mimetype=mimetype )
 
 @app.route( "/get_tts_audio", methods=[ "GET" ] )
@@ -215,13 +300,8 @@ def get_tts_audio():
 
 def generate_html_list( fifo_queue, descending=False, add_play_button=False ):
     
-    html_list = [ ]
-    for job in fifo_queue.queue_list:
-        html_list.append( job.get_html() )
-    
-    if descending: html_list.reverse()
-    
-    return html_list
+    # Rendered once per change to the queue, not once per poll
+    return fifo_queue.get_html_list( descending=descending )
 
 
 @app.route( '/get_queue/<queue_name>', methods=[ 'GET' ] )
@@ -266,6 +346,20 @@ def delete_snapshot( id_hash ):
     
     return f"Deleted snapshot [{id_hash}]"
 
+
+@app.route( '/cancel/<string:id_hash>', methods=[ 'GET' ] )
+def cancel_job( id_hash ):
+
+    # Running or still waiting to run, either way it ends up in the dead queue, and a running job's slot is freed now
+    if not jobs_run_queue.cancel_job( id_hash ):
+        return f"No job [{id_hash}] running or waiting to run"
+
+    socketio.emit( 'todo_update', { 'value': jobs_todo_queue.size() } )
+    socketio.emit( 'run_update', { 'value': jobs_run_queue.size() } )
+    socketio.emit( 'dead_update', { 'value': jobs_dead_queue.size() } )
+
+    return f"Cancelled job [{id_hash}]"
+
 # create an endpoint that refreshes the contents of the config manager and reloads the solution snapshot manager
 @app.route( '/api/init', methods=[ 'GET' ] )
 def init():
@@ -340,7 +434,6 @@ def proofread():
     print( result )
     timer.print( "Proofread", use_millis=True )
     
-    # TODO: This would be great place to make this insert asynchronous
     io_tbl.insert_io_row( input_type="/api/proofread", input=question, output_final=result )
     
     response = make_response( result )
@@ -376,7 +469,6 @@ def proofread_sql():
     print( response )
     sql = dux.get_value_by_xml_tag_name( response, "sql" )
     
-    # TODO: This would be great place to make this insert asynchronous
     io_tbl.insert_io_row( input_type="/api/proofread-sql", input=question, output_final=sql )
     
     response = make_response( sql )
@@ -408,7 +500,6 @@ def proofread_python():
     print( response )
     python = dux.get_value_by_xml_tag_name( response, "python" )
     
-    # TODO: This would be great place to make this insert asynchronous
     io_tbl.insert_io_row( input_type="/api/proofread-python", input=question, output_final=python )
     
     response = make_response( python )
@@ -489,7 +580,6 @@ def upload_and_transcribe_mp3_file():
     else:
         
         print( "Munger: Transcription is neither proofread nor agent. Returning brute force munger string..." )
-        # TODO: This would be great place to make this insert asynchronous
         io_tbl.insert_io_row( input_type=f"upload and proofread mp3: {munger.mode}", input=raw_transcription, output_raw=munger.transcription, output_final=munger.get_jsons() )
         
     # Write JSON string to file system.
@@ -501,6 +591,10 @@ def upload_and_transcribe_mp3_file():
 @app.route( "/api/get-io-stats" )
 def get_io_stats():
     
+    # Counts by input_type, or with ?by=date, by day and then by input_type
+    if request.args.get( "by", "input_type" ) == "date":
+        return json.dumps( io_tbl.get_io_stats_by_date() )
+    
     io_stats = io_tbl.get_io_stats_by_input_type()
 
     du.print_banner( "I/O Stats")
@@ -509,21 +603,80 @@ def get_io_stats():
         
     return json.dumps( io_stats )
 
-@app.route( "/api/get-all-io" )
-def get_all_io():
+@app.route( "/api/get-io-index-stats" )
+def get_io_index_stats():
+    
+    # How many I/O rows the vector and scalar indexes don't cover yet, and how long recent knn searches took
+    return json.dumps( io_tbl.get_index_stats() )
+
+@app.route( "/api/get-run-queue-stats" )
+def get_run_queue_stats():
     
-    all_io = io_tbl.get_all_io()
+    # Jobs running, by type, and how long jobs took to start after being pushed onto the todo queue
+    return json.dumps( jobs_run_queue.get_stats() )
+
+@app.route( "/metrics" )
+def get_metrics():
     
-    date = ""
-    for io in all_io:
+    # Queue depths, push to start, run and per stage latency histograms, and snapshot hit/miss counts, for Prometheus
+    return Response( get_metrics_registry().render(), mimetype="text/plain; version=0.0.4" )
 
-        if date != io[ "date" ]:
-            date = io[ "date" ]
-            du.print_banner( f"Date: [{date}]")
+@app.route( "/api/get-db-maintenance-stats" )
+def get_db_maintenance_stats():
+    
+    # Fragment, version and scan latency stats for each table, before and after each of the recent maintenance runs
+    return json.dumps( db_maintenance.get_stats() )
+
+@app.route( "/api/run-db-maintenance" )
+def run_db_maintenance():
+    
+    return json.dumps( db_maintenance.run_now() )
 
-        print( f"Time: [{io[ 'time' ]}] input_type: [{io[ 'input_type' ]}] input: [{io[ 'input' ]}] output_final: [{io[ 'output_final' ]}]", end="\n\n" )
+@app.route( "/api/get-embedding-cache-stats" )
+def get_embedding_cache_stats():
+    
+    # How many embedding round trips to the network have been saved by the shared embedding cache, and how well the
+    # ones that weren't saved have been batched
+    stats = get_embedding_cache().get_stats()
+    stats[ "client" ] = get_embedding_client().get_stats()
+    
+    return json.dumps( stats )
+
+@app.route( "/api/get-all-io" )
+def get_all_io():
+    
+    # Optional, server side filters: start_date and end_date (inclusive, YYYY-MM-DD) and input_type
+    filters = { key: request.args.get( key ) for key in [ "start_date", "end_date", "input_type" ] }
+    cursor  = request.args.get( "cursor" )
     
-    return json.dumps( all_io )
+    # ?format=ndjson streams every matching row, one JSON object per line, a record batch at a time
+    if request.args.get( "format" ) == "ndjson":
+        
+        # ¡OJO! The stream isn't ordered, so "rows after the cursor" would be a more or less random subset of them
+        if cursor is not None:
+            return make_response( json.dumps( { "error": "cursor is only supported for paged, not ndjson, requests" } ), 400 )
+        
+        batches = io_tbl.get_io_batches( **filters )
+        def generate_ndjson():
+            for batch in batches:
+                for row in batch.to_pylist(): yield json.dumps( row ) + "\n"
+        
+        return Response( stream_with_context( generate_ndjson() ), mimetype="application/x-ndjson" )
+    
+    # Otherwise a JSON list of one page of rows, w/ the cursor for the next page, if any, in the X-Next-Cursor header
+    page_size = request.args.get( "page_size", default=1000, type=int )
+    try:
+        rows, next_cursor = io_tbl.get_io_page( cursor=cursor, page_size=page_size, **filters )
+    except ValueError as e:
+        # A cursor that wasn't one of ours is the caller's mistake, not ours
+        return make_response( json.dumps( { "error": str( e ) } ), 400 )
+    print( f"get_all_io(): Returning [{len( rows )}] rows, next cursor [{next_cursor}]" )
+    
+    response = make_response( json.dumps( rows ) )
+    response.headers[ "Content-Type" ] = "application/json"
+    if next_cursor is not None: response.headers[ "X-Next-Cursor" ] = next_cursor
+    
+    return response
 
 # @app.route( "/api/run-raw-prompt-text" )
 # def run_raw_prompt_text():
@@ -590,7 +743,6 @@ def upload_and_transcribe_wav_file():
     
     munger = mmm.MultiModalMunger( raw_transcription, prefix=prefix, debug=app_debug, verbose=app_verbose )
     
-    # TODO: This would be great place to make this insert asynchronous
     io_tbl.insert_io_row( input_type=f"upload and proofread wav: {munger.mode}", input=raw_transcription, output_raw=munger.transcription, output_final=munger.get_jsons() )
     
     return munger.transcription
@@ -655,6 +807,7 @@ def load_commands_llm_once():
         prompt_path              = du.get_project_root() + config_mgr.get( "vox_command_prompt_path_wo_root" )
         cmd_prompt_template      = du.get_file_as_string( prompt_path )
         jobs_todo_queue.set_llm( cmd_model, cmd_tokenizer)
+        replay_recovered_todo_jobs()
         
         return "Commands LLM and prompt loaded"
     else:
@@ -7,12 +7,14 @@ import pandas as pd
 import lib.utils.util               as du
 import lib.utils.util_pandas        as dup
 import lib.utils.util_xml           as dux
+import lib.utils.util_code_runner   as ucr
 import lib.memory.solution_snapshot as ss
 
 from lib.agents.llm                  import Llm
 from lib.agents.raw_output_formatter import RawOutputFormatter
 from lib.agents.runnable_code        import RunnableCode
 from lib.app.configuration_manager   import ConfigurationManager
+from lib.app.job_context             import job_stage
 from lib.memory.solution_snapshot    import SolutionSnapshot
 
 class AgentBase( RunnableCode, abc.ABC ):
@@ -147,6 +149,7 @@ class AgentBase( RunnableCode, abc.ABC ):
         
         return prompt_response_dict
     
+    @job_stage( "prompt" )
     def run_prompt( self, model_name=None, temperature=0.5, top_p=0.25, top_k=10, max_new_tokens=1024, stop_sequences=None, include_raw_response=False ):
         
         if model_name is not None: self.model_name = model_name
@@ -165,6 +168,7 @@ class AgentBase( RunnableCode, abc.ABC ):
         
         return self.prompt_response_dict
     
+    @job_stage( "code" )
     def run_code( self, auto_debug=None, inject_bugs=None ):
         
         # Use this object's settings, if temporary overriding values aren't provided
@@ -179,7 +183,14 @@ class AgentBase( RunnableCode, abc.ABC ):
         else:
             path_to_df = None
             
-        code_response_dict = super().run_code( path_to_df=path_to_df, inject_bugs=inject_bugs )
+        # The debugger needs the code that failed, so it's kept on disk until we're done debugging it
+        code_response_dict = super().run_code( path_to_df=path_to_df, inject_bugs=inject_bugs, keep_code=auto_debug )
+        try:
+            return self._debug_code( code_response_dict, auto_debug )
+        finally:
+            if auto_debug: ucr.remove_code_file( code_response_dict.get( "code_path" ) )
+    
+    def _debug_code( self, code_response_dict, auto_debug ):
         
         if self.code_ran_to_completion():
             
@@ -197,7 +208,7 @@ class AgentBase( RunnableCode, abc.ABC ):
             for minimalist in [ True, False ]:
                 
                 debugging_agent = IterativeDebuggingAgent(
-                    code_response_dict[ "output" ], "/io/code.py",
+                    code_response_dict[ "output" ], code_response_dict[ "code_path" ],
                     minimalist=minimalist, example=self.prompt_response_dict[ "example" ], returns=self.prompt_response_dict.get( "returns", "string" ),
                     debug=self.debug, verbose=self.verbose
                 )
@@ -224,6 +235,7 @@ class AgentBase( RunnableCode, abc.ABC ):
         print( "AgentBase.is_format_output_runnable() not implemented" )
         pass
     
+    @job_stage( "formatter" )
     def format_output( self ):
         
         formatter = RawOutputFormatter( self.last_question_asked, self.code_response_dict[ "output" ], self.routing_command, debug=self.debug, verbose=self.verbose )
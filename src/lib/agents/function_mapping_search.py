@@ -2,7 +2,7 @@ import lib.utils.util                  as du
 
 from lib.utils.util_stopwatch           import Stopwatch
 from lib.agents.agent_base              import AgentBase
-from lib.memory.input_and_output_table  import InputAndOutputTable
+from lib.memory.lancedb_registry        import get_lancedb_registry
 
 from ephemera.prompts.xml_fine_tuning_prompt_generator  import XmlFineTuningPromptGenerator
 
@@ -15,12 +15,17 @@ class FunctionMappingSearch( AgentBase ):
         
         self.debug                  = debug
         self.verbose                = verbose
-        self.io_tbl                 = InputAndOutputTable( debug=self.debug, verbose=self.verbose )
         self.question               = question
         self.last_question_asked    = last_question_asked
         self.prompt                 = self._get_prompt()
         self.xml_response_tag_names = [ "thoughts", "can-use-available-functions", "function_name", "kwargs", "example", "returns" ]
         
+    @property
+    def io_tbl( self ):
+        
+        # Shared, and opened on first use, so that creating an agent never opens a database handle
+        return get_lancedb_registry().get_input_and_output_table()
+    
     def _get_prompt( self ):
         
         date_yesterday        = du.get_current_date( offset=-1 )
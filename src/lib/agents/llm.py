@@ -7,6 +7,7 @@ from groq                       import Groq
 import google.generativeai      as genai
 
 from lib.app.configuration_manager import ConfigurationManager
+from lib.app.job_context           import check_current_job, get_current_job_remaining_secs
 from lib.utils.util_stopwatch      import Stopwatch
 
 import lib.utils.util as du
@@ -176,6 +177,7 @@ class Llm:
         
         # Chunks are not the same as tokens, specifically for Google models
         for chunk in response:
+            check_current_job()
             chunks.append( chunk.text )
             ellipsis_count = self._do_conditional_print( chunk.text, ellipsis_count, debug=debug )
 
@@ -208,6 +210,7 @@ class Llm:
         ellipsis_count = 0
         for chunk in stream:
             
+            check_current_job()
             chunks.append( str( chunk.choices[ 0 ].delta.content ) )
             ellipsis_count = self._do_conditional_print( chunk.choices[ 0 ].delta.content, ellipsis_count, debug=debug )
             
@@ -245,6 +248,7 @@ class Llm:
         chunks         = [ ]
         ellipsis_count = 0
         for chunk in stream:
+            check_current_job()
             if chunk.choices[ 0 ].delta.content is not None:
                 chunks.append( chunk.choices[ 0 ].delta.content )
                 ellipsis_count = self._do_conditional_print( chunk.choices[ 0 ].delta.content, ellipsis_count, debug=debug )
@@ -259,7 +263,9 @@ class Llm:
     ):
         self._start_timer()
         
-        client = InferenceClient( self.tgi_server_url )
+        # When running as part of a job, a stream that stalls for longer than what's left of the job's prompt stage raises,
+        # rather than blocking the job, and its slot, forever
+        client = InferenceClient( self.tgi_server_url, timeout=get_current_job_remaining_secs() )
         token_list     = [ ]
         ellipsis_count = 0
         
@@ -271,6 +277,7 @@ class Llm:
                 prompt, max_new_tokens=max_new_tokens, stream=True, temperature=temperature, top_k=top_k, top_p=top_p,
                 stop_sequences=stop_sequences
         ):
+            check_current_job()
             ellipsis_count = self._do_conditional_print( token, ellipsis_count, debug=debug )
             token_list.append( token )
         
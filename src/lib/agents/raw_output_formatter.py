@@ -2,6 +2,7 @@ from lib.utils import util     as du
 from lib.utils import util_xml as dux
 
 from lib.app.configuration_manager import ConfigurationManager
+from lib.app.job_context           import job_stage
 
 from lib.agents.llm import Llm
 
@@ -40,6 +41,7 @@ class RawOutputFormatter:
         default_url                = self.config_mgr.get( "tgi_server_codegen_url", default=None )
         self.llm                   = Llm( model=self.models[ routing_command ], default_url=default_url, debug=self.debug, verbose=self.verbose )
     
+    @job_stage( "formatter" )
     def format_output( self ):
         
         response = self.llm.query_llm( prompt=self.prompt, debug=self.debug, verbose=self.verbose )
@@ -5,19 +5,26 @@ import lib.utils.util as du
 
 from lib.agents.agent_base             import AgentBase
 from lib.agents.raw_output_formatter   import RawOutputFormatter
-from lib.memory.input_and_output_table import InputAndOutputTable
+from lib.app.job_context               import job_stage
+from lib.memory.lancedb_registry       import get_lancedb_registry
+from lib.memory.memory_retriever       import MemoryRetriever
 
 class ReceptionistAgent( AgentBase ):
     def __init__( self, question="", last_question_asked="", push_counter=-1, routing_command="agent router go to receptionist", debug=False, verbose=False, auto_debug=False, inject_bugs=False ):
         
         super().__init__( question=question, last_question_asked=last_question_asked, routing_command=routing_command, push_counter=push_counter, debug=debug, verbose=verbose )
         
-        self.io_tbl                   = InputAndOutputTable( debug=self.debug, verbose=self.verbose)
         self.prompt                   = self._get_prompt()
         self.xml_response_tag_names   = [ "thoughts", "category", "answer" ]
         self.serialize_prompt_to_json = self.config_mgr.get( "agent_receptionist_serialize_prompt_to_json", default=False, return_type="boolean" )
         # self.serialize_code_to_json   = self.config_mgr.get( "agent_receptionist_serialize_code_to_json",   default=False, return_type="boolean" )
     
+    @property
+    def io_tbl( self ):
+        
+        # Shared, and opened on first use, so that creating an agent never opens a database handle
+        return get_lancedb_registry().get_input_and_output_table()
+    
     def _get_prompt( self ):
         
         date_today, entries = self._get_df_metadata()
@@ -26,16 +33,21 @@ class ReceptionistAgent( AgentBase ):
     
     def _get_df_metadata( self ):
         
-        entries    = []
-        rows       = self.io_tbl.get_all_qnr()
-        for row in rows:
-            entries.append( f"<memory-fragment> <date>{row['date']}</date/> <human-queried>{row['input']}</human-queried> <ai-answered>{row['output_final']}</ai-answered> </memory-fragment>" )
-            
-        entries    = "\n".join( entries )
+        # Only the most relevant, and recent, past questions and answers, rather than all of them, within a token budget
+        retriever  = MemoryRetriever(
+            self.io_tbl,
+            k=self.config_mgr.get( "agent_receptionist_memory_k", default=20, return_type="int" ),
+            token_budget=self.config_mgr.get( "agent_receptionist_memory_token_budget", default=2000, return_type="int" ),
+            recency_weight=self.config_mgr.get( "agent_receptionist_memory_recency_weight", default=0.15, return_type="float" ),
+            half_life_days=self.config_mgr.get( "agent_receptionist_memory_half_life_days", default=7.0, return_type="float" ),
+            debug=self.debug, verbose=self.verbose
+        )
+        entries    = retriever.get_memory_fragments( self.last_question_asked or self.question )
         date_today = du.get_current_date()
         
         return date_today, entries
     
+    @job_stage( "prompt" )
     def run_prompt( self, model_name=None, temperature=0.5, top_p=0.25, top_k=10, max_new_tokens=1024 ):
         
         results = super().run_prompt( model_name=model_name, temperature=temperature, top_p=top_p, top_k=top_k, max_new_tokens=max_new_tokens )
@@ -52,6 +64,7 @@ class ReceptionistAgent( AgentBase ):
         
         return False
     
+    @job_stage( "code" )
     def run_code( self, auto_debug=None, inject_bugs=None ):
         
         print( "NOT Running code, this is a receptionist agent" )
@@ -66,6 +79,7 @@ class ReceptionistAgent( AgentBase ):
         # This is a necessary lie to satisfy the interface
         return True
     
+    @job_stage( "formatter" )
     def format_output( self ):
         
         # Only reformat the output if it's humorous or salacious
@@ -1,6 +1,8 @@
 import lib.utils.util             as du
 import lib.utils.util_code_runner as ucr
 
+from lib.app.job_context import job_stage
+
 class RunnableCode:
     def __init__( self, debug=False, verbose=False ):
         
@@ -29,7 +31,8 @@ class RunnableCode:
             print( "No code to run: self.response_dict[ 'code' ] = [ ]" )
             return False
         
-    def run_code( self, path_to_df=None, inject_bugs=False ):
+    @job_stage( "code" )
+    def run_code( self, path_to_df=None, inject_bugs=False, keep_code=False ):
         
         if self.debug: du.print_banner( f"RunnableCode.run_code( path_to_df={path_to_df}, debug={self.debug}, verbose={self.verbose} )", prepend_nl=True )
         
@@ -38,7 +41,7 @@ class RunnableCode:
             self.prompt_response_dict[ "example" ],
             path_to_df=path_to_df,
             solution_code_returns=self.prompt_response_dict.get( "returns", "string" ),
-            debug=self.debug, inject_bugs=inject_bugs
+            debug=self.debug, inject_bugs=inject_bugs, keep_code=keep_code
         )
         if self.code_response_dict[ "return_code" ] != 0:
             self.error  = self.code_response_dict[ "output" ]
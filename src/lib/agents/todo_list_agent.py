@@ -4,6 +4,7 @@ import json
 import lib.utils.util as du
 
 from lib.agents.agent_base        import AgentBase
+from lib.app.job_context          import job_stage
 
 class TodoListAgent( AgentBase ):
     def __init__( self, question="", last_question_asked="", push_counter=-1, routing_command="agent router go to todo list", debug=False, verbose=False, auto_debug=False, inject_bugs=False ):
@@ -39,6 +40,7 @@ class TodoListAgent( AgentBase ):
         
         return column_names, list_names, head
     
+    @job_stage( "prompt" )
     def run_prompt( self, model_name=None, temperature=0.5, top_p=0.25, top_k=10, max_new_tokens=1024 ):
         
         results = super().run_prompt( model_name=model_name, temperature=temperature, top_p=top_p, top_k=top_k, max_new_tokens=max_new_tokens )
@@ -47,6 +49,7 @@ class TodoListAgent( AgentBase ):
         
         return results
         
+    @job_stage( "code" )
     def run_code( self, auto_debug=None, inject_bugs=None ):
         
         results = super().run_code( auto_debug=auto_debug, inject_bugs=inject_bugs )
@@ -4,6 +4,7 @@ import json
 import lib.utils.util as du
 
 from lib.agents.agent_base        import AgentBase
+from lib.app.job_context          import job_stage
 from lib.tools.search_gib         import GibSearch
 from lib.memory.solution_snapshot import SolutionSnapshot as ss
 
@@ -26,6 +27,7 @@ class WeatherAgent( AgentBase ):
         
         raise NotImplementedError( "WeatherAgent.restore_from_serialized_state() not implemented" )
     
+    @job_stage( "code" )
     def run_code( self, auto_debug=None, inject_bugs=None ):
         
         try:
@@ -1,56 +1,194 @@
+import contextlib
+import io
+import queue
+import threading
+import time
 from collections import OrderedDict
 
 
 class FifoQueue:
-    def __init__( self ):
+    """
+    First in, first out queue of jobs, indexed by their id_hash.
+    
+    Jobs live in an OrderedDict, i.e. a hash table threaded on a doubly linked list, so push, pop, head and
+    delete_by_id_hash are all O(1), and there's no separate list to keep in sync w/ the index.
+    
+    Optionally bounded: once max_size jobs are queued, push() either drops the oldest job to make room, or rejects
+    the new one by raising queue.Full, depending on the overflow policy.
+    """
+    OVERFLOW_DROP_OLDEST = "drop_oldest"
+    OVERFLOW_REJECT      = "reject"
+    OVERFLOW_POLICIES    = [ OVERFLOW_DROP_OLDEST, OVERFLOW_REJECT ]
+    
+    def __init__( self, max_size=None, overflow_policy=OVERFLOW_REJECT ):
+        
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError( f"Unknown overflow policy [{overflow_policy}], expected one of {self.OVERFLOW_POLICIES}" )
+        
+        self.queue_dict       = OrderedDict()
+        self.push_counter     = 0
+        self.last_queue_size  = 0
+        self.max_size         = max_size
+        self.overflow_policy  = overflow_policy
+        self.overflow_counter = 0
+        
+        # The run loop and the request handlers both touch the queues
+        self._lock            = threading.RLock()
         
-        self.queue_list      = [ ]
-        self.queue_dict      = OrderedDict()
-        self.push_counter    = 0
-        self.last_queue_size = 0
+        # Rendered by get_html_list(), and only re-rendered after the queue has changed
+        self._version         = 0
+        self._html_list       = None
+        self._html_version    = -1
+        
+        # Called w/ each job after it's pushed or popped, e.g. to wake up whoever's waiting to run it, or to journal it.
+        # Jobs dropped to make room in a bounded queue aren't reported as popped. ¡OJO! Callbacks are called after the
+        # queue's lock has been released, so that slow ones, e.g. the journal's, don't hold up everybody else
+        self._on_push_callbacks = [ ]
+        self._on_pop_callbacks  = [ ]
     
     def push( self, item ):
+        """
+        Adds a job to the tail of the queue.
+        
+        :return: The job that was dropped to make room for this one, if the queue is full and drops its oldest jobs, else None
+        """
+        with self._lock:
+            dropped = None
+            if self.max_size is not None and len( self.queue_dict ) >= self.max_size:
+                if self.overflow_policy == self.OVERFLOW_REJECT:
+                    raise queue.Full( f"Queue is full w/ [{self.max_size}] jobs" )
+                _, dropped = self.queue_dict.popitem( last=False )
+                self.overflow_counter += 1
+            
+            self.queue_dict[ item.id_hash ] = item
+            self.push_counter += 1
+            self._version     += 1
+            self._on_pushed( item, dropped )
+        
+        for callback in self._on_push_callbacks: callback( item )
+        
+        return dropped
+    
+    def _on_pushed( self, item, dropped ):
+        """
+        Hook for subclasses' bookkeeping, called w/ the lock held right after a job's been pushed, and w/ the job that
+        was dropped to make room for it, if any.
+        """
+        pass
+    
+    def _on_popped( self, item ):
+        """
+        Hook for subclasses' bookkeeping, called w/ the lock held right after a job's been popped or deleted.
+        """
+        pass
+    
+    def _pop_locked( self, id_hash ):
+        
+        # ¡OJO! Caller holds the lock, and calls the pop callbacks once it's released it
+        item = self.queue_dict.pop( id_hash, None )
+        if item is None: return None
+        self._version += 1
+        self._on_popped( item )
         
-        self.queue_list.append( item )
-        self.queue_dict[ item.id_hash ] = item
-        self.push_counter += 1
+        return item
+    
+    def _call_pop_callbacks( self, item ):
+        
+        if item is None: return
+        for callback in self._on_pop_callbacks: callback( item )
+    
+    def add_push_callback( self, callback ):
+        """
+        Registers a function to be called w/ each job, right after it's been pushed.
+        """
+        self._on_push_callbacks.append( callback )
+    
+    def add_pop_callback( self, callback ):
+        """
+        Registers a function to be called w/ each job, right after it's been popped or deleted.
+        """
+        self._on_pop_callbacks.append( callback )
     
     def get_push_counter( self ):
         return self.push_counter
     
     def pop( self ):
-        if not self.is_empty():
-            # Remove from ID_hash first
-            del self.queue_dict[ self.queue_list[ 0 ].id_hash ]
-            return self.queue_list.pop( 0 )
+        with self._lock:
+            if self.is_empty(): return None
+            item = self._pop_locked( next( iter( self.queue_dict ) ) )
+        
+        self._call_pop_callbacks( item )
+        
+        return item
     
     def head( self ):
-        if not self.is_empty():
-            return self.queue_list[ 0 ]
-        else:
-            return None
+        with self._lock:
+            if not self.is_empty():
+                return next( iter( self.queue_dict.values() ) )
+            else:
+                return None
     
     def get_by_id_hash( self, id_hash ):
         
         return self.queue_dict[ id_hash ]
     
-    def delete_by_id_hash( self, id_hash ):
+    def pop_by_id_hash( self, id_hash ):
+        """
+        Removes a job from anywhere in the queue.
         
-        del self.queue_dict[ id_hash ]
-        size_before = self.size()
-        self.queue_list = list( self.queue_dict.values() )
-        size_after = self.size()
+        :return: The job, or None if it's not in the queue
+        """
+        with self._lock:
+            item = self._pop_locked( id_hash )
         
-        if size_after < size_before:
-            print( f"Deleted {size_before - size_after} items from queue" )
+        self._call_pop_callbacks( item )
+        
+        return item
+    
+    def pop_first( self, predicate ):
+        """
+        Removes the job closest to the head of the queue that satisfies the predicate.
+        
+        :return: The job, or None if none of them do
+        """
+        with self._lock:
+            item = next( ( item for item in self.queue_dict.values() if predicate( item ) ), None )
+            if item is not None: self._pop_locked( item.id_hash )
+        
+        self._call_pop_callbacks( item )
+        
+        return item
+    
+    def delete_by_id_hash( self, id_hash ):
+        
+        if self.pop_by_id_hash( id_hash ) is not None:
+            print( "Deleted 1 items from queue" )
         else:
             print( "ERROR: Could not delete by id_hash" )
+    
+    def __iter__( self ):
+        
+        # A snapshot, so that callers can iterate while other threads push and pop
+        with self._lock:
+            return iter( list( self.queue_dict.values() ) )
+    
+    def get_html_list( self, descending=False ):
+        """
+        Each job rendered as an HTML list item, in queue order or reversed. Only re-rendered when the queue has changed.
+        """
+        with self._lock:
+            if self._html_version != self._version:
+                self._html_list    = [ job.get_html() for job in self.queue_dict.values() ]
+                self._html_version = self._version
+            html_list = self._html_list
         
+        return html_list[ ::-1 ] if descending else list( html_list )
+    
     def is_empty( self ):
-        return len( self.queue_list ) == 0
+        return len( self.queue_dict ) == 0
     
     def size( self ):
-        return len( self.queue_list )
+        return len( self.queue_dict )
     
     def has_changed( self ):
         if self.size() != self.last_queue_size:
@@ -58,3 +196,41 @@ class FifoQueue:
             return True
         else:
             return False
+
+
+if __name__ == "__main__":
+    
+    # Micro-benchmark: push, head, delete from the middle and pop 100k jobs
+    class Job:
+        def __init__( self, i ):
+            self.id_hash = f"job-{i}"
+        def get_html( self ):
+            return f"<li id='{self.id_hash}'></li>"
+    
+    job_count = 100000
+    jobs      = [ Job( i ) for i in range( job_count ) ]
+    fifo      = FifoQueue()
+    
+    def time_it( msg, func, count=job_count ):
+        start = time.perf_counter()
+        func()
+        secs  = time.perf_counter() - start
+        print( f"{msg:<44} {secs * 1000:8.1f} ms total, {secs * 1e9 / count:8.1f} ns per call" )
+    
+    time_it( f"push() x {job_count:,}",                       lambda: [ fifo.push( job ) for job in jobs ] )
+    time_it( f"head() x {job_count:,}",                       lambda: [ fifo.head() for _ in range( job_count ) ] )
+    time_it( f"get_html_list() x 1 (cold)",                   lambda: fifo.get_html_list(), count=1 )
+    time_it( f"get_html_list() x 1 (warm)",                   lambda: fifo.get_html_list(), count=1 )
+    
+    def delete_odd_jobs():
+        # delete_by_id_hash() reports every deletion, which would swamp the console
+        with contextlib.redirect_stdout( io.StringIO() ):
+            for job in jobs[ 1::2 ]: fifo.delete_by_id_hash( job.id_hash )
+    
+    time_it( f"delete_by_id_hash() x {job_count // 2:,} (odd)", delete_odd_jobs, count=job_count // 2 )
+    time_it( f"pop() x {job_count // 2:,}",                   lambda: [ fifo.pop() for _ in range( job_count // 2 ) ], count=job_count // 2 )
+    assert fifo.is_empty()
+    
+    bounded = FifoQueue( max_size=1000, overflow_policy=FifoQueue.OVERFLOW_DROP_OLDEST )
+    time_it( f"push() x {job_count:,} (bounded, drop oldest)", lambda: [ bounded.push( job ) for job in jobs ] )
+    print( f"Bounded queue size [{bounded.size()}], dropped [{bounded.overflow_counter}], head [{bounded.head().id_hash}]" )
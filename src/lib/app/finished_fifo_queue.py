@@ -0,0 +1,163 @@
+import os
+import sqlite3
+import threading
+
+from lib.app.fifo_queue import FifoQueue
+
+
+class FinishedJob:
+    """
+    What's left of a finished job once it's been read back from disk: enough to list it, play its answer and delete it.
+    """
+    def __init__( self, id_hash, question="", last_question_asked="", answer_conversational="", run_date="", html="" ):
+
+        self.id_hash               = id_hash
+        self.question              = question
+        self.last_question_asked   = last_question_asked
+        self.answer_conversational = answer_conversational
+        self.run_date              = run_date
+        self.html                  = html
+
+    def get_html( self ):
+
+        return self.html if self.html else f"<li id='{self.id_hash}'>{self.run_date} Q: {self.last_question_asked}</li>"
+
+
+class FinishedJobStore:
+    """
+    SQLite table of every finished (done or dead) job, so that they outlive both the process and the in-memory queues.
+    """
+    COLUMNS = [ "id_hash", "question", "last_question_asked", "answer_conversational", "run_date", "html" ]
+
+    def __init__( self, db_path, debug=False ):
+
+        self.debug = debug
+
+        self._lock = threading.Lock()
+
+        os.makedirs( os.path.dirname( db_path ), exist_ok=True )
+        self._db = sqlite3.connect( db_path, check_same_thread=False )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS finished_jobs ( seq INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT, id_hash TEXT UNIQUE, "
+            "question TEXT, last_question_asked TEXT, answer_conversational TEXT, run_date TEXT, html TEXT )"
+        )
+        self._db.execute( "CREATE INDEX IF NOT EXISTS finished_jobs_queue_seq ON finished_jobs ( queue, seq )" )
+        self._db.commit()
+
+    def put( self, queue_name, job ):
+
+        values = [ str( getattr( job, column, "" ) or "" ) for column in self.COLUMNS[ 1:-1 ] ]
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO finished_jobs ( queue, id_hash, question, last_question_asked, answer_conversational, run_date, html ) VALUES ( ?, ?, ?, ?, ?, ?, ? )",
+                [ queue_name, job.id_hash ] + values + [ job.get_html() ]
+            )
+            self._db.commit()
+
+    def get( self, queue_name, id_hash ):
+        """
+        :return: A FinishedJob, or None if there's no such job in the queue
+        """
+        with self._lock:
+            row = self._db.execute( f"SELECT {', '.join( self.COLUMNS )} FROM finished_jobs WHERE queue = ? AND id_hash = ?", ( queue_name, id_hash ) ).fetchone()
+
+        return None if row is None else FinishedJob( *row )
+
+    def get_latest( self, queue_name, limit ):
+        """
+        :return: The queue's most recently finished jobs, oldest first
+        """
+        with self._lock:
+            rows = self._db.execute( f"SELECT {', '.join( self.COLUMNS )} FROM finished_jobs WHERE queue = ? ORDER BY seq DESC LIMIT ?", ( queue_name, limit ) ).fetchall()
+
+        return [ FinishedJob( *row ) for row in reversed( rows ) ]
+
+    def get_html_list( self, queue_name, limit ):
+        """
+        :return: The HTML of the queue's most recently finished jobs, oldest first
+        """
+        with self._lock:
+            rows = self._db.execute( "SELECT html FROM finished_jobs WHERE queue = ? ORDER BY seq DESC LIMIT ?", ( queue_name, limit ) ).fetchall()
+
+        return [ row[ 0 ] for row in reversed( rows ) ]
+
+    def count( self, queue_name ):
+
+        with self._lock:
+            return self._db.execute( "SELECT COUNT( * ) FROM finished_jobs WHERE queue = ?", ( queue_name, ) ).fetchone()[ 0 ]
+
+    def delete( self, queue_name, id_hash ):
+
+        with self._lock:
+            self._db.execute( "DELETE FROM finished_jobs WHERE queue = ? AND id_hash = ?", ( queue_name, id_hash ) )
+            self._db.commit()
+
+
+class FinishedFifoQueue( FifoQueue ):
+    """
+    Queue of finished jobs that doesn't grow without limit.
+
+    Every job pushed is written through to a FinishedJobStore, but only the latest max_size jobs are kept in memory.
+    Older ones are spilled: they're dropped from memory and read back from the store when they're asked for, as
+    FinishedJob records. On startup the latest jobs are loaded from the store, so finished jobs survive restarts.
+    """
+    def __init__( self, store, queue_name, max_size=100, max_html_list_size=1000 ):
+
+        super().__init__( max_size=max_size, overflow_policy=FifoQueue.OVERFLOW_DROP_OLDEST )
+
+        self.store              = store
+        self.queue_name         = queue_name
+        self.max_html_list_size = max_html_list_size
+
+        for job in store.get_latest( queue_name, max_size ): self.queue_dict[ job.id_hash ] = job
+        self._size = store.count( queue_name )
+
+    def push( self, item ):
+
+        # Written through before it's visible, so that nothing in memory is missing from disk
+        self.store.put( self.queue_name, item )
+        
+        return super().push( item )
+    
+    def _on_pushed( self, item, dropped ):
+        
+        self._size += 1
+
+    def pop_by_id_hash( self, id_hash ):
+
+        with self._lock:
+            item = super().pop_by_id_hash( id_hash )
+            if item is None: item = self.store.get( self.queue_name, id_hash )
+            if item is not None:
+                self.store.delete( self.queue_name, id_hash )
+                self._size -= 1
+                self._version += 1
+
+            return item
+
+    def pop( self ):
+
+        raise NotImplementedError( "FinishedFifoQueue.pop() not supported, finished jobs are only ever deleted by id_hash" )
+
+    def get_by_id_hash( self, id_hash ):
+
+        item = self.queue_dict.get( id_hash )
+        if item is None: item = self.store.get( self.queue_name, id_hash )
+        if item is None: raise KeyError( id_hash )
+
+        return item
+
+    def get_html_list( self, descending=False ):
+
+        # Spilled jobs too, straight from the store, which has every job. Only re-read after the queue has changed
+        with self._lock:
+            if self._html_version != self._version:
+                self._html_list    = self.store.get_html_list( self.queue_name, self.max_html_list_size )
+                self._html_version = self._version
+            html_list = self._html_list
+
+        return html_list[ ::-1 ] if descending else list( html_list )
+
+    def size( self ):
+
+        return self._size
@@ -0,0 +1,163 @@
+import functools
+import threading
+import time
+from concurrent.futures import CancelledError
+
+from lib.app.metrics_registry import get_stage_seconds_histogram
+
+
+class JobContext:
+    """
+    Deadlines and cancellation for one running job.
+
+    A job runs in stages: prompt, code and formatter. Each stage gets its own deadline, counted from when the stage
+    starts, from timeouts_secs. The code doing the work calls check() wherever it can stop cleanly, e.g. between
+    streamed tokens, and asks get_remaining_secs() for a timeout for anything that blocks, e.g. a subprocess or an HTTP
+    read. A subprocess registered w/ set_process() is killed as soon as the job is cancelled.
+
+    A stage that runs out of time is remembered, even if whatever it raised was caught along the way, so the job's
+    check()s keep failing from then on, and whoever ran it can tell that it timed out.
+
+    The context of the job running in the current thread is available from get_current_job_context().
+    """
+    STAGES = [ "prompt", "code", "formatter" ]
+
+    def __init__( self, id_hash, job_type, timeouts_secs ):
+
+        self.id_hash          = id_hash
+        self.job_type         = job_type
+        self.timeouts_secs    = timeouts_secs
+
+        self.stage            = None
+        self.deadline         = None
+        self.cancelled_reason = None
+        self.timed_out_stage  = None
+        self.started_at       = time.monotonic()
+
+        self._lock            = threading.Lock()
+        self._process         = None
+        self._released        = False
+
+    def enter_stage( self, stage ):
+        """
+        Starts the clock on a stage.
+
+        :return: The stage and deadline we had before, to be handed back to exit_stage()
+        """
+        previous = ( self.stage, self.deadline )
+
+        # Nested calls in the same stage, e.g. an override calling super(), don't get to restart the clock
+        if stage != self.stage:
+            timeout       = self.timeouts_secs.get( stage )
+            self.stage    = stage
+            self.deadline = None if timeout is None else time.monotonic() + timeout
+
+        return previous
+
+    def exit_stage( self, previous ):
+
+        # Noticed on the way out, for stages that ran over w/o ever checking in
+        if self.is_overdue() and self.timed_out_stage is None: self.timed_out_stage = self.stage
+
+        # e.g. back to the code stage, and what was left of its clock, once a debugger has finished prompting
+        self.stage, self.deadline = previous
+
+    def get_remaining_secs( self ):
+        """
+        :return: Seconds left in the current stage, never less than zero, or None if it has no deadline
+        """
+        return None if self.deadline is None else max( 0.0, self.deadline - time.monotonic() )
+
+    def is_overdue( self, grace_secs=0.0 ):
+
+        return self.deadline is not None and time.monotonic() > self.deadline + grace_secs
+
+    def check( self ):
+        """
+        Raises CancelledError if the job has been cancelled, or TimeoutError if the current stage has run out of time.
+        """
+        if self.cancelled_reason is not None:
+            raise CancelledError( f"Job [{self.id_hash}] cancelled: {self.cancelled_reason}" )
+        if self.is_overdue() and self.timed_out_stage is None: self.timed_out_stage = self.stage
+        if self.timed_out_stage is not None:
+            raise TimeoutError( f"Job [{self.id_hash}] [{self.timed_out_stage}] stage ran longer than [{self.timeouts_secs[ self.timed_out_stage ]}] secs" )
+
+    def set_process( self, process ):
+
+        with self._lock:
+            self._process = process
+
+        # Cancelled before the process was even started
+        if process is not None and self.cancelled_reason is not None: process.kill()
+
+    def cancel( self, reason ):
+        """
+        Flags the job as cancelled, so that its next check() raises, and kills its subprocess, if it has one running.
+        """
+        self.cancelled_reason = reason
+
+        with self._lock:
+            if self._process is not None and self._process.poll() is None: self._process.kill()
+
+    def release( self ):
+        """
+        :return: True the first time it's called, and False after that. Whoever gets True frees the job's slot
+        """
+        with self._lock:
+            released, self._released = self._released, True
+
+        return not released
+
+
+_current = threading.local()
+
+def set_current_job_context( job_context ):
+
+    _current.job_context = job_context
+
+def get_current_job_context():
+    """
+    :return: The context of the job running in this thread, or None outside of a job
+    """
+    return getattr( _current, "job_context", None )
+
+def check_current_job():
+    """
+    Raises if the job running in this thread has been cancelled or has run out of time. A no-op outside of a job.
+    """
+    job_context = get_current_job_context()
+    if job_context is not None: job_context.check()
+
+def get_current_job_remaining_secs():
+    """
+    :return: Seconds left in the current job's current stage, or None outside of a job or if the stage has no deadline
+    """
+    job_context = get_current_job_context()
+
+    return None if job_context is None else job_context.get_remaining_secs()
+
+def job_stage( stage ):
+    """
+    Decorator: runs the method as one of the job's stages, w/ that stage's deadline, and times it. A no-op outside of a job.
+    """
+    def decorator( method ):
+
+        @functools.wraps( method )
+        def wrapper( *args, **kwargs ):
+
+            job_context = get_current_job_context()
+            if job_context is None: return method( *args, **kwargs )
+
+            previous  = job_context.enter_stage( stage )
+            outermost = previous[ 0 ] != stage
+            start     = time.perf_counter()
+            try:
+                job_context.check()
+                return method( *args, **kwargs )
+            finally:
+                job_context.exit_stage( previous )
+                if outermost: get_stage_seconds_histogram().observe( time.perf_counter() - start, stage=stage )
+
+        return wrapper
+
+    return decorator
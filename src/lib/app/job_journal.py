@@ -0,0 +1,226 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import lib.utils.util as du
+
+
+class JobJournal:
+    """
+    Append-only write-ahead journal of job queue transitions, so that a restart doesn't lose jobs that were waiting.
+
+    Every push onto, and pop off of, an attached queue is appended as one JSON line. Lines are written by a background
+    thread that group commits them: whatever's piled up while the last batch was being written goes out in one write,
+    and one (optional) fsync. Pushes can wait for their line to hit the disk, pops never do, so neither the run loop nor
+    the request handlers queue up behind each other's fsyncs. Lines are written in order, so a durable line means every
+    line before it is durable too. A batch that fails to write is retried, after a backoff, until it goes through, and
+    pushes waiting on it are told it failed rather than left thinking their job's safe.
+
+    On startup the journal is replayed to find the jobs that were still in each queue when the process went away.
+    Those are available from take_recovered(), and the journal is compacted down to them. A line torn by a crash
+    mid-write is skipped.
+    """
+    def __init__( self, path, fsync=True, max_retry_delay_secs=5.0, debug=False ):
+
+        self.debug                = debug
+        self.path                 = path
+        self.fsync                = fsync
+        self.max_retry_delay_secs = max_retry_delay_secs
+
+        self._lock   = threading.Lock()
+
+        os.makedirs( os.path.dirname( path ), exist_ok=True )
+        self._recovered_by_queue = self._replay()
+        self._compact()
+
+        self._file = open( self.path, "a", encoding="utf-8" )
+
+        # Lines waiting for the writer thread, and the sequence numbers of the last line appended and the last one written
+        self._condition = threading.Condition()
+        self._pending   = [ ]
+        self._appended  = 0
+        self._durable   = 0
+        self._closed    = False
+
+        # Failed writes: how many so far, and the last one's exception
+        self._failures  = 0
+        self._error     = None
+
+        self.batches_written = 0
+        self.lines_written   = 0
+
+        self._thread = threading.Thread( target=self._enter_write_loop, name="JobJournal", daemon=True )
+        self._thread.start()
+
+    def _replay( self ):
+
+        live_by_queue = { }
+        if not os.path.exists( self.path ): return live_by_queue
+
+        torn_lines = 0
+        with open( self.path, "r", encoding="utf-8" ) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads( line )
+                except json.JSONDecodeError:
+                    torn_lines += 1
+                    continue
+
+                live = live_by_queue.setdefault( entry[ "queue" ], OrderedDict() )
+                if entry[ "op" ] == "push":
+                    live[ entry[ "id_hash" ] ] = entry
+                else:
+                    live.pop( entry[ "id_hash" ], None )
+
+        counts = { queue_name: len( live ) for queue_name, live in live_by_queue.items() }
+        print( f"Replayed job journal [{self.path}]: live jobs by queue {counts}, skipped [{torn_lines}] torn lines" )
+
+        return live_by_queue
+
+    def _compact( self ):
+
+        # Written to the side and swapped in, so a crash while compacting leaves either the old journal or the new one
+        temp_path = self.path + ".tmp"
+        with open( temp_path, "w", encoding="utf-8" ) as journal:
+            for live in self._recovered_by_queue.values():
+                for entry in live.values(): journal.write( json.dumps( entry ) + "\n" )
+            journal.flush()
+            os.fsync( journal.fileno() )
+        os.replace( temp_path, self.path )
+
+    def take_recovered( self, queue_name ):
+        """
+        Hands over the jobs that were still in the queue at shutdown, once. ¡OJO! The caller is responsible for calling
+        record_pop() for each of them once it's been dealt with, otherwise they'll be recovered again after the next restart.
+
+        :return: The journal entries of the jobs, oldest first
+        """
+        with self._lock:
+            live = self._recovered_by_queue.pop( queue_name, { } )
+
+        return list( live.values() )
+
+    def attach( self, queue_name, fifo_queue, wait_for_pushes=True ):
+        """
+        Journals every push onto, and pop off of, the queue from here on.
+
+        :param wait_for_pushes: Whether push() waits until its line is on disk. Only pushes that somebody's been promised,
+        e.g. a job accepted from a client, need to. A lost pop, or a lost push onto the run queue, just means the job
+        is recovered from the queue it was in before
+        """
+        fifo_queue.add_push_callback( lambda job: self.record_push( queue_name, job, wait=wait_for_pushes ) )
+        fifo_queue.add_pop_callback( lambda job: self.record_pop( queue_name, job.id_hash ) )
+
+    def record_push( self, queue_name, job, wait=True ):
+
+        self._append( {
+            "queue"              : queue_name,
+            "op"                 : "push",
+            "id_hash"            : job.id_hash,
+            "date"               : du.get_current_datetime(),
+            "run_date"           : getattr( job, "run_date", None ),
+            "question"           : getattr( job, "question", None ),
+            "last_question_asked": getattr( job, "last_question_asked", None ),
+        }, wait=wait )
+
+    def record_pop( self, queue_name, id_hash ):
+
+        self._append( { "queue": queue_name, "op": "pop", "id_hash": id_hash }, wait=False )
+
+    def _append( self, entry, wait=False ):
+
+        line = json.dumps( entry ) + "\n"
+        with self._condition:
+            self._pending.append( line )
+            self._appended += 1
+            sequence = self._appended
+            failures = self._failures
+            self._condition.notify_all()
+
+            if not wait: return
+            self._condition.wait_for( lambda: self._durable >= sequence or self._failures > failures or self._closed )
+            if self._durable < sequence and self._failures > failures:
+                # ¡OJO! The line's still queued and will be retried, but nobody can promise the caller it'll make it
+                raise OSError( f"Job journal [{self.path}] write failed: {self._error}" ) from self._error
+
+    def flush( self, timeout=None ):
+        """
+        Blocks until every line appended so far has been written.
+
+        :return: True if they have, False if we timed out
+        """
+        with self._condition:
+            return self._condition.wait_for( lambda: self._durable >= self._appended or self._closed, timeout=timeout )
+
+    def get_stats( self ):
+
+        with self._condition:
+            return {
+                "pending"        : len( self._pending ),
+                "lines_written"  : self.lines_written,
+                "batches_written": self.batches_written,
+                "failures"       : self._failures,
+                "last_error"     : None if self._error is None else str( self._error ),
+            }
+
+    def _enter_write_loop( self ):
+
+        while True:
+
+            with self._condition:
+                self._condition.wait_for( lambda: self._pending or self._closed )
+                if self._closed and not self._pending: return
+                lines, self._pending = self._pending, [ ]
+                sequence = self._appended
+
+            try:
+                self._write_lines( lines )
+            except Exception as e:
+                with self._condition:
+                    self._failures += 1
+                    self._error     = e
+                    failures        = self._failures
+                    closed          = self._closed
+                    # Back to the head of the line, ahead of anything appended since, unless we're shutting down
+                    if not closed: self._pending = lines + self._pending
+                    self._condition.notify_all()
+
+                delay_secs = min( self.max_retry_delay_secs, 0.1 * 2 ** ( failures - 1 ) )
+                explanation = f"Writing [{len( lines )}] job journal lines failed, " + ( "giving up on them" if closed else f"retrying in [{delay_secs:.1f}] secs" )
+                du.print_stack_trace( e, explanation=explanation, caller="JobJournal._enter_write_loop()" )
+                if not closed: time.sleep( delay_secs )
+                continue
+
+            with self._condition:
+                self._durable          = sequence
+                self._error            = None
+                self.lines_written    += len( lines )
+                self.batches_written  += 1
+                self._condition.notify_all()
+
+    def _write_lines( self, lines ):
+
+        # Whatever a failed write left behind, i.e. a torn last line, is cut off before we try again
+        position = self._file.tell()
+        try:
+            self._file.write( "".join( lines ) )
+            self._file.flush()
+            if self.fsync: os.fsync( self._file.fileno() )
+        except Exception:
+            try:
+                self._file.truncate( position )
+                self._file.seek( position )
+            except Exception:
+                pass
+            raise
+
+    def close( self ):
+
+        # Whatever's still pending is written before the writer thread exits
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._file.close()
@@ -0,0 +1,128 @@
+import threading
+
+
+class JobScheduler:
+    """
+    Base class for the policies that decide which todo job runs next.
+
+    A policy is just a sort key: the eligible job w/ the lowest key runs first, ties go to whoever was pushed first. A
+    job's key is computed once, when it's pushed, and never changes while it waits, so the queue can keep its jobs in a
+    heap rather than sorting them all over again every time it pops one. Every policy also estimates how long a job will run, which is what expected wait times are built from: a solution
+    snapshot's own mean run time, when it has one, otherwise the mean of the jobs of its type that have run so far.
+    """
+    name = None
+
+    def __init__( self, default_run_ms=10000, debug=False ):
+
+        self.debug          = debug
+        self.default_run_ms = default_run_ms
+
+        self._lock                = threading.Lock()
+        self._total_ms_by_type    = { }
+        self._run_count_by_type   = { }
+
+    @staticmethod
+    def get_job_type( job ):
+
+        return type( job ).__name__
+
+    def record_run_ms( self, job, run_ms ):
+        """
+        Folds a finished job's run time into the historical mean for its type.
+        """
+        job_type = self.get_job_type( job )
+
+        with self._lock:
+            self._total_ms_by_type[ job_type ]  = self._total_ms_by_type.get( job_type, 0 ) + run_ms
+            self._run_count_by_type[ job_type ] = self._run_count_by_type.get( job_type, 0 ) + 1
+
+    def get_mean_run_ms_by_type( self ):
+
+        with self._lock:
+            return { job_type: int( total_ms / self._run_count_by_type[ job_type ] ) for job_type, total_ms in self._total_ms_by_type.items() }
+
+    def get_expected_run_ms( self, job ):
+
+        # Snapshots that have been rerun know their own cached run time. Their first run, by the agent, doesn't count
+        runtime_stats = getattr( job, "runtime_stats", None )
+        if runtime_stats is not None and runtime_stats.get( "run_count", -1 ) > 0: return runtime_stats[ "mean_run_ms" ]
+
+        job_type = self.get_job_type( job )
+        with self._lock:
+            if self._run_count_by_type.get( job_type, 0 ) > 0:
+                return int( self._total_ms_by_type[ job_type ] / self._run_count_by_type[ job_type ] )
+
+        return self.default_run_ms
+
+    def get_sort_key( self, job, pushed_at_ms ):
+        """
+        :param pushed_at_ms: When the job was pushed, in milliseconds on the monotonic clock
+
+        :return: The job's place in line, lowest first
+        """
+        raise NotImplementedError( f"{type( self ).__name__}.get_sort_key() not implemented" )
+
+    def __str__( self ):
+
+        return f"{type( self ).__name__}( name={self.name}, default_run_ms={self.default_run_ms} )"
+
+
+class FifoJobScheduler( JobScheduler ):
+    """
+    First come, first served.
+    """
+    name = "fifo"
+
+    def get_sort_key( self, job, pushed_at_ms ):
+
+        return 0
+
+
+class ShortestJobFirstScheduler( JobScheduler ):
+    """
+    Shortest expected job first: minimizes the mean wait, but a steady stream of short jobs can starve a long one.
+    """
+    name = "sjf"
+
+    def get_sort_key( self, job, pushed_at_ms ):
+
+        return self.get_expected_run_ms( job )
+
+
+class AgingJobScheduler( JobScheduler ):
+    """
+    Shortest expected job first, w/ aging: every millisecond a job waits takes aging_weight milliseconds off its expected
+    run time, so a long job is never passed over for longer than ( its run time - the shorter job's ) / aging_weight.
+
+    Since every job waiting at any given moment has aged by the same "now", comparing expected run time - aging_weight *
+    waited_ms is the same as comparing expected run time + aging_weight * pushed_at_ms, which doesn't change as they wait.
+    """
+    name = "aging"
+
+    def __init__( self, aging_weight=1.0, default_run_ms=10000, debug=False ):
+
+        super().__init__( default_run_ms=default_run_ms, debug=debug )
+
+        self.aging_weight = aging_weight
+
+    def get_sort_key( self, job, pushed_at_ms ):
+
+        return self.get_expected_run_ms( job ) + self.aging_weight * pushed_at_ms
+
+
+def get_job_scheduler_by_name( name, **kwargs ):
+    """
+    Factory for todo queue schedulers.
+
+    :param name: One of "fifo", "sjf" or "aging"
+
+    :param kwargs: Passed through to the scheduler's constructor, e.g. aging_weight for "aging"
+
+    :return: A JobScheduler
+    """
+    schedulers = { scheduler.name: scheduler for scheduler in [ FifoJobScheduler, ShortestJobFirstScheduler, AgingJobScheduler ] }
+
+    if name not in schedulers:
+        raise ValueError( f"Unknown job scheduler [{name}], expected one of {list( schedulers.keys() )}" )
+
+    return schedulers[ name ]( **kwargs )
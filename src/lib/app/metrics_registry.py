@@ -0,0 +1,221 @@
+import math
+import threading
+
+
+def _escape( value ):
+
+    return str( value ).replace( "\\", "\\\\" ).replace( "\"", "\\\"" ).replace( "\n", "\\n" )
+
+def _format_labels( names, values, extra=None ):
+
+    pairs = [ f'{name}="{_escape( value )}"' for name, value in zip( names, values ) ]
+    if extra is not None: pairs.append( f'{extra[ 0 ]}="{_escape( extra[ 1 ] )}"' )
+
+    return "{" + ",".join( pairs ) + "}" if pairs else ""
+
+def _format_value( value ):
+
+    if value == math.inf: return "+Inf"
+
+    return repr( float( value ) ) if isinstance( value, float ) else str( value )
+
+
+class Metric:
+    """
+    Base class for a named metric, w/ one series per combination of label values.
+    """
+    type_name = None
+
+    def __init__( self, name, help_text, label_names=( ) ):
+
+        self.name        = name
+        self.help_text   = help_text
+        self.label_names = tuple( label_names )
+
+        self._lock       = threading.Lock()
+        self._series     = { }
+
+    def _get_key( self, labels ):
+
+        if set( labels.keys() ) != set( self.label_names ):
+            raise ValueError( f"Metric [{self.name}] expects labels {list( self.label_names )}, got {list( labels.keys() )}" )
+
+        return tuple( str( labels[ name ] ) for name in self.label_names )
+
+    def render( self ):
+
+        lines = [ f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}" ]
+        with self._lock:
+            series = sorted( self._series.items(), key=lambda item: item[ 0 ] )
+        for key, value in series: lines += self._render_series( key, value )
+
+        return lines
+
+    def _render_series( self, key, value ):
+
+        return [ f"{self.name}{_format_labels( self.label_names, key )} {_format_value( value )}" ]
+
+
+class CounterMetric( Metric ):
+    """
+    Only ever goes up, e.g. jobs finished. Rates are computed from it by whoever's scraping.
+    """
+    type_name = "counter"
+
+    def inc( self, amount=1, **labels ):
+
+        key = self._get_key( labels )
+        with self._lock:
+            self._series[ key ] = self._series.get( key, 0 ) + amount
+
+
+class GaugeMetric( Metric ):
+    """
+    Goes up and down, e.g. queue depth. Either set directly, or read from a function at scrape time.
+    """
+    type_name = "gauge"
+
+    def __init__( self, name, help_text, label_names=( ) ):
+
+        super().__init__( name, help_text, label_names=label_names )
+
+        self._functions = { }
+
+    def set( self, value, **labels ):
+
+        key = self._get_key( labels )
+        with self._lock:
+            self._series[ key ] = value
+
+    def set_function( self, function, **labels ):
+        """
+        Reads the value from the function every time the metric is rendered, so it's never stale.
+        """
+        key = self._get_key( labels )
+        with self._lock:
+            self._functions[ key ] = function
+
+    def render( self ):
+
+        with self._lock:
+            functions = list( self._functions.items() )
+        for key, function in functions:
+            value = function()
+            with self._lock:
+                self._series[ key ] = value
+
+        return super().render()
+
+
+class HistogramMetric( Metric ):
+    """
+    Distribution of observations, e.g. latencies in seconds, as cumulative counts per bucket plus their sum and count.
+    """
+    type_name = "histogram"
+
+    # Seconds, from a quick cache hit up to a slow agent w/ a round of debugging
+    DEFAULT_BUCKETS = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300 ]
+
+    def __init__( self, name, help_text, label_names=( ), buckets=None ):
+
+        super().__init__( name, help_text, label_names=label_names )
+
+        self.buckets = sorted( self.DEFAULT_BUCKETS if buckets is None else buckets ) + [ math.inf ]
+
+    def observe( self, value, **labels ):
+
+        key = self._get_key( labels )
+        with self._lock:
+            series = self._series.get( key )
+            if series is None:
+                series = self._series[ key ] = { "counts": [ 0 ] * len( self.buckets ), "sum": 0.0, "count": 0 }
+
+            # Counts are kept per bucket and only made cumulative when rendered
+            for i, upper_bound in enumerate( self.buckets ):
+                if value <= upper_bound:
+                    series[ "counts" ][ i ] += 1
+                    break
+            series[ "sum" ]   += value
+            series[ "count" ] += 1
+
+    def _render_series( self, key, series ):
+
+        lines      = [ ]
+        cumulative = 0
+        for upper_bound, count in zip( self.buckets, series[ "counts" ] ):
+            cumulative += count
+            lines.append( f"{self.name}_bucket{_format_labels( self.label_names, key, extra=( 'le', _format_value( upper_bound ) ) )} {cumulative}" )
+        lines.append( f"{self.name}_sum{_format_labels( self.label_names, key )} {_format_value( series[ 'sum' ] )}" )
+        lines.append( f"{self.name}_count{_format_labels( self.label_names, key )} {series[ 'count' ]}" )
+
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Process wide set of metrics, rendered in the Prometheus text exposition format for the /metrics endpoint.
+
+    Metrics are created on first use and shared after that, so the modules that feed a metric don't need to agree on
+    which of them creates it, only on its name, type and labels.
+    """
+    def __init__( self ):
+
+        self._lock            = threading.Lock()
+        self._metrics_by_name = { }
+
+    def _get_or_create( self, metric_class, name, help_text, label_names, **kwargs ):
+
+        with self._lock:
+            metric = self._metrics_by_name.get( name )
+            if metric is None:
+                metric = self._metrics_by_name[ name ] = metric_class( name, help_text, label_names=label_names, **kwargs )
+            elif type( metric ) is not metric_class or metric.label_names != tuple( label_names ):
+                raise ValueError( f"Metric [{name}] already registered as a {metric.type_name} w/ labels {list( metric.label_names )}" )
+
+        return metric
+
+    def counter( self, name, help_text, label_names=( ) ):
+
+        return self._get_or_create( CounterMetric, name, help_text, label_names )
+
+    def gauge( self, name, help_text, label_names=( ) ):
+
+        return self._get_or_create( GaugeMetric, name, help_text, label_names )
+
+    def histogram( self, name, help_text, label_names=( ), buckets=None ):
+
+        return self._get_or_create( HistogramMetric, name, help_text, label_names, buckets=buckets )
+
+    def render( self ):
+        """
+        :return: Every metric in the Prometheus text exposition format, version 0.0.4
+        """
+        with self._lock:
+            metrics = sorted( self._metrics_by_name.values(), key=lambda metric: metric.name )
+
+        lines = [ ]
+        for metric in metrics: lines += metric.render()
+
+        return "\n".join( lines ) + "\n"
+
+
+_metrics_registry      = None
+_metrics_registry_lock = threading.Lock()
+
+def get_metrics_registry():
+    """
+    Returns the process wide metrics registry, creating it the first time it's asked for.
+    """
+    global _metrics_registry
+
+    with _metrics_registry_lock:
+        if _metrics_registry is None:
+            _metrics_registry = MetricsRegistry()
+
+    return _metrics_registry
+
+def get_stage_seconds_histogram():
+    """
+    The one histogram every pipeline stage, from routing through to TTS, is timed in.
+    """
+    return get_metrics_registry().histogram( "gib_stage_seconds", "Time spent in each stage of answering a question", label_names=( "stage", ) )
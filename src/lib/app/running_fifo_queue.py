@@ -1,19 +1,28 @@
 from lib.agents.receptionist_agent       import ReceptionistAgent
 from lib.agents.weather_agent            import WeatherAgent
 from lib.app.fifo_queue                  import FifoQueue
+from lib.app.job_context                 import JobContext, check_current_job, set_current_job_context
+from lib.app.metrics_registry            import get_metrics_registry
 from lib.agents.agent_base               import AgentBase
 # from lib.agents.agent_function_mapping   import FunctionMappingAgent
-from lib.memory.input_and_output_table   import InputAndOutputTable
+from lib.memory.lancedb_registry         import get_lancedb_registry
 from lib.memory.solution_snapshot        import SolutionSnapshot
 
 import lib.utils.util as du
 import lib.utils.util_stopwatch as sw
 
 from flask import url_for
+from collections import Counter, deque
+import json
+import threading
+import time
 import traceback
 import pprint
 
 class RunningFifoQueue( FifoQueue ):
+    
+    STAGE_TIMEOUTS_SECS = { "default": { "prompt": 120, "code": 60, "formatter": 60 } }
+    
     def __init__( self, app, socketio, snapshot_mgr, jobs_todo_queue, jobs_done_queue, jobs_dead_queue, config_mgr=None ):
         
         super().__init__()
@@ -27,52 +36,290 @@ class RunningFifoQueue( FifoQueue ):
         
         self.auto_debug      = False if config_mgr is None else config_mgr.get( "auto_debug",  default=False, return_type="boolean" )
         self.inject_bugs     = False if config_mgr is None else config_mgr.get( "inject_bugs", default=False, return_type="boolean" )
-        self.io_tbl          = InputAndOutputTable()
+        
+        # How many jobs can run at once, overall and by job type, i.e. agent class name or SolutionSnapshot. Agents that
+        # share one in-memory model on the GPU should be limited to one at a time, agents that call remote APIs can have more
+        self.max_concurrent_jobs         = 1  if config_mgr is None else config_mgr.get( "jobs_run_max_concurrent", default=4, return_type="int" )
+        self.max_concurrent_jobs_by_type = { } if config_mgr is None else config_mgr.get( "jobs_run_max_concurrent_by_type", default="{}", return_type="json" )
+        # ¡OJO! Cached solutions are shallow copies of the snapshot in the manager, sharing its runtime stats and synonymous
+        # questions, so unless configured otherwise they run one at a time
+        self.max_concurrent_jobs_by_type.setdefault( "SolutionSnapshot", 1 )
+        self._running_jobs_by_type       = Counter()
+        
+        # The run loop sleeps until a job is pushed onto the todo queue, or a running job frees up its slot, rather than
+        # polling. The timeout is only a safety net
+        self.idle_timeout_secs           = 5.0
+        self._wake_up                    = self._create_event()
+        self._pushed_at_by_id_hash       = { }
+        self._push_to_start_ms           = deque( maxlen=1000 )
+        self.jobs_todo_queue.add_push_callback( self._on_todo_job_pushed )
+        
+        # A job's finished once it leaves the run queue, or goes straight from todo to dead, and the next time its
+        # question is asked it has to be run again, rather than coalesced w/ it
+        self.add_pop_callback( self.jobs_todo_queue.end_single_flight )
+        self.jobs_dead_queue.add_push_callback( self.jobs_todo_queue.end_single_flight )
+        
+        # Deadlines, in seconds, for each stage of a job (prompt, code and formatter), by job type, w/ "default" for
+        # types that don't have their own. A job that blows through a deadline by more than the grace period is given up
+        # on by the watchdog, even if its thread is still stuck, so that its slot is freed
+        self.stage_timeouts_secs         = self.STAGE_TIMEOUTS_SECS if config_mgr is None else config_mgr.get( "jobs_stage_timeouts_secs", default=json.dumps( self.STAGE_TIMEOUTS_SECS ), return_type="json" )
+        self.stage_timeout_grace_secs    = 5.0 if config_mgr is None else config_mgr.get( "jobs_stage_timeout_grace_secs", default=5.0, return_type="float" )
+        self.watchdog_interval_secs      = 1.0
+        self._contexts_by_id_hash        = { }
+        self._timed_out_counter          = 0
+        self._cancelled_counter          = 0
+        
+        # Queue wait, service time and throughput (the histograms' counts) by job type, for /metrics
+        metrics                          = get_metrics_registry()
+        self._push_to_start_histogram    = metrics.histogram( "gib_job_push_to_start_seconds", "Time from a job being pushed onto the todo queue to it starting", label_names=( "job_type", ) )
+        self._run_histogram              = metrics.histogram( "gib_job_run_seconds", "Time from a job starting to it being filed under done or dead", label_names=( "job_type", "outcome" ) )
+        self._abandoned_counter          = metrics.counter( "gib_jobs_abandoned_total", "Running jobs given up on, by whether they timed out or were cancelled", label_names=( "reason", ) )
+        queue_depth                      = metrics.gauge( "gib_queue_depth", "Jobs in each queue", label_names=( "queue", ) )
+        for queue_name, fifo_queue in [ ( "run", self ), ( "done", self.jobs_done_queue ), ( "dead", self.jobs_dead_queue ) ]:
+            queue_depth.set_function( fifo_queue.size, queue=queue_name )
+    
+    def _create_event( self ):
+        
+        # Whatever flavor of event the Socket.IO async mode (threading, eventlet, gevent) needs, so that waiting on it
+        # doesn't block the other green threads
+        try:
+            return self.socketio.server.eio.create_event()
+        except AttributeError:
+            return threading.Event()
+    
+    def _on_todo_job_pushed( self, job ):
+        
+        self._pushed_at_by_id_hash[ job.id_hash ] = time.perf_counter()
+        self._wake_up.set()
+    
+    @property
+    def io_tbl( self ):
+        
+        # Looked up every time, rather than held on to, so that we pick up the new table after a configuration refresh
+        return get_lancedb_registry().get_input_and_output_table()
     
     def enter_running_loop( self ):
         
-        print( "Starting job run loop..." )
+        print( f"Starting job run loop w/ up to [{self.max_concurrent_jobs}] concurrent jobs, limits by type {self.max_concurrent_jobs_by_type}..." )
+        self.socketio.start_background_task( self._enter_watchdog_loop )
+        
         while True:
             
+            # Cleared before we look, so that a push that lands between looking and waiting isn't missed
+            self._wake_up.clear()
+            
             if not self.jobs_todo_queue.is_empty():
                 
+                job = self._pop_next_runnable_job()
+                if job is None:
+                    # Every job waiting is of a type that's already running as many jobs as it's allowed to
+                    self._wake_up.wait( timeout=self.idle_timeout_secs )
+                    continue
+                
+                pushed_at = self._pushed_at_by_id_hash.pop( job.id_hash, None )
+                if pushed_at is not None:
+                    push_to_start_secs = time.perf_counter() - pushed_at
+                    self._push_to_start_ms.append( push_to_start_secs * 1000 )
+                    self._push_to_start_histogram.observe( push_to_start_secs, job_type=self._get_job_type( job ) )
+                
                 print( "Jobs running @ " + du.get_current_datetime() )
                 
-                print( "popping one job from todo Q" )
-                job = self.jobs_todo_queue.pop()
+                print( f"Popped one job from todo Q, [{self.size() + 1}] jobs running" )
                 self.socketio.emit( 'todo_update', { 'value': self.jobs_todo_queue.size() } )
                 
                 self.push( job )
                 self.socketio.emit( 'run_update', { 'value': self.size() } )
                 
-                # Point to the head of the queue without popping it
-                running_job = self.head()
-                
-                # Limit the length of the question string
-                truncated_question = du.truncate_string( running_job.question, max_len=64 )
-                
-                run_timer = sw.Stopwatch( "Starting job run timer..." )
-                
-                # if type( running_job ) == FunctionMappingAgent:
-                #     running_job = self._handle_function_mapping_agent( running_job, truncated_question )
-                
-                # Assume for now that all *agents* are of type AgentBase. If it's not, then it's a solution snapshot
-                if isinstance( running_job, AgentBase ):
-                    running_job = self._handle_base_agent( running_job, truncated_question, run_timer )
-                else:
-                    running_job = self._handle_solution_snapshot( running_job, truncated_question, run_timer )
+                self.socketio.start_background_task( self._run_job, job )
             
             else:
                 # print( "No jobs to pop from todo Q " )
-                self.socketio.sleep( 1 )
+                self._wake_up.wait( timeout=self.idle_timeout_secs )
+    
+    def get_stats( self ):
+        """
+        Jobs running, overall and by type, and the latency between a job being pushed onto the todo queue and starting.
+        """
+        latencies  = sorted( self._push_to_start_ms )
+        percentile = lambda p: None if not latencies else round( latencies[ min( len( latencies ) - 1, int( p * len( latencies ) ) ) ], 3 )
+        
+        with self._lock:
+            running_by_type = { job_type: count for job_type, count in self._running_jobs_by_type.items() if count > 0 }
+        
+        return {
+            "running"                  : self.size(),
+            "running_by_type"          : running_by_type,
+            "max_concurrent"           : self.max_concurrent_jobs,
+            "max_concurrent_by_type"   : self.max_concurrent_jobs_by_type,
+            "todo"                     : self.jobs_todo_queue.size(),
+            "latency_samples"          : len( latencies ),
+            "push_to_start_ms_p50"     : percentile( 0.50 ),
+            "push_to_start_ms_p95"     : percentile( 0.95 ),
+            "push_to_start_ms_max"     : None if not latencies else round( latencies[ -1 ], 3 ),
+            "timed_out"                : self._timed_out_counter,
+            "cancelled"                : self._cancelled_counter,
+            **self.jobs_todo_queue.get_single_flight_stats(),
+        }
+    
+    @staticmethod
+    def _get_job_type( job ):
+        
+        return type( job ).__name__
+    
+    def _has_free_slot( self, job ):
+        
+        job_type = self._get_job_type( job )
+        
+        return self._running_jobs_by_type[ job_type ] < self.max_concurrent_jobs_by_type.get( job_type, self.max_concurrent_jobs )
     
-    def _handle_error_case( self, response, running_job, truncated_question ):
+    def _pop_next_runnable_job( self ):
+        """
+        Takes the job the todo queue's scheduler would run next, among those whose type has a free slot, and reserves the slot for it.
+        
+        :return: The job, or None if we're running as many jobs as we're allowed to
+        """
+        # ¡OJO! Only the run loop takes slots, job threads and the watchdog only ever give them back, so there are at least
+        # as many free slots when we reserve one below as there were when we checked. That lets the todo queue's pop
+        # callbacks, e.g. the journal's, run w/o our lock held
+        if self.size() >= self.max_concurrent_jobs: return None
+        
+        # In the scheduler's order, but a job whose type is at its limit doesn't hold up the jobs behind it
+        job = self.jobs_todo_queue.pop_next( self._has_free_slot )
+        if job is not None:
+            with self._lock:
+                self._running_jobs_by_type[ self._get_job_type( job ) ] += 1
+        
+        return job
+    
+    def _run_job( self, running_job ):
+        
+        # ¡OJO! Agents are recast as solution snapshots when they're done, which gives them a new id_hash, so hang on to
+        # the one they're filed under in the run queue
+        id_hash  = running_job.id_hash
+        job_type = self._get_job_type( running_job )
+        
+        job_context = JobContext( id_hash, job_type, self._get_stage_timeouts_secs( job_type ) )
+        self._contexts_by_id_hash[ id_hash ] = job_context
+        set_current_job_context( job_context )
+        
+        try:
+            # Limit the length of the question string
+            truncated_question = du.truncate_string( running_job.question, max_len=64 )
+            
+            run_timer = sw.Stopwatch( "Starting job run timer..." )
+            
+            # if type( running_job ) == FunctionMappingAgent:
+            #     running_job = self._handle_function_mapping_agent( running_job, truncated_question )
+            
+            # Assume for now that all *agents* are of type AgentBase. If it's not, then it's a solution snapshot
+            if isinstance( running_job, AgentBase ):
+                self._handle_base_agent( running_job, truncated_question, run_timer, id_hash )
+            else:
+                self._handle_solution_snapshot( running_job, truncated_question, run_timer, id_hash )
+            
+            # What the scheduler estimates the run times of agents, and of snapshots that haven't been rerun yet, from.
+            # Failures don't count, they tend to be quick
+            if id_hash not in self.jobs_dead_queue.queue_dict: self.jobs_todo_queue.scheduler.record_run_ms( running_job, run_timer.get_delta_ms() )
+        
+        except Exception as e:
+            
+            du.print_stack_trace( e, explanation=f"Running [{job_type}] job failed", caller="RunningFifoQueue._run_job()" )
+            if id_hash in self.queue_dict:
+                if isinstance( e, TimeoutError ): self._count_timed_out()
+                self._handle_error_case( { "output": str( e ) }, running_job, du.truncate_string( running_job.question, max_len=64 ), id_hash )
+        
+        finally:
+            set_current_job_context( None )
+            self._contexts_by_id_hash.pop( id_hash, None )
+            
+            # Unless the watchdog already gave up on this job and freed its slot
+            if job_context.release(): self._release_slot( job_context, "dead" if id_hash in self.jobs_dead_queue.queue_dict else "done" )
+    
+    def _release_slot( self, job_context, outcome ):
+        
+        self._run_histogram.observe( time.monotonic() - job_context.started_at, job_type=job_context.job_type, outcome=outcome )
+        
+        with self._lock:
+            self._running_jobs_by_type[ job_context.job_type ] -= 1
+        
+        # A slot just opened up, there may be a job waiting for it
+        self._wake_up.set()
+    
+    def _get_stage_timeouts_secs( self, job_type ):
+        
+        stage_timeouts_secs = dict( self.stage_timeouts_secs.get( "default", { } ) )
+        stage_timeouts_secs.update( self.stage_timeouts_secs.get( job_type, { } ) )
+        
+        return stage_timeouts_secs
+    
+    def _enter_watchdog_loop( self ):
+        
+        # ¡OJO! Python threads can't be killed. A job that's stuck somewhere it never checks its context, e.g. a blocking
+        # call w/o a timeout, keeps its thread, but not its slot: it's filed under dead, and whatever it returns is dropped
+        while True:
+            
+            try:
+                for job_context in list( self._contexts_by_id_hash.values() ):
+                    if job_context.is_overdue( grace_secs=self.stage_timeout_grace_secs ):
+                        self._count_timed_out()
+                        self._abandon_job( job_context, f"[{job_context.stage}] stage ran past its [{job_context.timeouts_secs.get( job_context.stage )}] sec deadline" )
+            
+            except Exception as e:
+                du.print_stack_trace( e, explanation="Watchdog pass failed", caller="RunningFifoQueue._enter_watchdog_loop()" )
+            
+            self.socketio.sleep( self.watchdog_interval_secs )
+    
+    def _count_timed_out( self ):
+        
+        self._timed_out_counter += 1
+        self._abandoned_counter.inc( reason="timed_out" )
+    
+    def _abandon_job( self, job_context, reason ):
+        
+        job_context.cancel( reason )
+        self._contexts_by_id_hash.pop( job_context.id_hash, None )
+        
+        running_job = self.queue_dict.get( job_context.id_hash )
+        if running_job is not None:
+            self._handle_error_case( { "output": f"Job [{job_context.id_hash}] abandoned: {reason}" }, running_job, du.truncate_string( running_job.question, max_len=64 ), job_context.id_hash )
+        
+        if job_context.release(): self._release_slot( job_context, "dead" )
+    
+    def cancel_job( self, id_hash, reason="Cancelled by user" ):
+        """
+        Cancels a job, whether it's running or still waiting to run, and files it under dead.
+        
+        A running job's current stage is interrupted as soon as it next checks in, and its subprocess, if it has one, is
+        killed. Its slot is freed right away, either way.
+        
+        :return: True if the job was found and cancelled, False if it's not running or waiting to run
+        """
+        job_context = self._contexts_by_id_hash.get( id_hash )
+        if job_context is not None:
+            
+            self._cancelled_counter += 1
+            self._abandoned_counter.inc( reason="cancelled" )
+            self._abandon_job( job_context, reason )
+            return True
+        
+        waiting_job = self.jobs_todo_queue.pop_by_id_hash( id_hash )
+        if waiting_job is not None:
+            
+            self._cancelled_counter += 1
+            self._pushed_at_by_id_hash.pop( id_hash, None )
+            self.jobs_dead_queue.push( waiting_job )
+            return True
+        
+        return False
+    
+    def _handle_error_case( self, response, running_job, truncated_question, id_hash ):
         
         du.print_banner( f"Error running code for [{truncated_question}]", prepend_nl=True )
         
         for line in response[ "output" ].split( "\n" ): print( line )
         
-        self.pop()
+        # Already filed under dead, e.g. by the watchdog
+        if self.pop_by_id_hash( id_hash ) is None: return running_job
         
         url = self._get_audio_url( "I'm sorry Dave, I'm afraid I can't do that. Please check your logs" )
         self.socketio.emit( 'audio_update', { 'audioURL': url } )
@@ -82,7 +329,7 @@ class RunningFifoQueue( FifoQueue ):
         
         return running_job
     
-    def _handle_base_agent( self, running_job, truncated_question, agent_timer ):
+    def _handle_base_agent( self, running_job, truncated_question, agent_timer, id_hash ):
         
         msg = f"Running AgentBase for [{truncated_question}]..."
         
@@ -94,11 +341,27 @@ class RunningFifoQueue( FifoQueue ):
         formatted_output = "ERROR: Formatted output not yet generated!?!"
         try:
             formatted_output    = running_job.do_all()
+            
+            # Agents that catch their own exceptions may have swallowed a timeout or a cancellation, but the job's context
+            # remembers a stage that ran out of time
+            check_current_job()
+        
+        except TimeoutError as e:
+            
+            du.print_stack_trace( e, explanation="do_all() timed out", caller="RunningFifoQueue._handle_base_agent()" )
+            
+            # Unless the watchdog's already counted it and filed it under dead
+            if id_hash not in self.queue_dict: return running_job
+            self._count_timed_out()
+            code_response[ "output" ] = str( e )
+            return self._handle_error_case( code_response, running_job, truncated_question, id_hash )
         
         except Exception as e:
             
             du.print_stack_trace( e, explanation="do_all() failed", caller="RunningFifoQueue._handle_base_agent()" )
-            running_job = self._handle_error_case( code_response, running_job, truncated_question )
+            
+            # Already filed under dead, don't fall through and file it a second time below
+            return self._handle_error_case( code_response, running_job, truncated_question, id_hash )
         
         du.print_banner( f"Job [{running_job.last_question_asked}] complete...", prepend_nl=True, end="\n" )
         
@@ -138,7 +401,8 @@ class RunningFifoQueue( FifoQueue ):
                 # The receptionist is an exception, there is no code executed to generate a RAW answer, just a conversational one
                 running_job.answer = "no code executed by receptionist"
             
-            self.pop()
+            # Given up on by the watchdog while we were finishing up
+            if self.pop_by_id_hash( id_hash ) is None: return running_job
             self.socketio.emit( 'run_update', { 'value': self.size() } )
             if serialize_snapshot: self.jobs_done_queue.push( running_job )
             self.socketio.emit( 'done_update', { 'value': self.jobs_done_queue.size() } )
@@ -148,11 +412,11 @@ class RunningFifoQueue( FifoQueue ):
             
         else:
             
-            running_job = self._handle_error_case( code_response, running_job, truncated_question )
+            running_job = self._handle_error_case( code_response, running_job, truncated_question, id_hash )
         
         return running_job
     
-    def _handle_solution_snapshot( self, running_job, truncated_question, run_timer ):
+    def _handle_solution_snapshot( self, running_job, truncated_question, run_timer, id_hash ):
         
         msg = f"Executing SolutionSnapshot code for [{truncated_question}]..."
         du.print_banner( msg=msg, prepend_nl=True )
@@ -161,12 +425,14 @@ class RunningFifoQueue( FifoQueue ):
         timer.print( "Done!", use_millis=True )
         
         formatted_output = running_job.format_output()
+        check_current_job()
         print( formatted_output )
         url = self._get_audio_url( running_job.answer_conversational )
         print( f"Emitting DONE url [{url}]...", end="\n\n" )
         self.socketio.emit( 'audio_update', { 'audioURL': url } )
         
-        self.pop()
+        # Given up on by the watchdog while we were finishing up
+        if self.pop_by_id_hash( id_hash ) is None: return running_job
         self.jobs_done_queue.push( running_job )
         self.socketio.emit( 'run_update', { 'value': self.size() } )
         self.socketio.emit( 'done_update', { 'value': self.jobs_done_queue.size() } )
@@ -176,9 +442,9 @@ class RunningFifoQueue( FifoQueue ):
         running_job.update_runtime_stats( run_timer )
         du.print_banner( f"Job [{running_job.question}] complete!", prepend_nl=True, end="\n" )
         
-        print( f"Writing job [{running_job.question}] to file..." )
-        running_job.write_current_state_to_file()
-        print( f"Writing job [{running_job.question}] to file... Done!" )
+        # Persisting the updated runtime stats happens in the background, we don't wait for the disk here
+        print( f"Queueing job [{running_job.question}] to be written to file..." )
+        self.snapshot_mgr.save_snapshot( running_job )
         
         du.print_banner( "running_job.runtime_stats", prepend_nl=True )
         pprint.pprint( running_job.runtime_stats )
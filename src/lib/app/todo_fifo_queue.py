@@ -1,4 +1,7 @@
+import heapq
+import itertools
 import random
+import time
 
 from flask import url_for
 
@@ -6,6 +9,8 @@ from lib.agents.date_and_time_agent            import DateAndTimeAgent
 from lib.agents.receptionist_agent import ReceptionistAgent
 from lib.agents.weather_agent import WeatherAgent
 from lib.app.fifo_queue                        import FifoQueue
+from lib.app.job_scheduler                     import FifoJobScheduler, get_job_scheduler_by_name
+from lib.app.metrics_registry                  import get_metrics_registry, get_stage_seconds_histogram
 from lib.agents.todo_list_agent                import TodoListAgent
 from lib.agents.calendaring_agent              import CalendaringAgent
 
@@ -35,6 +40,35 @@ class TodoFifoQueue( FifoQueue ):
         self.auto_debug   = False if config_mgr is None else config_mgr.get( "auto_debug",  default=False, return_type="boolean" )
         self.inject_bugs  = False if config_mgr is None else config_mgr.get( "inject_bugs", default=False, return_type="boolean" )
         
+        # Which job runs next: fifo, sjf (shortest expected job first) or aging (sjf that doesn't starve long jobs)
+        scheduler_name    = "fifo" if config_mgr is None else config_mgr.get( "jobs_todo_scheduler", default="fifo" )
+        scheduler_kwargs  = { } if config_mgr is None else { "default_run_ms": config_mgr.get( "jobs_todo_scheduler_default_run_ms", default=10000, return_type="int" ) }
+        if scheduler_name == "aging" and config_mgr is not None:
+            scheduler_kwargs[ "aging_weight" ] = config_mgr.get( "jobs_todo_scheduler_aging_weight", default=1.0, return_type="float" )
+        self.scheduler    = get_job_scheduler_by_name( scheduler_name, **scheduler_kwargs )
+        
+        # Jobs are run this many at a time, which divides the expected wait
+        self.concurrency  = 1 if config_mgr is None else config_mgr.get( "jobs_run_max_concurrent", default=4, return_type="int" )
+        
+        # ( sort key, push order ) of every queued job, fixed when it's pushed, plus a heap of ( sort key, push order,
+        # id_hash ) for the policies that don't run jobs in push order. ¡OJO! Popped jobs are left in the heap and skipped
+        # when they surface, so an entry only counts if it's still the job's own
+        self._schedule_key_by_id_hash = { }
+        self._schedule_heap           = [ ]
+        self._push_order              = itertools.count()
+        self._is_fifo                 = isinstance( self.scheduler, FifoJobScheduler )
+        
+        # Single flight: a question that's asked again before the job for it has finished attaches to that job, rather
+        # than being routed, generated and run all over again. Keyed by the normalized question
+        self._single_flights_by_key     = { }
+        self._single_flight_key_by_hash = { }
+        self.coalesced_counter          = 0
+        
+        metrics                          = get_metrics_registry()
+        self._snapshot_lookups_counter   = metrics.counter( "gib_snapshot_lookups_total", "Questions looked up in the solution snapshots, by whether a similar one was found", label_names=( "result", ) )
+        self._coalesced_metric           = metrics.counter( "gib_jobs_coalesced_total", "Questions attached to an identical one already in flight, rather than run again" )
+        metrics.gauge( "gib_queue_depth", "Jobs in each queue", label_names=( "queue", ) ).set_function( self.size, queue="todo" )
+        
         # Set by set_llm() below
         self.cmd_llm_in_memory = None
         self.cmd_llm_tokenizer = None
@@ -53,6 +87,90 @@ class TodoFifoQueue( FifoQueue ):
             "let me think about that...", "let me think about it...", "let me check...", "checking..."
         ]
         
+    def _on_pushed( self, item, dropped ):
+        
+        schedule_key = ( self.scheduler.get_sort_key( item, time.monotonic() * 1000 ), next( self._push_order ) )
+        self._schedule_key_by_id_hash[ item.id_hash ] = schedule_key
+        if not self._is_fifo: heapq.heappush( self._schedule_heap, schedule_key + ( item.id_hash, ) )
+        if dropped is not None: self._on_popped( dropped )
+    
+    def _on_popped( self, item ):
+        
+        self._schedule_key_by_id_hash.pop( item.id_hash, None )
+        
+        # Popped jobs' entries sink out of the heap as it's popped, unless they're piling up faster than that
+        if len( self._schedule_heap ) > 2 * len( self._schedule_key_by_id_hash ) + 64:
+            self._schedule_heap = [ entry for entry in self._schedule_heap if self._is_scheduled( entry ) ]
+            heapq.heapify( self._schedule_heap )
+    
+    def _is_scheduled( self, entry ):
+        
+        return self._schedule_key_by_id_hash.get( entry[ 2 ] ) == entry[ :2 ]
+    
+    def pop_next( self, predicate=lambda job: True ):
+        """
+        Removes the job the scheduler wants to run next, among those that satisfy the predicate, e.g. have a free slot.
+        
+        :return: The job, or None if none of them do
+        """
+        # In push order, which is the order the queue's already in
+        if self._is_fifo: return self.pop_first( predicate )
+        
+        with self._lock:
+            item    = None
+            skipped = [ ]
+            while self._schedule_heap and item is None:
+                entry = heapq.heappop( self._schedule_heap )
+                if not self._is_scheduled( entry ): continue
+                job = self.queue_dict[ entry[ 2 ] ]
+                if predicate( job ):
+                    item = job
+                else:
+                    skipped.append( entry )
+            
+            # Jobs passed over, e.g. for want of a free slot, keep their place in line
+            for entry in skipped: heapq.heappush( self._schedule_heap, entry )
+            if item is not None: self._pop_locked( item.id_hash )
+        
+        self._call_pop_callbacks( item )
+        
+        return item
+    
+    def get_expected_wait_secs( self, job=None ):
+        """
+        How long until a job starts: the expected run times of the jobs the scheduler would run before it, spread over
+        the jobs that run concurrently. Time left on jobs already running isn't counted.
+        
+        :param job: A queued job, or one about to be pushed. None means a new job of unknown type, i.e. the whole queue
+        
+        :return: Expected wait in seconds
+        """
+        ahead = self._get_jobs_ahead( job )
+        
+        return sum( self.scheduler.get_expected_run_ms( queued_job ) for queued_job in ahead ) / 1000.0 / max( 1, self.concurrency )
+    
+    def get_jobs_ahead_count( self, job=None ):
+        """
+        How many jobs the scheduler would run before this one, which isn't the queue's size once jobs are prioritized.
+        
+        :param job: A queued job, or one about to be pushed. None means a new job of unknown type, i.e. the whole queue
+        """
+        return len( self._get_jobs_ahead( job ) )
+    
+    def _get_jobs_ahead( self, job ):
+        
+        # Only needs the jobs ahead of this one, not their order, so one pass over the queue w/o sorting it
+        with self._lock:
+            if job is None:
+                return list( self.queue_dict.values() )
+            elif job.id_hash in self._schedule_key_by_id_hash:
+                schedule_key = self._schedule_key_by_id_hash[ job.id_hash ]
+                return [ self.queue_dict[ id_hash ] for id_hash, key in self._schedule_key_by_id_hash.items() if key < schedule_key ]
+            else:
+                # Not pushed yet, so it's pushed now and it's last in line among equals
+                sort_key = self.scheduler.get_sort_key( job, time.monotonic() * 1000 )
+                return [ self.queue_dict[ id_hash ] for id_hash, key in self._schedule_key_by_id_hash.items() if key[ 0 ] <= sort_key ]
+    
     def set_llm( self, cmd_llm_in_memory, cmd_llm_tokenizer ):
         
         self.cmd_llm_in_memory = cmd_llm_in_memory
@@ -83,17 +201,97 @@ class TodoFifoQueue( FifoQueue ):
         return ' '.join( prefix_holder ), remaining_string
     
     
+    @staticmethod
+    def get_single_flight_key( question ):
+        
+        return " ".join( SolutionSnapshot.remove_non_alphabetics( question ).split() )
+    
+    def _join_single_flight( self, key ):
+        """
+        Attaches to the in flight job for the question, if there is one, otherwise starts a new flight w/ us as its leader.
+        
+        :return: The flight we attached to, or None if we're the leader and have to push the job ourselves
+        """
+        with self._lock:
+            flight = self._single_flights_by_key.get( key )
+            if flight is not None:
+                flight[ "attached" ] += 1
+                self.coalesced_counter += 1
+                self._coalesced_metric.inc()
+                return flight
+            
+            # The job isn't pushed, so has no id_hash, until routing's done, but identical questions attach from here on
+            self._single_flights_by_key[ key ] = { "id_hash": None, "attached": 0 }
+            
+            return None
+    
+    def _push_single_flight( self, job, key ):
+        
+        with self._lock:
+            self._single_flights_by_key[ key ][ "id_hash" ] = job.id_hash
+            self._single_flight_key_by_hash[ job.id_hash ]  = key
+        
+        # Outside the lock: the push callbacks include the journal, which waits for the push to hit the disk
+        self.push( job )
+    
+    def end_single_flight( self, job ):
+        """
+        Called once a job has finished, done or dead, so that the next time its question is asked it's run again.
+        """
+        with self._lock:
+            key = self._single_flight_key_by_hash.pop( job.id_hash, None )
+            if key is None: return
+            flight = self._single_flights_by_key.pop( key )
+        
+        if flight[ "attached" ] > 0: print( f"Job [{job.id_hash}] answered [{flight[ 'attached' ]}] coalesced request(s) for [{key}]" )
+    
+    def _abandon_single_flight( self, key ):
+        
+        with self._lock:
+            flight = self._single_flights_by_key.get( key )
+            if flight is not None and flight[ "id_hash" ] is None: del self._single_flights_by_key[ key ]
+    
+    def get_single_flight_stats( self ):
+        
+        with self._lock:
+            return { "coalesced": self.coalesced_counter, "in_flight_questions": len( self._single_flights_by_key ) }
+    
     def push_job( self, question ):
         
         self.push_counter += 1
         salutations, question = self.parse_salutations( question )
         
+        key    = self.get_single_flight_key( question )
+        flight = self._join_single_flight( key )
+        if flight is not None:
+            
+            # ¡OJO! The in flight job's answer, and its audio notification, are broadcast to every client when it's done,
+            # so there's nothing more to do for this request than let it know
+            msg = "Same question's already being worked on, hang tight"
+            print( f"push_job(): Coalesced [{question}] w/ in flight job [{flight[ 'id_hash' ]}], [{flight[ 'attached' ]}] request(s) attached" )
+            with self.app.app_context():
+                url = url_for( 'get_tts_audio' ) + "?tts_text=" + msg
+            self.socketio.emit( 'audio_update', { 'audioURL': url } )
+            
+            return msg
+        
+        try:
+            return self._push_job( salutations, question, key )
+        finally:
+            # Routing failed, or didn't come up w/ a job: let the next identical question have a go
+            self._abandon_single_flight( key )
+    
+    def _push_job( self, salutations, question, key ):
+        
         du.print_banner( f"push_job( '{( salutations + ' ' + question ).strip()}' )", prepend_nl=True )
         threshold = self.config_mgr.get( "snapshot_similiarity_threshold", default=90.0, return_type="float" )
         print( f"push_job(): Using snapshot similarity threshold of [{threshold}]" )
         
         # We're searching for similar snapshots without any salutations prepended to the question.
+        lookup_start      = time.perf_counter()
         similar_snapshots = self.snapshot_mgr.get_snapshots_by_question( question, threshold=threshold )
+        get_stage_seconds_histogram().observe( time.perf_counter() - lookup_start, stage="snapshot_lookup" )
+        self._snapshot_lookups_counter.inc( result="hit" if len( similar_snapshots ) > 0 else "miss" )
         print()
         
         # if we've got a similar snapshot then go ahead and push it onto the queue
@@ -124,16 +322,19 @@ class TodoFifoQueue( FifoQueue ):
             
             print()
             
-            if self.size() != 0:
-                suffix = "s" if self.size() > 1 else ""
+            # Jobs that jump the line, e.g. cheap snapshots, shouldn't be told about the ones they're jumping
+            jobs_ahead = self.get_jobs_ahead_count( job )
+            if jobs_ahead != 0:
+                suffix    = "s" if jobs_ahead > 1 else ""
+                wait_secs = int( round( self.get_expected_wait_secs( job ) ) )
                 with self.app.app_context():
-                    url = url_for( 'get_tts_audio' ) + f"?tts_text={self.size()} job{suffix} before this one"
+                    url = url_for( 'get_tts_audio' ) + f"?tts_text={jobs_ahead} job{suffix} before this one, about {wait_secs} seconds"
                 print( f"Emitting TODO url [{url}]..." )
                 self.socketio.emit( 'audio_update', { 'audioURL': url } )
             else:
                 print( "No jobs ahead of this one in the todo Q" )
             
-            self.push( job )
+            self._push_single_flight( job, key )
             self.socketio.emit( 'todo_update', { 'value': self.size() } )
             
             return f'Job added to queue. Queue size [{self.size()}]'
@@ -148,7 +349,9 @@ class TodoFifoQueue( FifoQueue ):
 
             # We're going to give the routing function maximum information, hence including the salutation with the question
             # ¡OJO! I know this is a tad adhoc-ish, but it's what we want... for the moment at least
+            routing_start = time.perf_counter()
             command, args = self._get_routing_command( salutation_plus_question )
+            get_stage_seconds_histogram().observe( time.perf_counter() - routing_start, stage="routing" )
             
             starting_a_new_job = "New {agent_type} job..."
             ding_for_new_job   = False
@@ -182,7 +385,7 @@ class TodoFifoQueue( FifoQueue ):
             if ding_for_new_job:
                 self.socketio.emit( 'notification_sound_update', { 'soundFile': '/static/gentle-gong.mp3' } )
             if agent is not None:
-                self.push( agent )
+                self._push_single_flight( agent, key )
             
             with self.app.app_context():
                 url = url_for( 'get_tts_audio' ) + "?tts_text=" + msg
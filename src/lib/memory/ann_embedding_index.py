@@ -0,0 +1,464 @@
+import json
+import os
+import time
+
+import numpy as np
+
+import lib.utils.util as du
+from lib.memory.embedding_matrix_index import EmbeddingMatrixIndex
+from lib.utils.util_stopwatch          import Stopwatch
+
+
+class IvfEmbeddingIndex( EmbeddingMatrixIndex ):
+    """
+    Inverted file (IVF) approximate nearest neighbor index.
+
+    Embeddings are clustered around nlist centroids, and a search only scores the rows that belong to the nprobe
+    clusters closest to the query. Raising nprobe trades latency for recall. Below exact_search_threshold rows, or
+    until the centroids have been trained, every search falls back to the exact matrix scan of the parent class.
+    """
+    def __init__( self, dimensions=1536, nprobe=8, exact_search_threshold=10000, kmeans_iterations=10, save_path=None, debug=False ):
+
+        super().__init__( dimensions=dimensions, debug=debug )
+
+        self.nprobe                 = nprobe
+        self.exact_search_threshold = exact_search_threshold
+        self.kmeans_iterations      = kmeans_iterations
+        self.save_path              = save_path
+
+        self._centroids             = None
+        self._trained_size          = 0
+        # Cluster id for each populated row of the matrix, kept in lock step with the parent's row swapping
+        self._list_ids              = np.zeros( self._matrix.shape[ 0 ], dtype=np.int32 )
+
+    def is_trained( self ):
+
+        return self._centroids is not None
+
+    def add( self, key, embedding ):
+
+        with self._lock:
+
+            super().add( key, embedding )
+
+            if key in self._row_by_key:
+                row = self._row_by_key[ key ]
+                if row >= len( self._list_ids ): self._list_ids = np.resize( self._list_ids, self._matrix.shape[ 0 ] )
+                if self.is_trained(): self._list_ids[ row ] = self._get_nearest_list( self._matrix[ row ] )
+
+    def remove( self, key ):
+
+        with self._lock:
+
+            if key not in self._row_by_key: return False
+
+            # Mirror the parent's move-the-last-row-into-the-hole bookkeeping
+            row      = self._row_by_key[ key ]
+            last_row = len( self._keys ) - 1
+            self._list_ids[ row ] = self._list_ids[ last_row ]
+
+            return super().remove( key )
+
+    def rebuild( self, embeddings_by_key ):
+
+        # Reuse previously persisted centroids if we've got them, otherwise train them now, if we're big enough
+        with self._lock:
+            super().rebuild( embeddings_by_key )
+            if not self.load(): self.train_if_needed()
+
+    def maintain( self ):
+
+        self.train_if_needed()
+
+    def train( self, nlist=None, seed=42 ):
+        """
+        Clusters the current embeddings using spherical k-means, then assigns every row to its nearest centroid.
+
+        ¡OJO! k-means runs on a copy of the matrix, outside the lock, so that searches and adds carry on meanwhile.
+        Rows added while we're training are assigned to the new centroids along w/ everything else when we're done.
+
+        :param nlist: Number of clusters. Defaults to 4 * sqrt( rows )
+
+        :return: None
+        """
+        with self._lock:
+            rows   = len( self._keys )
+            if rows == 0: return
+            matrix = self.get_matrix().copy()
+
+        if nlist is None: nlist = max( 1, int( 4 * np.sqrt( rows ) ) )
+        nlist = min( nlist, rows )
+
+        timer   = Stopwatch( msg=f"Training IVF index: [{rows}] rows, [{nlist}] lists...", silent=not self.debug )
+        rng     = np.random.default_rng( seed )
+
+        centroids = matrix[ rng.choice( rows, size=nlist, replace=False ) ].copy()
+        for _ in range( self.kmeans_iterations ):
+
+            assignments = np.argmax( matrix @ centroids.T, axis=1 )
+            for list_id in range( nlist ):
+                members = matrix[ assignments == list_id ]
+                # Empty clusters keep their previous centroid
+                if len( members ) > 0: centroids[ list_id ] = members.mean( axis=0 )
+            centroids /= np.maximum( np.linalg.norm( centroids, axis=1, keepdims=True ), 1e-12 )
+
+        with self._lock:
+            self._centroids    = centroids.astype( np.float32 )
+            self._trained_size = rows
+            self._reassign_all()
+        timer.print( "Done!", use_millis=True )
+
+    def train_if_needed( self ):
+        """
+        (Re)trains the centroids once we're above the exact search threshold and the index has doubled in size since
+        it was last trained. That takes seconds on a big index, so outside of startup call it via maintain(), from a
+        background thread.
+
+        :return: True if the index was trained, False otherwise
+        """
+        rows = len( self._keys )
+        if rows < self.exact_search_threshold: return False
+        if self.is_trained() and rows < 2 * self._trained_size: return False
+
+        self.train()
+        self.save()
+
+        return True
+
+    def get_top_k( self, embedding, threshold=0.0, k=-1, exclude_keys=None ):
+
+        with self._lock:
+
+            # Probing a few clusters can only ever find some of "everything above the threshold", so that's exact too
+            if len( self._keys ) < self.exact_search_threshold or not self.is_trained() or k <= 0:
+                return super().get_top_k( embedding, threshold=threshold, k=k, exclude_keys=exclude_keys )
+
+            query       = np.asarray( embedding, dtype=np.float32 )
+            nprobe      = min( self.nprobe, len( self._centroids ) )
+            probe_lists = np.argpartition( -( self._centroids @ query ), nprobe - 1 )[ :nprobe ]
+            rows        = np.flatnonzero( np.isin( self._list_ids[ :len( self._keys ) ], probe_lists ) )
+
+            if exclude_keys:
+                excluded = [ self._row_by_key[ key ] for key in exclude_keys if key in self._row_by_key ]
+                rows     = np.setdiff1d( rows, excluded, assume_unique=True )
+
+            scores     = self._matrix[ rows ] @ query * 100
+            candidates = np.flatnonzero( scores >= threshold )
+
+            if 0 < k < len( candidates ):
+                top        = np.argpartition( -scores[ candidates ], k - 1 )[ :k ]
+                candidates = candidates[ top ]
+
+            candidates = candidates[ np.argsort( -scores[ candidates ], kind="stable" ) ]
+
+            return [ ( float( scores[ i ] ), self._keys[ rows[ i ] ] ) for i in candidates ]
+
+    def save( self ):
+        """
+        Persists the trained centroids. Row assignments aren't saved, they're recalculated in one pass when loaded.
+        """
+        if self.save_path is None or not self.is_trained(): return
+
+        os.makedirs( os.path.dirname( self.save_path ), exist_ok=True )
+        np.savez( self.save_path, centroids=self._centroids, trained_size=self._trained_size, nprobe=self.nprobe )
+        if self.debug: print( f"Saved IVF index to [{self.save_path}]" )
+
+    def load( self ):
+        """
+        Loads previously trained centroids, if any, and assigns the current rows to them.
+
+        :return: True if centroids were loaded, False otherwise
+        """
+        if self.save_path is None or not os.path.isfile( self.save_path ): return False
+
+        saved = np.load( self.save_path )
+        if saved[ "centroids" ].shape[ 1 ] != self.dimensions:
+            print( f"WARNING: Ignoring IVF index [{self.save_path}], dimensions don't match [{self.dimensions}]" )
+            return False
+
+        with self._lock:
+            self._centroids    = saved[ "centroids" ]
+            self._trained_size = int( saved[ "trained_size" ] )
+            self._reassign_all()
+        if self.debug: print( f"Loaded IVF index w/ [{len( self._centroids )}] lists from [{self.save_path}]" )
+
+        return True
+
+    def _reassign_all( self ):
+
+        rows = len( self._keys )
+        self._list_ids = np.resize( self._list_ids, self._matrix.shape[ 0 ] )
+        if rows > 0: self._list_ids[ :rows ] = np.argmax( self.get_matrix() @ self._centroids.T, axis=1 )
+
+    def _get_nearest_list( self, embedding ):
+
+        return int( np.argmax( self._centroids @ embedding ) )
+
+
+class HnswEmbeddingIndex( EmbeddingMatrixIndex ):
+    """
+    Hierarchical navigable small world (HNSW) graph index, backed by the optional hnswlib package.
+
+    The parent class still keeps the exact matrix, which is used below exact_search_threshold rows, and for searches
+    that want every result above the threshold ( k=-1 ), which a graph search can't promise. Raising ef, the size of
+    the search time candidate list, trades latency for recall.
+
+    The graph is saved to disk by maintain(), and reloaded by rebuild() as long as it was built from the same keys.
+    """
+    def __init__( self, dimensions=1536, ef=64, ef_construction=200, m=16, exact_search_threshold=10000, save_path=None, debug=False ):
+
+        super().__init__( dimensions=dimensions, debug=debug )
+
+        import hnswlib
+
+        self._hnswlib               = hnswlib
+        self.ef                     = ef
+        self.ef_construction        = ef_construction
+        self.m                      = m
+        self.exact_search_threshold = exact_search_threshold
+        self.save_path              = save_path
+
+        self._graph                 = self._create_graph( self._matrix.shape[ 0 ] )
+
+        # Graph labels are stable integer ids, unlike matrix rows, which move around when a key is removed
+        self._label_by_key          = { }
+        self._key_by_label          = { }
+        self._next_label            = 0
+
+        # Whether the graph has changed since it was last saved
+        self._dirty                 = False
+
+    def _create_graph( self, max_elements ):
+
+        graph = self._hnswlib.Index( space="ip", dim=self.dimensions )
+        graph.init_index( max_elements=max( 1, max_elements ), ef_construction=self.ef_construction, M=self.m, allow_replace_deleted=True )
+        graph.set_ef( self.ef )
+
+        return graph
+
+    def add( self, key, embedding ):
+
+        with self._lock:
+
+            super().add( key, embedding )
+            if key not in self._row_by_key: return
+
+            if key in self._label_by_key:
+                label = self._label_by_key[ key ]
+            else:
+                label = self._next_label
+                self._next_label += 1
+                self._label_by_key[ key ]   = label
+                self._key_by_label[ label ] = key
+
+            if self._graph.get_current_count() >= self._graph.get_max_elements():
+                self._graph.resize_index( 2 * self._graph.get_max_elements() )
+
+            self._graph.add_items( np.asarray( [ embedding ], dtype=np.float32 ), [ label ], replace_deleted=True )
+            self._dirty = True
+
+    def remove( self, key ):
+
+        with self._lock:
+
+            if key in self._label_by_key:
+                label = self._label_by_key.pop( key )
+                del self._key_by_label[ label ]
+                self._graph.mark_deleted( label )
+                self._dirty = True
+
+            return super().remove( key )
+
+    def clear( self ):
+
+        with self._lock:
+            super().clear()
+            for label in list( self._key_by_label.keys() ): self._graph.mark_deleted( label )
+            self._label_by_key = { }
+            self._key_by_label = { }
+            self._dirty        = True
+
+    def rebuild( self, embeddings_by_key ):
+        """
+        Fills the exact matrix, then reloads the saved graph if it was built from exactly these keys. Otherwise the
+        graph is built from scratch, in one multithreaded batch rather than one item at a time, and saved.
+        """
+        with self._lock:
+
+            EmbeddingMatrixIndex.clear( self )
+            for key, embedding in embeddings_by_key: EmbeddingMatrixIndex.add( self, key, embedding )
+
+            if self.load(): return
+
+            timer = Stopwatch( msg=f"Building HNSW index: [{len( self._keys )}] rows...", silent=not self.debug )
+            self._graph        = self._create_graph( self._matrix.shape[ 0 ] )
+            self._label_by_key = { key: label for label, key in enumerate( self._keys ) }
+            self._key_by_label = { label: key for key, label in self._label_by_key.items() }
+            self._next_label   = len( self._keys )
+            if self._keys: self._graph.add_items( self.get_matrix(), list( range( len( self._keys ) ) ) )
+            timer.print( "Done!", use_millis=True )
+
+            self._dirty = True
+            self.save()
+
+    def maintain( self ):
+
+        if self._dirty: self.save()
+
+    def train_if_needed( self ):
+
+        # Graphs are built incrementally, there's nothing to train
+        return False
+
+    def get_top_k( self, embedding, threshold=0.0, k=-1, exclude_keys=None ):
+
+        with self._lock:
+
+            # A graph search only ever returns its ef nearest neighbors, so "everything above the threshold" is exact
+            if len( self._keys ) < self.exact_search_threshold or k <= 0:
+                return super().get_top_k( embedding, threshold=threshold, k=k, exclude_keys=exclude_keys )
+
+            exclude_keys = exclude_keys or set()
+            neighbors    = min( k + len( exclude_keys ), len( self._keys ) )
+
+            labels, distances = self._graph.knn_query( np.asarray( [ embedding ], dtype=np.float32 ), k=neighbors )
+
+            # hnswlib's inner product "distance" is 1 - dot product
+            results = [ ]
+            for label, distance in zip( labels[ 0 ], distances[ 0 ] ):
+                key   = self._key_by_label.get( int( label ) )
+                score = float( ( 1.0 - distance ) * 100 )
+                if key is None or key in exclude_keys or score < threshold: continue
+                results.append( ( score, key ) )
+
+            return results[ :k ]
+
+    def save( self ):
+
+        if self.save_path is None: return
+
+        # Graph and labels are each written to a temp file and renamed into place, labels last, so that a crash mid
+        # save can't pair a new graph w/ old labels
+        with self._lock:
+            os.makedirs( os.path.dirname( self.save_path ), exist_ok=True )
+            self._graph.save_index( self.save_path + ".tmp" )
+            os.replace( self.save_path + ".tmp", self.save_path )
+            with open( self.save_path + ".labels.json.tmp", "w" ) as f:
+                json.dump( { "label_by_key": self._label_by_key, "next_label": self._next_label }, f )
+            os.replace( self.save_path + ".labels.json.tmp", self.save_path + ".labels.json" )
+            self._dirty = False
+
+        if self.debug: print( f"Saved HNSW index w/ [{len( self._label_by_key )}] rows to [{self.save_path}]" )
+
+    def load( self ):
+        """
+        Loads the saved graph, but only if it was built from exactly the keys that we've got right now.
+
+        :return: True if the graph was loaded, False otherwise
+        """
+        labels_path = None if self.save_path is None else self.save_path + ".labels.json"
+        if labels_path is None or not os.path.isfile( self.save_path ) or not os.path.isfile( labels_path ): return False
+
+        with open( labels_path, "r" ) as f:
+            labels = json.load( f )
+        if set( labels[ "label_by_key" ].keys() ) != set( self._keys ): return False
+
+        try:
+            graph = self._hnswlib.Index( space="ip", dim=self.dimensions )
+            graph.load_index( self.save_path, max_elements=max( self._matrix.shape[ 0 ], len( self._keys ), 1 ), allow_replace_deleted=True )
+            graph.set_ef( self.ef )
+        except Exception as e:
+            du.print_stack_trace( e, explanation=f"Loading HNSW index [{self.save_path}] failed, rebuilding it", caller="HnswEmbeddingIndex.load()" )
+            return False
+
+        with self._lock:
+            self._graph        = graph
+            self._label_by_key = labels[ "label_by_key" ]
+            self._key_by_label = { label: key for key, label in self._label_by_key.items() }
+            self._next_label   = labels[ "next_label" ]
+            self._dirty        = False
+        if self.debug: print( f"Loaded HNSW index w/ [{len( self._label_by_key )}] rows from [{self.save_path}]" )
+
+        return True
+
+
+def get_embedding_index( backend="exact", dimensions=1536, save_path=None, nprobe=8, ef=64, exact_search_threshold=10000, debug=False ):
+    """
+    Factory for the similarity index backends: "exact", "ivf" or "hnsw"
+
+    :param save_path: Where the index is persisted, without an extension. Ignored by the exact backend
+
+    :return: An EmbeddingMatrixIndex, or one of its approximate subclasses
+    """
+    if backend == "ivf":
+        save_path = None if save_path is None else save_path + ".ivf.npz"
+        return IvfEmbeddingIndex( dimensions=dimensions, nprobe=nprobe, exact_search_threshold=exact_search_threshold, save_path=save_path, debug=debug )
+
+    elif backend == "hnsw":
+        save_path = None if save_path is None else save_path + ".hnsw.bin"
+        try:
+            return HnswEmbeddingIndex( dimensions=dimensions, ef=ef, exact_search_threshold=exact_search_threshold, save_path=save_path, debug=debug )
+        except ImportError:
+            print( "WARNING: hnswlib isn't installed, falling back to the exact similarity index" )
+            return EmbeddingMatrixIndex( dimensions=dimensions, debug=debug )
+
+    elif backend != "exact":
+        print( f"WARNING: Unknown similarity index backend [{backend}], falling back to the exact similarity index" )
+
+    return EmbeddingMatrixIndex( dimensions=dimensions, debug=debug )
+
+
+def get_recall_report( approximate_idx, queries, thresholds=( 85.0, 90.0, 92.5, 95.0 ), k=7 ):
+    """
+    Compares an approximate index against an exact scan of the same rows.
+
+    For each threshold it reports the share of exact results above that threshold that the approximate index also
+    found ( recall@k ), plus the mean search latency of both.
+
+    :param approximate_idx: IvfEmbeddingIndex or HnswEmbeddingIndex
+
+    :param queries: List of query embeddings
+
+    :return: List of dictionaries, one per threshold
+    """
+    exact_idx = EmbeddingMatrixIndex( dimensions=approximate_idx.dimensions, initial_capacity=max( 1, len( approximate_idx ) ) )
+    exact_idx._matrix[ :len( approximate_idx ) ] = approximate_idx.get_matrix()
+    exact_idx._keys       = list( approximate_idx.get_keys() )
+    exact_idx._row_by_key = { key: row for row, key in enumerate( exact_idx._keys ) }
+
+    report = [ ]
+    for threshold in thresholds:
+
+        found = expected = 0
+        exact_ms = approximate_ms = 0
+        for query in queries:
+
+            # ¡OJO! Stopwatch only has millisecond resolution, which is too coarse for a single search
+            start_time      = time.perf_counter()
+            exact           = exact_idx.get_top_k( query, threshold=threshold, k=k )
+            exact_ms       += ( time.perf_counter() - start_time ) * 1000
+
+            start_time      = time.perf_counter()
+            approximate     = approximate_idx.get_top_k( query, threshold=threshold, k=k )
+            approximate_ms += ( time.perf_counter() - start_time ) * 1000
+
+            expected += len( exact )
+            found    += len( set( key for _, key in exact ) & set( key for _, key in approximate ) )
+
+        report.append( {
+            "threshold"        : threshold,
+            "recall"           : 1.0 if expected == 0 else found / expected,
+            "exact_results"    : expected,
+            "mean_exact_ms"    : exact_ms / max( 1, len( queries ) ),
+            "mean_approx_ms"   : approximate_ms / max( 1, len( queries ) ),
+        } )
+
+    return report
+
+
+def print_recall_report( report ):
+
+    du.print_banner( "Approximate vs. exact snapshot similarity search", prepend_nl=True )
+    for row in report:
+        print( f"Threshold [{row[ 'threshold' ]:5.1f}] recall [{row[ 'recall' ]:.3f}] over [{row[ 'exact_results' ]}] exact results, mean ms exact [{row[ 'mean_exact_ms' ]:.2f}] vs approximate [{row[ 'mean_approx_ms' ]:.2f}]" )
+    print()
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import lib.utils.util as du
+
+
+class EmbeddingCache:
+    """
+    Content addressed embedding cache, shared by every caller that needs an embedding.
+
+    Entries are keyed by a hash of ( model, text ) and live in two tiers: an in-memory LRU dictionary and a persistent
+    SQLite table on disk. Embeddings are stored as float64 bytes, so a cached embedding is bit for bit identical to
+    the one that the API returned in the first place.
+    """
+    def __init__( self, db_path=None, max_memory_entries=10000, debug=False ):
+
+        self.debug              = debug
+        self.max_memory_entries = max_memory_entries
+        self.db_path            = db_path
+
+        self._lock              = threading.Lock()
+        self._memory            = OrderedDict()
+        self._db                = None
+
+        self.memory_hits        = 0
+        self.disk_hits          = 0
+        self.misses             = 0
+
+        if db_path is not None:
+            os.makedirs( os.path.dirname( db_path ), exist_ok=True )
+            self._db = sqlite3.connect( db_path, check_same_thread=False )
+            self._db.execute( "CREATE TABLE IF NOT EXISTS embeddings ( key TEXT PRIMARY KEY, model TEXT, embedding BLOB )" )
+            self._db.commit()
+
+    @staticmethod
+    def get_key( model, text ):
+
+        return hashlib.sha256( f"{model}\x00{text}".encode() ).hexdigest()
+
+    def get( self, model, text ):
+        """
+        :return: The cached embedding as a list of floats, or None if it isn't cached in either tier
+        """
+        key = EmbeddingCache.get_key( model, text )
+
+        with self._lock:
+
+            if key in self._memory:
+                self._memory.move_to_end( key )
+                self.memory_hits += 1
+                return self._memory[ key ]
+
+            if self._db is not None:
+                row = self._db.execute( "SELECT embedding FROM embeddings WHERE key = ?", ( key, ) ).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer( row[ 0 ], dtype=np.float64 ).tolist()
+                    self._put_in_memory( key, embedding )
+                    self.disk_hits += 1
+                    return embedding
+
+            self.misses += 1
+            return None
+
+    def put( self, model, text, embedding ):
+
+        key = EmbeddingCache.get_key( model, text )
+        embedding = list( embedding )
+
+        with self._lock:
+            self._put_in_memory( key, embedding )
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings ( key, model, embedding ) VALUES ( ?, ?, ? )",
+                    ( key, model, np.asarray( embedding, dtype=np.float64 ).tobytes() )
+                )
+                self._db.commit()
+
+    def get_or_generate( self, model, text, generate ):
+        """
+        Returns the cached embedding for this model and text, calling generate( text ) and caching the result on a miss.
+        """
+        embedding = self.get( model, text )
+        if embedding is None:
+            embedding = generate( text )
+            self.put( model, text, embedding )
+
+        return embedding
+
+    def get_stats( self ):
+
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits"   : self.memory_hits,
+                "disk_hits"     : self.disk_hits,
+                "misses"        : self.misses,
+                "hit_rate"      : 0.0 if lookups == 0 else ( self.memory_hits + self.disk_hits ) / lookups,
+                "memory_entries": len( self._memory ),
+            }
+
+    def _put_in_memory( self, key, embedding ):
+
+        self._memory[ key ] = embedding
+        self._memory.move_to_end( key )
+        while len( self._memory ) > self.max_memory_entries:
+            self._memory.popitem( last=False )
+
+
+_embedding_cache      = None
+_embedding_cache_lock = threading.Lock()
+
+def get_embedding_cache():
+    """
+    Returns the process wide embedding cache, creating it the first time it's asked for.
+    """
+    global _embedding_cache
+
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache( db_path=du.get_project_root() + "/src/conf/long-term-memory/embedding-cache.sqlite" )
+
+    return _embedding_cache
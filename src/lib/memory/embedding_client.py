@@ -0,0 +1,243 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from lib.memory.embedding_cache    import get_embedding_cache
+from lib.memory.embedding_provider import get_embedding_provider
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket: holds up to capacity tokens, refilled continuously at rate_per_second.
+
+    ¡OJO! Not thread safe. It's only ever touched from the embedding client's event loop thread.
+    """
+    def __init__( self, rate_per_second, capacity ):
+
+        self.rate_per_second = rate_per_second
+        self.capacity        = capacity
+
+        self._tokens         = capacity
+        self._last_refill    = time.monotonic()
+
+    def _refill( self ):
+
+        now               = time.monotonic()
+        self._tokens      = min( self.capacity, self._tokens + ( now - self._last_refill ) * self.rate_per_second )
+        self._last_refill = now
+
+    async def acquire( self, tokens=1 ):
+        """
+        Waits until the requested number of tokens is available, then takes them.
+        """
+        # A single request bigger than the bucket would otherwise wait forever
+        tokens = min( tokens, self.capacity )
+
+        while True:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return
+            await asyncio.sleep( ( tokens - self._tokens ) / self.rate_per_second )
+
+
+class EmbeddingClient:
+    """
+    Micro-batching embedding client.
+
+    Requests that arrive within batch_window_ms of each other, from any thread, are gathered into a single call to the
+    provider's embed_batch(). Batches are rate limited with token buckets, one for requests and one for (estimated)
+    tokens per minute, and failed batches are retried with exponential backoff and full jitter.
+
+    The batching runs on an asyncio event loop in a background thread. Async callers can await embed_async(), while
+    synchronous callers use the thin blocking wrappers embed() and embed_batch(), so existing code doesn't need rewriting.
+    """
+    def __init__( self, provider=None, cache=None, batch_window_ms=10, max_batch_size=64, requests_per_minute=None,
+                  tokens_per_minute=None, max_retries=5, base_delay_secs=0.5, max_delay_secs=20.0, debug=False ):
+
+        self.debug              = debug
+        self.provider           = provider if provider is not None else get_embedding_provider()
+        self.cache              = cache if cache is not None else get_embedding_cache()
+        self.batch_window_secs  = batch_window_ms / 1000.0
+        self.max_batch_size     = max_batch_size
+        self.max_retries        = max_retries
+        self.base_delay_secs    = base_delay_secs
+        self.max_delay_secs     = max_delay_secs
+
+        # Fall back to the provider's published limits. None means unlimited, e.g. for local providers
+        requests_per_minute     = requests_per_minute if requests_per_minute is not None else self.provider.requests_per_minute
+        tokens_per_minute       = tokens_per_minute if tokens_per_minute is not None else self.provider.tokens_per_minute
+        self._request_bucket    = None if not requests_per_minute else TokenBucket( requests_per_minute / 60.0, max( 1, requests_per_minute // 60 ) )
+        self._token_bucket      = None if not tokens_per_minute else TokenBucket( tokens_per_minute / 60.0, max( 1, tokens_per_minute // 60 ) )
+
+        self.texts_requested    = 0
+        self.batches_sent       = 0
+        self.texts_sent         = 0
+        self.retries            = 0
+        self.failures           = 0
+
+        # Requests waiting on each text that's been batched but hasn't come back yet. Only touched from the loop thread
+        self._futures_by_text   = { }
+
+        self._loop   = asyncio.new_event_loop()
+        self._queue  = None
+        self._ready  = threading.Event()
+        self._thread = threading.Thread( target=self._run_event_loop, name="EmbeddingClient", daemon=True )
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_event_loop( self ):
+
+        asyncio.set_event_loop( self._loop )
+        self._queue = asyncio.Queue()
+        self._loop.create_task( self._enter_batch_loop() )
+        self._ready.set()
+        self._loop.run_forever()
+
+    def submit( self, text ):
+        """
+        Queues a text to be embedded in the next batch. Cache hits are answered right away, without a trip to the loop.
+
+        :return: A concurrent.futures.Future that resolves to the embedding
+        """
+        future    = Future()
+        namespace = self.provider.get_namespace()
+
+        embedding = self.cache.get( namespace, text )
+        if embedding is not None:
+            future.set_result( embedding )
+            return future
+
+        self._loop.call_soon_threadsafe( self._queue.put_nowait, ( text, future ) )
+
+        return future
+
+    def embed( self, text ):
+        """
+        Blocking wrapper: waits for this text's batch to come back.
+        """
+        return self.submit( text ).result()
+
+    def embed_batch( self, texts ):
+        """
+        Blocking wrapper: submits every text before waiting on any of them, so they all land in the same batch(es).
+        """
+        futures = [ self.submit( text ) for text in texts ]
+
+        return [ future.result() for future in futures ]
+
+    async def embed_async( self, text ):
+
+        return await asyncio.wrap_future( self.submit( text ) )
+
+    def get_stats( self ):
+
+        return {
+            "namespace"      : self.provider.get_namespace(),
+            "texts_requested": self.texts_requested,
+            "batches_sent"   : self.batches_sent,
+            "texts_sent"     : self.texts_sent,
+            "mean_batch_size": 0.0 if self.batches_sent == 0 else self.texts_sent / self.batches_sent,
+            "retries"        : self.retries,
+            "failures"       : self.failures,
+        }
+
+    async def _enter_batch_loop( self ):
+
+        while True:
+
+            # Block until there's something to do, then keep gathering until the window closes or the batch is full
+            texts    = [ ]
+            deadline = None
+            while len( texts ) < self.max_batch_size:
+                try:
+                    if deadline is None:
+                        text, future = await self._queue.get()
+                        deadline     = self._loop.time() + self.batch_window_secs
+                    else:
+                        timeout = deadline - self._loop.time()
+                        if timeout <= 0: break
+                        text, future = await asyncio.wait_for( self._queue.get(), timeout )
+                except asyncio.TimeoutError:
+                    break
+
+                # The same text can be requested again, by another thread, before its first request has come back.
+                # Rather than embed it twice, the second request waits on the first
+                self.texts_requested += 1
+                if text in self._futures_by_text:
+                    self._futures_by_text[ text ].append( future )
+                else:
+                    self._futures_by_text[ text ] = [ future ]
+                    texts.append( text )
+
+            # Don't wait for this batch before gathering the next one: the rate limiters decide how many are in flight
+            if texts: self._loop.create_task( self._send_batch( texts ) )
+
+    async def _send_batch( self, texts ):
+
+        namespace = self.provider.get_namespace()
+
+        for attempt in range( self.max_retries + 1 ):
+
+            if self._request_bucket is not None: await self._request_bucket.acquire( 1 )
+            if self._token_bucket   is not None: await self._token_bucket.acquire( sum( EmbeddingClient.estimate_tokens( text ) for text in texts ) )
+
+            try:
+                embeddings = await self._loop.run_in_executor( None, self.provider.embed_batch, texts )
+                break
+
+            except Exception as e:
+                if attempt == self.max_retries or not self.provider.is_retryable( e ):
+                    self.failures += 1
+                    for text in texts:
+                        for future in self._futures_by_text.pop( text ):
+                            if not future.done(): future.set_exception( e )
+                    return
+
+                # Exponential backoff with full jitter, so that a burst of failed batches doesn't retry in lockstep
+                delay = random.uniform( 0, min( self.max_delay_secs, self.base_delay_secs * 2 ** attempt ) )
+                self.retries += 1
+                if self.debug: print( f"Embedding batch of [{len( texts )}] failed w/ [{e}], retrying in [{delay:.2f}] secs..." )
+                await asyncio.sleep( delay )
+
+        self.batches_sent += 1
+        self.texts_sent   += len( texts )
+        if self.debug: print( f"Embedded batch of [{len( texts )}] texts" )
+
+        for text, embedding in zip( texts, embeddings ):
+            self.cache.put( namespace, text, embedding )
+            for future in self._futures_by_text.pop( text ):
+                if not future.done(): future.set_result( embedding )
+
+    @staticmethod
+    def estimate_tokens( text ):
+
+        # Rule of thumb for English text and BPE tokenizers: ~4 characters per token
+        return len( text ) // 4 + 1
+
+
+_embedding_clients       = { }
+_embedding_client_kwargs = { }
+_embedding_client_lock   = threading.Lock()
+
+def configure_embedding_client( **kwargs ):
+    """
+    Sets the constructor arguments, e.g. batch_window_ms or requests_per_minute, used for clients created from here on.
+    """
+    with _embedding_client_lock:
+        _embedding_client_kwargs.update( kwargs )
+
+def get_embedding_client():
+    """
+    Returns the process wide embedding client for the current embedding provider, creating it the first time it's asked for.
+    """
+    provider = get_embedding_provider()
+
+    with _embedding_client_lock:
+        namespace = provider.get_namespace()
+        if namespace not in _embedding_clients:
+            _embedding_clients[ namespace ] = EmbeddingClient( provider=provider, **_embedding_client_kwargs )
+
+        return _embedding_clients[ namespace ]
@@ -0,0 +1,175 @@
+import threading
+
+import numpy as np
+
+
+class EmbeddingMatrixIndex:
+    """
+    Keeps a contiguous float32 matrix of embeddings, one row per key, so that similarity searches can be run as a single
+    matrix-vector product instead of a python loop over every snapshot.
+
+    Rows are added by appending to a preallocated buffer that doubles in size when it fills up, and removed by swapping
+    the last row into the hole left behind, so both add() and remove() are O(1) amortized.
+
+    Jobs run concurrently, so every operation that reads or moves rows holds the index's (reentrant) lock.
+    """
+    def __init__( self, dimensions=1536, initial_capacity=1024, debug=False ):
+
+        self.debug       = debug
+        self.dimensions  = dimensions
+
+        self._matrix     = np.zeros( ( initial_capacity, dimensions ), dtype=np.float32 )
+        self._keys       = [ ]
+        self._row_by_key = { }
+        self._lock       = threading.RLock()
+
+    def __len__( self ):
+
+        return len( self._keys )
+
+    def __contains__( self, key ):
+
+        return key in self._row_by_key
+
+    def get_matrix( self ):
+        """
+        Returns a view of the populated rows of the embedding matrix. ¡OJO! This is a view, not a copy.
+        """
+        return self._matrix[ :len( self._keys ) ]
+
+    def get_keys( self ):
+
+        return self._keys
+
+    def add( self, key, embedding ):
+        """
+        Adds or replaces the embedding for the given key.
+
+        :param key: Hashable key, e.g. the snapshot's question
+
+        :param embedding: List or array of floats of length self.dimensions
+
+        :return: None
+        """
+        # Empty embeddings can't be compared to anything, so they don't get a row
+        if embedding is None or len( embedding ) == 0:
+            self.remove( key )
+            return
+
+        with self._lock:
+
+            if key in self._row_by_key:
+                self._matrix[ self._row_by_key[ key ] ] = embedding
+                return
+
+            row = len( self._keys )
+            if row == self._matrix.shape[ 0 ]: self._grow()
+
+            self._matrix[ row ]      = embedding
+            self._row_by_key[ key ]  = row
+            self._keys.append( key )
+
+    def remove( self, key ):
+        """
+        Removes the row for the given key, if present, by moving the last row into its place.
+
+        :return: True if a row was removed, False otherwise
+        """
+        with self._lock:
+
+            if key not in self._row_by_key: return False
+
+            row      = self._row_by_key.pop( key )
+            last_row = len( self._keys ) - 1
+
+            if row != last_row:
+                last_key                     = self._keys[ last_row ]
+                self._matrix[ row ]          = self._matrix[ last_row ]
+                self._keys[ row ]            = last_key
+                self._row_by_key[ last_key ] = row
+
+            self._keys.pop()
+
+            return True
+
+    def clear( self ):
+
+        with self._lock:
+            self._keys       = [ ]
+            self._row_by_key = { }
+
+    def rebuild( self, embeddings_by_key ):
+        """
+        Replaces the contents of the index, e.g. when snapshots are (re)loaded. Approximate subclasses override this to
+        reuse what they've persisted, rather than rebuilding from scratch.
+
+        :param embeddings_by_key: Iterable of ( key, embedding ) tuples
+
+        :return: None
+        """
+        with self._lock:
+            self.clear()
+            for key, embedding in embeddings_by_key: self.add( key, embedding )
+
+    def maintain( self ):
+        """
+        Housekeeping that's too slow to run on the caller's thread after every add(), e.g. retraining or persisting an
+        approximate index. Meant to be called from a background thread. The exact index doesn't need any.
+
+        :return: None
+        """
+        pass
+
+    def get_scores( self, embedding ):
+        """
+        Scores every row against the given embedding, using the same scale as SolutionSnapshot: dot product * 100
+
+        :return: Array of float32 scores, one per key, in the same order as get_keys()
+        """
+        query = np.asarray( embedding, dtype=np.float32 )
+
+        return self.get_matrix() @ query * 100
+
+    def get_top_k( self, embedding, threshold=0.0, k=-1, exclude_keys=None ):
+        """
+        Finds the keys whose embeddings are most similar to the one provided.
+
+        :param embedding: Query embedding
+
+        :param threshold: Minimum score, on a 0-100 scale, for a key to be included
+
+        :param k: Maximum number of results to return. -1 returns everything that clears the threshold
+
+        :param exclude_keys: Optional set of keys to be skipped
+
+        :return: List of ( score, key ) tuples, sorted by score in descending order
+        """
+        with self._lock:
+
+            if len( self._keys ) == 0: return [ ]
+
+            scores = self.get_scores( embedding )
+
+            if exclude_keys:
+                for key in exclude_keys:
+                    if key in self._row_by_key: scores[ self._row_by_key[ key ] ] = -np.inf
+
+            candidates = np.flatnonzero( scores >= threshold )
+
+            # Only pay for a partial sort when we're asked for fewer rows than we've got candidates
+            if 0 < k < len( candidates ):
+                top        = np.argpartition( -scores[ candidates ], k - 1 )[ :k ]
+                candidates = candidates[ top ]
+
+            # Stable sort so that ties keep their insertion order, just like list.sort() does
+            candidates = candidates[ np.argsort( -scores[ candidates ], kind="stable" ) ]
+
+            return [ ( float( scores[ row ] ), self._keys[ row ] ) for row in candidates ]
+
+    def _grow( self ):
+
+        new_matrix = np.zeros( ( max( 1, self._matrix.shape[ 0 ] * 2 ), self.dimensions ), dtype=np.float32 )
+        new_matrix[ :len( self._keys ) ] = self.get_matrix()
+        self._matrix = new_matrix
+
+        if self.debug: print( f"EmbeddingMatrixIndex grown to [{self._matrix.shape[ 0 ]}] rows" )
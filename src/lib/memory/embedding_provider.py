@@ -0,0 +1,232 @@
+import hashlib
+import threading
+
+import numpy as np
+
+import lib.utils.util as du
+import lib.utils.util_stopwatch as sw
+
+
+class EmbeddingProvider:
+    """
+    Base class for the things that turn text into embeddings.
+
+    Each provider has its own namespace, e.g. "openai/text-embedding-ada-002", because vectors from different models
+    can't be compared to each other. The namespace keys the embedding cache and picks the tables the vectors live in.
+    """
+    name                = None
+
+    # Published rate limits, enforced by the embedding client. None means unlimited
+    requests_per_minute = None
+    tokens_per_minute   = None
+
+    # The provider whose vectors the tables were originally built with. Its tables keep their original names
+    DEFAULT_NAMESPACE = "openai/text-embedding-ada-002"
+
+    def __init__( self, model, dimensions, debug=False ):
+
+        self.debug      = debug
+        self.model      = model
+        self.dimensions = dimensions
+
+    def get_namespace( self ):
+
+        return f"{self.name}/{self.model}"
+
+    @staticmethod
+    def get_namespace_slug( namespace ):
+        """
+        Turns a namespace into something that's safe to use in table and file names, e.g. "local/all-MiniLM-L6-v2" -> "local_all_minilm_l6_v2"
+        """
+        return "".join( char if char.isalnum() else "_" for char in namespace.lower() )
+
+    def get_table_name( self, base_name ):
+        """
+        Maps a table name onto this provider's namespace, e.g. "question_embeddings_tbl" -> "question_embeddings_tbl_local_all_minilm_l6_v2"
+        """
+        if self.get_namespace() == EmbeddingProvider.DEFAULT_NAMESPACE: return base_name
+
+        return f"{base_name}_{EmbeddingProvider.get_namespace_slug( self.get_namespace() )}"
+
+    def embed( self, text ):
+        """
+        :return: The embedding for the given text, as a list of floats of length self.dimensions
+        """
+        raise NotImplementedError( f"{type( self ).__name__}.embed()" )
+
+    def embed_batch( self, texts ):
+
+        return [ self.embed( text ) for text in texts ]
+
+    def is_retryable( self, exception ):
+        """
+        :return: True if a failed call is worth retrying, e.g. because we were rate limited or the network hiccupped
+        """
+        return False
+
+    def __str__( self ):
+
+        return f"{type( self ).__name__}( namespace=[{self.get_namespace()}], dimensions=[{self.dimensions}] )"
+
+
+class OpenAiEmbeddingProvider( EmbeddingProvider ):
+    """
+    Remote embeddings via the OpenAI API. This is the original, and default, provider.
+    """
+    name                = "openai"
+
+    requests_per_minute = 3000
+    tokens_per_minute   = 1000000
+
+    def __init__( self, model="text-embedding-ada-002", dimensions=1536, debug=False ):
+
+        super().__init__( model, dimensions, debug=debug )
+
+    def embed( self, text ):
+
+        return self.embed_batch( [ text ] )[ 0 ]
+
+    def embed_batch( self, texts ):
+
+        import openai
+
+        timer = sw.Stopwatch( msg=f"Generating [{len( texts )}] embedding(s) for [{du.truncate_string( texts[ 0 ] )}]...", silent=True )
+        openai.api_key = du.get_api_key( "openai" )
+
+        response = openai.embeddings.create(
+            input=list( texts ),
+            model=self.model
+        )
+        timer.print( "Done!", use_millis=True )
+
+        # The API doesn't promise to return embeddings in the order they were asked for, but it does tell us the order
+        return [ datum.embedding for datum in sorted( response.data, key=lambda datum: datum.index ) ]
+
+    def is_retryable( self, exception ):
+
+        import openai
+
+        return isinstance( exception, ( openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError ) )
+
+
+class OnnxEmbeddingProvider( EmbeddingProvider ):
+    """
+    Local CPU embeddings from a small sentence transformer, e.g. all-MiniLM-L6-v2, exported to ONNX. No network required.
+
+    The model directory is expected to hold a model.onnx and the HuggingFace tokenizer.json that goes with it. Both
+    onnxruntime and tokenizers are optional dependencies, imported only when this provider is used.
+    """
+    name = "local"
+
+    def __init__( self, model_path, model="all-MiniLM-L6-v2", dimensions=384, max_length=256, threads=None, debug=False ):
+
+        super().__init__( model, dimensions, debug=debug )
+
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.model_path = model_path
+        self.max_length = max_length
+
+        self._tokenizer = Tokenizer.from_file( f"{model_path}/tokenizer.json" )
+        self._tokenizer.enable_truncation( max_length=max_length )
+        self._tokenizer.enable_padding()
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None: options.intra_op_num_threads = threads
+        self._session     = onnxruntime.InferenceSession( f"{model_path}/model.onnx", sess_options=options, providers=[ "CPUExecutionProvider" ] )
+        self._input_names = { session_input.name for session_input in self._session.get_inputs() }
+
+        # The session can be shared between threads, but the tokenizer's padding and truncation state can't
+        self._lock = threading.Lock()
+
+    def embed( self, text ):
+
+        return self.embed_batch( [ text ] )[ 0 ]
+
+    def embed_batch( self, texts ):
+
+        timer = sw.Stopwatch( msg=f"Generating [{len( texts )}] local embeddings...", silent=True )
+
+        with self._lock:
+            encodings = self._tokenizer.encode_batch( list( texts ) )
+
+        input_ids      = np.array( [ encoding.ids for encoding in encodings ], dtype=np.int64 )
+        attention_mask = np.array( [ encoding.attention_mask for encoding in encodings ], dtype=np.int64 )
+        inputs         = { "input_ids": input_ids, "attention_mask": attention_mask }
+        if "token_type_ids" in self._input_names: inputs[ "token_type_ids" ] = np.zeros_like( input_ids )
+
+        token_embeddings = self._session.run( None, inputs )[ 0 ]
+
+        # Mean pooling over the real (unpadded) tokens, then unit length so that dot product == cosine similarity
+        mask       = attention_mask[ :, :, np.newaxis ].astype( np.float32 )
+        embeddings = ( token_embeddings * mask ).sum( axis=1 ) / np.clip( mask.sum( axis=1 ), 1e-9, None )
+        embeddings = embeddings / np.clip( np.linalg.norm( embeddings, axis=1, keepdims=True ), 1e-12, None )
+        timer.print( "Done!", use_millis=True )
+
+        return embeddings.astype( np.float64 ).tolist()
+
+
+class StubEmbeddingProvider( EmbeddingProvider ):
+    """
+    Deterministic, offline embeddings for tests: the same text always maps to the same unit vector, and different
+    texts map to (nearly) orthogonal ones. Useless for semantic similarity, useful for everything else.
+    """
+    name = "stub"
+
+    def __init__( self, model="sha256", dimensions=1536, debug=False ):
+
+        super().__init__( model, dimensions, debug=debug )
+
+    def embed( self, text ):
+
+        seed       = int.from_bytes( hashlib.sha256( text.encode() ).digest()[ :8 ], "little" )
+        embedding  = np.random.default_rng( seed ).standard_normal( self.dimensions )
+
+        return ( embedding / np.linalg.norm( embedding ) ).tolist()
+
+
+def get_embedding_provider_by_name( name, **kwargs ):
+    """
+    Factory for embedding providers.
+
+    :param name: One of "openai", "local" or "stub"
+
+    :param kwargs: Passed through to the provider's constructor, e.g. model_path for "local"
+
+    :return: An EmbeddingProvider
+    """
+    providers = { provider.name: provider for provider in [ OpenAiEmbeddingProvider, OnnxEmbeddingProvider, StubEmbeddingProvider ] }
+
+    if name not in providers:
+        raise ValueError( f"Unknown embedding provider [{name}], expected one of {list( providers.keys() )}" )
+
+    return providers[ name ]( **kwargs )
+
+
+_embedding_provider      = None
+_embedding_provider_lock = threading.Lock()
+
+def get_embedding_provider():
+    """
+    Returns the process wide embedding provider, which defaults to OpenAI until the app configures something else.
+    """
+    global _embedding_provider
+
+    with _embedding_provider_lock:
+        if _embedding_provider is None:
+            _embedding_provider = OpenAiEmbeddingProvider()
+
+    return _embedding_provider
+
+def set_embedding_provider( provider ):
+    """
+    Swaps the process wide embedding provider. ¡OJO! Call this before any tables or snapshot managers are created,
+    since they pick their tables and index dimensions from the provider that's in place when they're created.
+    """
+    global _embedding_provider
+
+    with _embedding_provider_lock:
+        _embedding_provider = provider
+
+    print( f"Embedding provider set to {provider}" )
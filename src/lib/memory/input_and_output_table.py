@@ -1,11 +1,21 @@
 import lib.utils.util               as du
 
-from lib.memory.question_embeddings_table import QuestionEmbeddingsTable
-from lib.memory.solution_snapshot         import SolutionSnapshot as ss
-from lib.app.configuration_manager        import ConfigurationManager
-from lib.utils.util_stopwatch             import Stopwatch
+from lib.memory.question_embeddings_table     import QuestionEmbeddingsTable
+from lib.memory.solution_snapshot             import SolutionSnapshot as ss
+from lib.memory.embedding_provider            import get_embedding_provider
+from lib.memory.embedding_client              import get_embedding_client
+from lib.memory.input_and_output_table_writer import InputAndOutputTableWriter
+from lib.memory.lancedb_registry              import get_lancedb_registry
+from lib.app.configuration_manager            import ConfigurationManager
+from lib.utils.util_stopwatch                 import Stopwatch
 
-import lancedb
+import base64
+import json
+import math
+import threading
+import time
+from collections        import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 # def singleton( cls ):
@@ -28,17 +38,80 @@ import lancedb
 # @singleton
 class InputAndOutputTable():
     
+    # What get_all_io() and friends return, i.e. everything but the embeddings
+    IO_COLUMNS                = [ "date", "time", "input_type", "input", "output_final" ]
+    
+    # Questions and answers, i.e. everything that was routed to an agent
+    QNR_WHERE_CLAUSE          = "input_type LIKE 'agent router go to %'"
+    
+    VECTOR_INDEX_COLUMNS      = [ "input_embedding", "output_final_embedding" ]
+    SCALAR_INDEX_COLUMNS      = [ "input_type", "date" ]
+    FTS_INDEX_COLUMNS         = [ "input", "output_final" ]
+    
+    # Reciprocal rank fusion constant: larger values flatten the difference between the top ranks and the rest
+    RRF_K                     = 60
+    
+    # Product quantization needs at least 256 rows to train its codebooks, below that brute force is plenty fast anyway
+    MIN_ROWS_FOR_VECTOR_INDEX = 256
+    
     def __init__( self, debug=False, verbose=False ):
         
         self.debug       = debug
         self.verbose     = verbose
         self._config_mgr = ConfigurationManager( env_var_name="GIB_CONFIG_MGR_CLI_ARGS" )
         
-        self.db = lancedb.connect( du.get_project_root() + self._config_mgr.get( "database_path_wo_root" ) )
-        self._input_and_output_tbl    = self.db.open_table( "input_and_output_tbl" )
-        self._question_embeddings_tbl = QuestionEmbeddingsTable( debug=self.debug, verbose=self.verbose )
+        # Indexes are rebuilt in the background once this many rows have been added since the last build
+        self.index_rebuild_rows  = self._config_mgr.get( "io_tbl_index_rebuild_rows",   default=1000, return_type="int" )
+        self.index_nprobes       = self._config_mgr.get( "io_tbl_index_nprobes",        default=20,   return_type="int" )
+        self.index_refine_factor = self._config_mgr.get( "io_tbl_index_refine_factor",  default=10,   return_type="int" )
+        
+        # One connection and one question embeddings table per process, shared w/ everybody else. ¡OJO! Get instances of
+        # this class from the registry too, rather than creating them, see get_lancedb_registry()
+        registry = get_lancedb_registry()
+        self.db  = registry.get_connection()
+        # Each embedding provider gets its own table, since vectors from different models can't be compared
+        self._provider                = get_embedding_provider()
+        self._table_name              = self._provider.get_table_name( "input_and_output_tbl" )
+        if self._table_name not in self.db.table_names():
+            print( f"Creating {self._table_name} for embedding provider [{self._provider.get_namespace()}]" )
+            self.init_tbl()
+        self._input_and_output_tbl    = registry.open_table( self._table_name )
+        self._question_embeddings_tbl = registry.get_question_embeddings_table()
 
-        print( f"Opened input_and_output_tbl w/ [{self._input_and_output_tbl.count_rows()}] rows" )
+        print( f"Opened {self._table_name} w/ [{self._input_and_output_tbl.count_rows()}] rows" )
+        
+        self._index_lock               = threading.Lock()
+        self._index_build_thread       = None
+        self._rows_at_last_index_build = None
+        self._last_index_build_date    = None
+        self._last_index_build_secs    = None
+        self._has_vector_index         = False
+        self._knn_latencies_ms         = deque( maxlen=1000 )
+        
+        # The lexical and vector halves of a hybrid search run side by side, Lance releases the GIL while it searches
+        self._search_executor          = ThreadPoolExecutor( max_workers=4, thread_name_prefix="InputAndOutputTableSearch" )
+        self._hybrid_searches          = 0
+        self._hybrid_lexical_only      = 0
+        
+        # Only build the indexes that are missing, or that have fallen too far behind, rebuilding the rest is maintenance's job
+        self.rebuild_indexes( only_stale=True )
+        
+        # Exact row counts per input_type and per day, rebuilt from the table now and kept up to date as rows are written
+        self._stats_lock                        = threading.Lock()
+        self._counts_by_input_type              = Counter()
+        self._counts_by_date_and_input_type     = defaultdict( Counter )
+        self._load_io_stats()
+        
+        # Rows are queued and written in batches by a background thread, which fills in missing embeddings as it goes
+        self._writer = InputAndOutputTableWriter(
+            self._input_and_output_tbl, self._question_embeddings_tbl,
+            max_batch_rows=self._config_mgr.get( "io_tbl_writer_max_batch_rows", default=64, return_type="int" ),
+            max_delay_secs=self._config_mgr.get( "io_tbl_writer_max_delay_secs", default=1.0, return_type="float" ),
+            max_retry_delay_secs=self._config_mgr.get( "io_tbl_writer_max_retry_delay_secs", default=60.0, return_type="float" ),
+            debug=self.debug, verbose=self.verbose
+        )
+        self._writer.add_flush_callback( self._count_io_rows )
+        self._writer.add_flush_callback( lambda rows: self._rebuild_indexes_if_stale() )
 
         # if self.debug and self.verbose:
         #     du.print_banner( "Tables:" )
@@ -46,7 +119,7 @@ class InputAndOutputTable():
         #     du.print_banner( "Table:" )
         #     print( self._input_and_output_tbl.select( [ "date", "time", "input", "output_final" ] ).head( 10 ) )
         
-    def insert_io_row( self, date=du.get_current_date(), time=du.get_current_time( include_timezone=False ),
+    def insert_io_row( self, date=None, time=None,
         input_type="", input="", input_embedding=[], output_raw="", output_final="", output_final_embedding=[], solution_path_wo_root=None
     ):
         
@@ -54,22 +127,42 @@ class InputAndOutputTable():
         # In this case the only embedding that we are caching is the one that corresponds to the query/input, otherwise known
         # as the 'question' in the solution snapshot object and the 'query' in the self._question_embeddings_tbl object.
         # TODO: Make consistent the use of the terms 'input', 'query' and 'question'. While they are synonymous that's not necessarily clear to the casual reader.
-        timer = Stopwatch( msg=f"insert_io_row( '{input[ :64 ]}...' )", silent=True )
-        
-        new_row = [ {
-            "date"                             : date,
-            "time"                             : time,
+        # ¡OJO! Rows are written in the background, in batches, so we stamp them w/ the date and time at which they were
+        # queued. These used to be default argument values, which python evaluates only once, when the module is loaded
+        new_row = {
+            "date"                             : date if date is not None else du.get_current_date(),
+            "time"                             : time if time is not None else du.get_current_time( include_timezone=False ),
             "input_type"                       : input_type,
             "input"                            : input,
-            "input_embedding"                  : input_embedding if input_embedding else self._question_embeddings_tbl.get_embedding( input ),
+            "input_embedding"                  : input_embedding,
             "output_raw"                       : output_raw,
             "output_final"                     : output_final,
-            "output_final_embedding"           : output_final_embedding if output_final_embedding else ss.generate_embedding( output_final ),
+            "output_final_embedding"           : output_final_embedding,
             "solution_path_wo_root"            : solution_path_wo_root
-        } ]
-        self._input_and_output_tbl.add( new_row )
-        timer.print( "Done! I/O table now has {self._input_and_output_tbl.count_rows()} rows", use_millis=True, end="\n" )
+        }
+        self._writer.enqueue( new_row )
+        
+    def close( self ):
+        """
+        Writes any rows that are still queued and stops the background writer.
+        """
+        self._writer.stop()
+        self._search_executor.shutdown( wait=False )
+    
+    def get_table( self ):
+        
+        return self._input_and_output_tbl
+    
+    def get_question_embeddings_table( self ):
         
+        return self._question_embeddings_tbl
+    
+    def flush( self, timeout=None ):
+        """
+        Blocks until every row queued by insert_io_row() has been written to the table.
+        """
+        return self._writer.flush( timeout=timeout )
+    
     def get_knn_by_input( self, search_terms, k=10 ):
         
         timer = Stopwatch( msg="get_knn_by_input() called..." )
@@ -77,9 +170,16 @@ class InputAndOutputTable():
         # First, convert the search_terms string into an embedding. The embedding table caches all question embeddings
         search_terms_embedding = self._question_embeddings_tbl.get_embedding( search_terms )
         
-        knn = self._input_and_output_tbl.search(
+        query = self._input_and_output_tbl.search(
             search_terms_embedding, vector_column_name="input_embedding"
-        ).metric( "dot" ).limit( k ).select( [ "input", "output_final" ] ).to_list()
+        ).metric( "dot" ).limit( k ).select( [ "input", "output_final" ] )
+        
+        # With an IVF-PQ index: search more than one partition, then re-rank the top candidates w/ their full vectors
+        if self._has_vector_index: query = query.nprobes( self.index_nprobes ).refine_factor( self.index_refine_factor )
+        
+        search_start = time.perf_counter()
+        knn = query.to_list()
+        self._knn_latencies_ms.append( ( time.perf_counter() - search_start ) * 1000 )
         timer.print( "Done!", use_millis=True )
         
         if self.debug and self.verbose:
@@ -92,6 +192,214 @@ class InputAndOutputTable():
         
         return knn
     
+    def get_hybrid_by_input( self, search_terms, k=10, where=None, fts_column="input" ):
+        """
+        Hybrid search: full text search on the input (or output) text and nearest neighbor search on the input embedding,
+        run concurrently and merged w/ reciprocal rank fusion, i.e. each row scores the sum of 1 / ( RRF_K + rank ) over
+        the result lists it appears in.
+        
+        If the search terms' embedding isn't cached yet, we don't wait for it: the lexical results are returned right away,
+        and the embedding is requested in the background so that the next search for the same terms is a hybrid one.
+        
+        :param where: Optional where clause, e.g. QNR_WHERE_CLAUSE, applied to both searches before ranking
+        
+        :param fts_column: Which text column to match the search terms against, "input" or "output_final"
+        
+        :return: List of up to k row dictionaries, best first, w/ the fused score in _rrf_score
+        """
+        timer = Stopwatch( msg=f"get_hybrid_by_input( '{du.truncate_string( search_terms )}', k={k} ) called...", silent=not self.debug )
+        
+        # Each search contributes more candidates than we return, so that rows ranked well by both can float to the top
+        candidates = 2 * k
+        embedding  = self._get_cached_embedding( search_terms )
+        
+        lexical_future = self._search_executor.submit( self._get_fts_results, search_terms, candidates, where, fts_column )
+        vector_future  = None if embedding is None else self._search_executor.submit( self._get_vector_results, embedding, candidates, where )
+        
+        result_lists = [ lexical_future.result() ]
+        if vector_future is not None: result_lists.append( vector_future.result() )
+        
+        # ¡OJO! Searches run on many request threads at once, and += isn't atomic
+        with self._stats_lock:
+            self._hybrid_searches += 1
+            if vector_future is None: self._hybrid_lexical_only += 1
+        
+        results = InputAndOutputTable._fuse_ranks( result_lists, k )
+        timer.print( f"Done! Returning [{len( results )}] rows{'' if vector_future is not None else ', lexical only'}", use_millis=True )
+        
+        return results
+    
+    def query_memory_table_for_knn_topics( self, topics, start_date=None, end_date=None, k=10 ):
+        """
+        Backs the function mapping tool of the same name: the past questions and answers that best match the topics,
+        optionally within a date range, found by hybrid search.
+        """
+        where = self._get_where_clause( start_date=start_date, end_date=end_date )
+        where = self.QNR_WHERE_CLAUSE if where is None else f"{self.QNR_WHERE_CLAUSE} AND {where}"
+        
+        return self.get_hybrid_by_input( topics, k=k, where=where )
+    
+    def _get_cached_embedding( self, search_terms ):
+        
+        embedding = self._question_embeddings_tbl.get_cached_embedding( search_terms )
+        if embedding is not None: return embedding
+        
+        # Cache hits come back already resolved. Misses keep going in the background, to warm the cache for next time
+        future = get_embedding_client().submit( search_terms )
+        
+        return future.result() if future.done() and future.exception() is None else None
+    
+    def _get_fts_results( self, search_terms, limit, where, fts_column ):
+        
+        query = self._input_and_output_tbl.search( search_terms, query_type="fts", fts_columns=fts_column ).limit( limit ).select( self.IO_COLUMNS )
+        if where: query = query.where( where, prefilter=True )
+        
+        try:
+            return query.to_list()
+        except Exception as e:
+            # E.g. a table created before its full text indexes were, which the next index build will take care of
+            du.print_stack_trace( e, explanation="Full text search failed", caller="InputAndOutputTable._get_fts_results()" )
+            return [ ]
+    
+    def _get_vector_results( self, embedding, limit, where ):
+        
+        query = self._input_and_output_tbl.search( embedding, vector_column_name="input_embedding" ).metric( "dot" ).limit( limit ).select( self.IO_COLUMNS )
+        if where: query = query.where( where, prefilter=True )
+        if self._has_vector_index: query = query.nprobes( self.index_nprobes ).refine_factor( self.index_refine_factor )
+        
+        search_start = time.perf_counter()
+        results      = query.to_list()
+        self._knn_latencies_ms.append( ( time.perf_counter() - search_start ) * 1000 )
+        
+        return results
+    
+    @classmethod
+    def _fuse_ranks( cls, result_lists, k ):
+        
+        rows_by_key   = { }
+        scores_by_key = Counter()
+        for results in result_lists:
+            for rank, row in enumerate( results, start=1 ):
+                key = ( row[ "date" ], row[ "time" ], row[ "input" ] )
+                scores_by_key[ key ] += 1.0 / ( cls.RRF_K + rank )
+                # Keep both the lexical _score and the vector _distance, when a row turns up in both lists
+                rows_by_key.setdefault( key, { } ).update( row )
+        
+        results = [ ]
+        for key, score in scores_by_key.most_common( k ):
+            rows_by_key[ key ][ "_rrf_score" ] = score
+            results.append( rows_by_key[ key ] )
+        
+        return results
+    
+    def _rebuild_indexes_if_stale( self ):
+        
+        if self._rows_at_last_index_build is None: return
+        
+        rows_since_build = self._input_and_output_tbl.count_rows() - self._rows_at_last_index_build
+        if rows_since_build >= self.index_rebuild_rows: self.rebuild_indexes()
+    
+    def rebuild_indexes( self, blocking=False, only_stale=False ):
+        """
+        (Re)builds the IVF-PQ vector indexes and the scalar indexes in a background thread.
+        
+        :param blocking: Wait for the build to finish before returning
+        
+        :param only_stale: Leave alone the indexes that exist and are missing fewer than index_rebuild_rows rows
+        
+        :return: False if a build was already in progress, True otherwise
+        """
+        with self._index_lock:
+            if self._index_build_thread is not None and self._index_build_thread.is_alive(): return False
+            self._index_build_thread = threading.Thread(
+                target=self._build_indexes, kwargs={ "only_stale": only_stale }, name="InputAndOutputTableIndexer", daemon=True
+            )
+            self._index_build_thread.start()
+        
+        if blocking: self._index_build_thread.join()
+        
+        return True
+    
+    def _get_unindexed_rows_by_column( self ):
+        """
+        :return: Dictionary of how many rows each existing index doesn't cover yet, by column
+        """
+        unindexed_rows_by_column = { }
+        for index in self._input_and_output_tbl.list_indices():
+            unindexed_rows = self._input_and_output_tbl.index_stats( index.name ).num_unindexed_rows
+            for column in index.columns: unindexed_rows_by_column[ column ] = unindexed_rows
+        
+        return unindexed_rows_by_column
+    
+    def _build_indexes( self, only_stale=False ):
+        
+        timer = Stopwatch( msg=f"Building indexes for {self._table_name}...", silent=not self.debug )
+        rows  = self._input_and_output_tbl.count_rows()
+        
+        try:
+            unindexed_rows_by_column = self._get_unindexed_rows_by_column() if only_stale else { }
+            is_stale = lambda column: column not in unindexed_rows_by_column or unindexed_rows_by_column[ column ] >= self.index_rebuild_rows
+            
+            vector_columns = [ column for column in self.VECTOR_INDEX_COLUMNS if is_stale( column ) ]
+            if vector_columns and rows >= self.MIN_ROWS_FOR_VECTOR_INDEX:
+                # Rule of thumb: ~sqrt( rows ) partitions, and sub vectors of 16 dimensions apiece
+                num_partitions  = max( 1, min( 256, int( math.sqrt( rows ) ) ) )
+                num_sub_vectors = max( 1, self._provider.dimensions // 16 )
+                for column in vector_columns:
+                    self._input_and_output_tbl.create_index(
+                        metric="dot", num_partitions=num_partitions, num_sub_vectors=num_sub_vectors, vector_column_name=column, replace=True
+                    )
+                    unindexed_rows_by_column[ column ] = 0
+            self._has_vector_index = all( column in unindexed_rows_by_column for column in self.VECTOR_INDEX_COLUMNS )
+            
+            for column in [ column for column in self.SCALAR_INDEX_COLUMNS if is_stale( column ) ]:
+                self._input_and_output_tbl.create_scalar_index( column, replace=True )
+                unindexed_rows_by_column[ column ] = 0
+            
+            # Rows added since the last build are still found by full text search, but by brute force
+            for column in [ column for column in self.FTS_INDEX_COLUMNS if is_stale( column ) ]:
+                self._input_and_output_tbl.create_fts_index( column, replace=True )
+                unindexed_rows_by_column[ column ] = 0
+            
+            # The indexes we left alone may still be a few rows behind, so count from the one furthest behind
+            self._rows_at_last_index_build = rows - max( unindexed_rows_by_column.values(), default=0 )
+            self._last_index_build_date    = du.get_current_datetime()
+            self._last_index_build_secs    = timer.get_delta_ms() / 1000.0
+            timer.print( f"Done! Indexed [{rows}] rows", use_millis=True )
+        
+        except Exception as e:
+            du.print_stack_trace( e, explanation="Index build failed", caller="InputAndOutputTable._build_indexes()" )
+            # Don't retry on every insert, wait for another batch of rows to accumulate
+            self._rows_at_last_index_build = rows
+    
+    def get_index_stats( self ):
+        """
+        Reports how fresh the indexes are, i.e. how many rows they don't cover yet, and the latency of recent knn queries.
+        """
+        rows       = self._input_and_output_tbl.count_rows()
+        latencies  = sorted( self._knn_latencies_ms )
+        percentile = lambda p: None if not latencies else round( latencies[ min( len( latencies ) - 1, int( p * len( latencies ) ) ) ], 3 )
+        with self._stats_lock: hybrid_searches, hybrid_lexical_only = self._hybrid_searches, self._hybrid_lexical_only
+        
+        return {
+            "table"              : self._table_name,
+            "rows"               : rows,
+            "rows_indexed"       : self._rows_at_last_index_build,
+            "rows_not_indexed"   : None if self._rows_at_last_index_build is None else rows - self._rows_at_last_index_build,
+            "rebuild_after_rows" : self.index_rebuild_rows,
+            "has_vector_index"   : self._has_vector_index,
+            "writer"             : self._writer.get_stats(),
+            "build_in_progress"  : self._index_build_thread is not None and self._index_build_thread.is_alive(),
+            "last_build_date"    : self._last_index_build_date,
+            "last_build_secs"    : self._last_index_build_secs,
+            "knn_queries"        : len( latencies ),
+            "knn_latency_ms_p50" : percentile( 0.50 ),
+            "knn_latency_ms_p95" : percentile( 0.95 ),
+            "knn_latency_ms_max" : None if not latencies else round( latencies[ -1 ], 3 ),
+            "hybrid_searches"    : hybrid_searches,
+            "hybrid_lexical_only": hybrid_lexical_only,
+        }
+    
     def get_all_io( self, max_rows=1000 ):
         
         timer = Stopwatch( msg=f"get_all_io( max_rows={max_rows} ) called..." )
@@ -105,29 +413,174 @@ class InputAndOutputTable():
         
         return results
     
-    def get_io_stats_by_input_type( self, max_rows=1000 ):
+    def _get_where_clause( self, start_date=None, end_date=None, input_type=None, cursor=None ):
         
-        timer = Stopwatch( msg=f"get_io_stats_by_input_type( max_rows={max_rows} ) called..." )
+        # Dates are ISO formatted strings, so they compare correctly as strings
+        quote   = QuestionEmbeddingsTable.quote_sql_string
+        clauses = [ ]
+        if start_date: clauses.append( f"date >= {quote( start_date )}" )
+        if end_date:   clauses.append( f"date <= {quote( end_date )}" )
+        if input_type: clauses.append( f"input_type = {quote( input_type )}" )
         
-        stats_df = self._input_and_output_tbl.search().select( [ "input_type" ] ).limit( max_rows ).to_pandas()
-        row_count = len( stats_df )
-        timer.print( f"Done! Returning [{row_count}] rows for summarization", use_millis=True )
-        if row_count == max_rows:
-            print( f"WARNING: Only returning [{max_rows}] rows out of [{self._input_and_output_tbl.count_rows()}]. Increase max_rows to see more data." )
+        # Rows after the cursor's ( date, time, row id ), which Lance can answer from the scalar index on date, rather
+        # than reading and throwing away every row before it like an offset does
+        if cursor:
+            date, time, row_id = self._decode_cursor( cursor )
+            clauses.append( f"( date > {quote( date )} OR ( date = {quote( date )} AND ( time > {quote( time )} OR ( time = {quote( time )} AND _rowid > {row_id} ) ) ) )" )
+        
+        return " AND ".join( clauses ) if clauses else None
+    
+    @staticmethod
+    def _encode_cursor( row ):
+        
+        # Opaque to clients, and safe to pass back as a query parameter as is
+        return base64.urlsafe_b64encode( json.dumps( [ row[ "date" ], row[ "time" ], row[ "_rowid" ] ] ).encode( "utf-8" ) ).decode( "ascii" )
+    
+    @staticmethod
+    def _decode_cursor( cursor ):
+        
+        try:
+            date, time, row_id = json.loads( base64.urlsafe_b64decode( cursor.encode( "ascii" ) ) )
+            return str( date ), str( time ), int( row_id )
+        except Exception as e:
+            raise ValueError( f"Invalid cursor [{cursor}]" ) from e
+    
+    def get_io_batches( self, start_date=None, end_date=None, input_type=None, limit=None, batch_size=1024 ):
+        """
+        Streams I/O rows from the table as Arrow record batches, so memory use stays flat no matter how big the table gets.
+        Filters are pushed down to Lance, rather than applied after the fact. Rows come back in no particular order, so
+        there's no cursor to resume from: use get_io_page() for that.
         
-        # Add a count column to the dataframe, which will be used to summarize the data
-        stats_df[ "count" ] = stats_df.groupby( [ "input_type" ] )[ "input_type" ].transform( "count" )
-        # Create a dictionary from the dataframe, setting the input_type as the index (key) and the count column as the value
-        stats_dict = stats_df.set_index( 'input_type' )[ 'count' ].to_dict()
+        :param start_date: Optional, inclusive, "YYYY-MM-DD"
+        
+        :param end_date: Optional, inclusive, "YYYY-MM-DD"
+        
+        :param input_type: Optional, exact match
+        
+        :param limit: Maximum number of rows to return, None for all of them
+        
+        :return: pyarrow.RecordBatchReader over the date, time, input_type, input and output_final columns
+        """
+        query = self._input_and_output_tbl.search().select( self.IO_COLUMNS )
+        where = self._get_where_clause( start_date=start_date, end_date=end_date, input_type=input_type )
+        if where: query = query.where( where )
+        
+        # ¡OJO! Queries w/o a limit default to 10 rows, so "everything" has to be spelled out
+        query = query.limit( limit if limit is not None else max( 1, self._input_and_output_tbl.count_rows() ) )
+        
+        return query.to_batches( batch_size=batch_size )
+    
+    def get_io_page( self, cursor=None, page_size=1000, start_date=None, end_date=None, input_type=None ):
+        """
+        One page of I/O rows in ( date, time ) order, plus the cursor for the next one. The cursor is the key of the last
+        row returned, not an offset, so fetching a page costs the same no matter how deep into the table it is, and
+        rows written in the meantime don't shift the pages.
+        
+        :return: Tuple of ( list of row dictionaries, next cursor or None if this was the last page )
+        """
+        key   = lambda row: ( row[ "date" ], row[ "time" ], row[ "_rowid" ] )
+        where = self._get_where_clause( start_date=start_date, end_date=end_date, input_type=input_type, cursor=cursor )
+        
+        def get_rows( where, limit ):
+            query = self._input_and_output_tbl.search().select( self.IO_COLUMNS ).with_row_id( True )
+            if where: query = query.where( where )
+            return query.order_by( [ { "column_name": "date" }, { "column_name": "time" } ] ).limit( limit ).to_list()
+        
+        # Ask for one row more than we need, to find out if there's a next page without counting
+        rows = get_rows( where, page_size + 1 )
+        
+        # ¡OJO! Lance can't sort by row id, so rows that share a date and time come back in no particular order, and the
+        # limit may have cut the last of those groups short. Fetch that group whole, so the cursor's row id is the group's
+        if len( rows ) > page_size:
+            last  = rows[ -1 ]
+            quote = QuestionEmbeddingsTable.quote_sql_string
+            tied  = f"date = {quote( last[ 'date' ] )} AND time = {quote( last[ 'time' ] )}"
+            rows  = [ row for row in rows if ( row[ "date" ], row[ "time" ] ) != ( last[ "date" ], last[ "time" ] ) ]
+            rows += get_rows( f"{where} AND {tied}" if where else tied, max( 1, self._input_and_output_tbl.count_rows() ) )
+        
+        rows.sort( key=key )
+        next_cursor = self._encode_cursor( rows[ page_size - 1 ] ) if len( rows ) > page_size else None
+        rows        = rows[ :page_size ]
+        for row in rows: del row[ "_rowid" ]
+        
+        return rows, next_cursor
+    
+    def _load_io_stats( self ):
+        
+        timer = Stopwatch( msg=f"Counting rows in {self._table_name} by input_type and date..." )
+        
+        # Only the two columns we need, aggregated by Arrow, not pandas, and without a row limit
+        table  = self._input_and_output_tbl.search().select( [ "date", "input_type" ] ).limit( max( 1, self._input_and_output_tbl.count_rows() ) ).to_arrow()
+        counts = table.group_by( [ "date", "input_type" ] ).aggregate( [ ( "input_type", "count" ) ] ).to_pydict()
+        
+        with self._stats_lock:
+            self._counts_by_input_type.clear()
+            self._counts_by_date_and_input_type.clear()
+            for date, input_type, count in zip( counts[ "date" ], counts[ "input_type" ], counts[ "input_type_count" ] ):
+                self._counts_by_input_type[ input_type ]                  += count
+                self._counts_by_date_and_input_type[ date ][ input_type ] += count
+        
+        timer.print( f"Done! [{table.num_rows}] rows, [{len( self._counts_by_input_type )}] input types", use_millis=True )
+    
+    def _count_io_rows( self, rows ):
+        
+        with self._stats_lock:
+            for row in rows:
+                self._counts_by_input_type[ row[ "input_type" ] ]                           += 1
+                self._counts_by_date_and_input_type[ row[ "date" ] ][ row[ "input_type" ] ] += 1
+    
+    def get_io_stats_by_input_type( self ):
+        """
+        Exact counts of the rows written so far, by input_type. Constant time: the counters are maintained as rows are written.
+        
+        :return: Dictionary of input_type -> count
+        """
+        with self._stats_lock:
+            return dict( self._counts_by_input_type )
+    
+    def get_io_stats_by_date( self ):
+        """
+        Exact counts of the rows written so far, by day and then by input_type.
+        
+        :return: Dictionary of date -> { input_type -> count }, sorted by date
+        """
+        with self._stats_lock:
+            return { date: dict( counts ) for date, counts in sorted( self._counts_by_date_and_input_type.items() ) }
+    
+    def get_knn_qnr( self, search_terms, k=100 ):
+        """
+        The questions and answers (see get_all_qnr()) whose inputs are nearest to the search terms.
+        
+        :return: List of row dictionaries, w/ the dot "distance", i.e. 1 - dot product, in _distance
+        """
+        timer = Stopwatch( msg=f"get_knn_qnr( k={k} ) called...", silent=not self.debug )
+        
+        search_terms_embedding = self._question_embeddings_tbl.get_embedding( search_terms )
+        
+        query = self._input_and_output_tbl.search(
+            search_terms_embedding, vector_column_name="input_embedding"
+        ).metric( "dot" ).where( self.QNR_WHERE_CLAUSE, prefilter=True ).limit( k ).select( self.IO_COLUMNS )
+        if self._has_vector_index: query = query.nprobes( self.index_nprobes ).refine_factor( self.index_refine_factor )
+        
+        results = query.to_list()
+        timer.print( f"Done! Returning [{len( results )}] rows of QnR", use_millis=True )
+        
+        return results
+    
+    def get_qnr_since( self, since_date, max_rows=100 ):
+        """
+        The questions and answers (see get_all_qnr()) asked on or after the given "YYYY-MM-DD" date.
+        """
+        where_clause = f"{self.QNR_WHERE_CLAUSE} AND date >= {QuestionEmbeddingsTable.quote_sql_string( since_date )}"
         
-        return stats_dict
+        return self._input_and_output_tbl.search().where( where_clause ).limit( max_rows ).select( self.IO_COLUMNS ).to_list()
     
     # Method to bitch all input an output where input_type starts with "go to agent"
     def get_all_qnr( self, max_rows=1000 ):
         
         timer = Stopwatch( msg=f"get_all_qnr( max_rows={max_rows} ) called..." )
         
-        where_clause = "input_type LIKE 'agent router go to %'"
+        where_clause = self.QNR_WHERE_CLAUSE
         results = self._input_and_output_tbl.search().where( where_clause ).limit( max_rows ).select(
             [ "date", "time", "input_type", "input", "output_final" ]
         ).to_list()
@@ -153,14 +606,14 @@ class InputAndOutputTable():
                 pa.field( "time",                     pa.string() ),
                 pa.field( "input_type",               pa.string() ),
                 pa.field( "input",                    pa.string() ),
-                pa.field( "input_embedding",          pa.list_( pa.float32(), 1536 ) ),
+                pa.field( "input_embedding",          pa.list_( pa.float32(), self._provider.dimensions ) ),
                 pa.field( "output_raw",               pa.string() ),
                 pa.field( "output_final",             pa.string() ),
-                pa.field( "output_final_embedding",   pa.list_( pa.float32(), 1536 ) ),
+                pa.field( "output_final_embedding",   pa.list_( pa.float32(), self._provider.dimensions ) ),
                 pa.field( "solution_path_wo_root",    pa.string() ),
             ]
         )
-        self._input_and_output_tbl = self.db.create_table( "input_and_output_tbl", schema=schema, mode="overwrite" )
+        self._input_and_output_tbl = self.db.create_table( self._table_name, schema=schema, mode="overwrite" )
         self._input_and_output_tbl.create_fts_index( "input", replace=True )
         self._input_and_output_tbl.create_fts_index( "input_type", replace=True )
         self._input_and_output_tbl.create_fts_index( "date", replace=True )
@@ -197,7 +650,7 @@ if __name__ == '__main__':
     # print( "Sum of foo", np.sum( foo ) )
     # print( "dot product of foo and foo", np.dot( foo, foo ) * 100 )
     #
-    io_tbl = InputAndOutputTable( debug=True )
+    io_tbl = get_lancedb_registry().get_input_and_output_table()
     qnr = io_tbl.get_all_qnr( max_rows=100 )
     # qnr = io_tbl.get_all_io( max_rows=100 )
     for row in qnr:
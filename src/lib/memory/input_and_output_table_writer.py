@@ -0,0 +1,184 @@
+import atexit
+import threading
+import time
+
+import lib.utils.util as du
+
+from lib.memory.solution_snapshot import SolutionSnapshot as ss
+from lib.utils.util_stopwatch     import Stopwatch
+
+
+class InputAndOutputTableWriter:
+    """
+    Write-behind persistence for I/O table rows.
+
+    Callers enqueue a row and return immediately. A background thread waits until either max_batch_rows rows have
+    piled up or the oldest one has waited max_delay_secs. It then fills in any missing embeddings in one batch and
+    appends all the rows to the Lance table in a single add(), rather than one tiny fragment per request.
+
+    A batch that fails, e.g. because the embedding API is down, isn't dropped: it goes back to the head of the queue and
+    is retried after a backoff that doubles w/ every consecutive failure, up to max_retry_delay_secs.
+    """
+    def __init__( self, io_tbl, question_embeddings_tbl, max_batch_rows=64, max_delay_secs=1.0, max_retry_delay_secs=60.0, debug=False, verbose=False ):
+
+        self.debug                    = debug
+        self.verbose                  = verbose
+        self.max_batch_rows           = max_batch_rows
+        self.max_delay_secs           = max_delay_secs
+        self.max_retry_delay_secs     = max_retry_delay_secs
+
+        self._io_tbl                  = io_tbl
+        self._question_embeddings_tbl = question_embeddings_tbl
+        self._pending                 = [ ]
+        self._oldest_pending_time     = None
+        self._flush_requested         = False
+        self._condition               = threading.Condition()
+        self._in_flight               = 0
+        self._stopped                 = False
+        self._on_flush_callbacks      = [ ]
+        self._consecutive_failures    = 0
+        self._retry_at                = None
+
+        self.rows_requested           = 0
+        self.rows_written             = 0
+        self.rows_failed              = 0
+        self.batches_written          = 0
+
+        self._thread = threading.Thread( target=self._enter_write_loop, name="InputAndOutputTableWriter", daemon=True )
+        self._thread.start()
+
+        # Don't lose queued rows when the server shuts down
+        atexit.register( self.stop )
+
+    def add_flush_callback( self, callback ):
+        """
+        Registers a function to be called w/ the list of rows, after every batch that's written to the table.
+        """
+        self._on_flush_callbacks.append( callback )
+
+    def enqueue( self, row ):
+        """
+        Queues a row to be written by the background thread. Empty embeddings are filled in before it's written.
+
+        :return: None
+        """
+        with self._condition:
+            if not self._pending: self._oldest_pending_time = time.monotonic()
+            self._pending.append( row )
+            self.rows_requested += 1
+            self._condition.notify()
+
+    def flush( self, timeout=None ):
+        """
+        Writes everything that's queued now, rather than waiting for a size or time trigger, and blocks until it's done.
+
+        :return: True if the queue was drained, False if we timed out
+        """
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            return self._condition.wait_for( lambda: not self._pending and self._in_flight == 0, timeout=timeout )
+
+    def stop( self, timeout=30 ):
+
+        self.flush( timeout=timeout )
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def get_stats( self ):
+
+        with self._condition:
+            return {
+                "pending"        : len( self._pending ),
+                "requested"      : self.rows_requested,
+                "written"        : self.rows_written,
+                "failed"         : self.rows_failed,
+                "retrying"       : self._retry_at is not None,
+                "failures_in_row": self._consecutive_failures,
+                "batches_written": self.batches_written,
+                "mean_batch_size": 0.0 if self.batches_written == 0 else self.rows_written / self.batches_written,
+            }
+
+    def _is_batch_ready( self ):
+
+        if not self._pending:
+            self._flush_requested = False
+            return False
+        # Backing off after a failure: not even a flush or a stop gets to hammer whatever's down
+        if self._retry_at is not None: return time.monotonic() >= self._retry_at
+        if self._stopped or self._flush_requested or len( self._pending ) >= self.max_batch_rows: return True
+
+        return time.monotonic() - self._oldest_pending_time >= self.max_delay_secs
+
+    def _enter_write_loop( self ):
+
+        while True:
+
+            with self._condition:
+                # Wake up when there's a full batch, or when the oldest pending row has waited long enough
+                while not self._is_batch_ready():
+                    if self._stopped and not self._pending: return
+                    if not self._pending:
+                        timeout = None
+                    elif self._retry_at is not None:
+                        timeout = max( 0.0, self._retry_at - time.monotonic() )
+                    else:
+                        timeout = max( 0.0, self.max_delay_secs - ( time.monotonic() - self._oldest_pending_time ) )
+                    self._condition.wait( timeout=timeout )
+
+                rows, self._pending       = self._pending[ :self.max_batch_rows ], self._pending[ self.max_batch_rows: ]
+                self._oldest_pending_time = time.monotonic() if self._pending else None
+                self._in_flight          += len( rows )
+
+            try:
+                self._write_rows( rows )
+            except Exception as e:
+                with self._condition:
+                    self.rows_failed           += len( rows )
+                    self._consecutive_failures += 1
+                    delay_secs                  = min( self.max_retry_delay_secs, max( 1.0, self.max_delay_secs ) * 2 ** ( self._consecutive_failures - 1 ) )
+                    self._retry_at              = time.monotonic() + delay_secs
+                    # Back to the head of the queue, ahead of anything that's been queued since
+                    self._pending               = rows + self._pending
+                    self._oldest_pending_time   = time.monotonic()
+                du.print_stack_trace( e, explanation=f"Writing [{len( rows )}] I/O rows failed, retrying in [{delay_secs:.1f}] secs", caller="InputAndOutputTableWriter._enter_write_loop()" )
+                continue
+            else:
+                with self._condition:
+                    self.rows_written          += len( rows )
+                    self.batches_written       += 1
+                    self._consecutive_failures  = 0
+                    self._retry_at              = None
+                # The rows are in, so a failing callback mustn't send them around again
+                for callback in self._on_flush_callbacks:
+                    try:
+                        callback( rows )
+                    except Exception as e:
+                        du.print_stack_trace( e, explanation="I/O rows flush callback failed", caller="InputAndOutputTableWriter._enter_write_loop()" )
+            finally:
+                with self._condition:
+                    self._in_flight -= len( rows )
+                    self._condition.notify_all()
+
+    def _write_rows( self, rows ):
+
+        timer = Stopwatch( msg=f"Writing [{len( rows )}] I/O rows...", silent=not self.debug )
+
+        # Inputs are questions, so the question embeddings table gets first crack at them. Whatever it doesn't have,
+        # and all the missing output embeddings, are generated in one batch
+        missing_inputs  = [ row for row in rows if len( row[ "input_embedding" ] ) == 0 ]
+        missing_outputs = [ row for row in rows if len( row[ "output_final_embedding" ] ) == 0 ]
+        for row in missing_inputs:
+            if self._question_embeddings_tbl.has( row[ "input" ] ): row[ "input_embedding" ] = self._question_embeddings_tbl.get_embedding( row[ "input" ] )
+        missing_inputs  = [ row for row in missing_inputs if len( row[ "input_embedding" ] ) == 0 ]
+
+        texts      = [ row[ "input" ] for row in missing_inputs ] + [ row[ "output_final" ] for row in missing_outputs ]
+        embeddings = ss.generate_embeddings( texts ) if texts else [ ]
+        for row, embedding in zip( missing_inputs, embeddings[ :len( missing_inputs ) ] ):
+            row[ "input_embedding" ] = embedding
+        for row, embedding in zip( missing_outputs, embeddings[ len( missing_inputs ): ] ):
+            row[ "output_final_embedding" ] = embedding
+
+        self._io_tbl.add( rows )
+        timer.print( "Done!", use_millis=True )
@@ -0,0 +1,162 @@
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+
+import lib.utils.util as du
+from lib.utils.util_stopwatch import Stopwatch
+
+
+class LanceDbMaintenanceScheduler:
+    """
+    Keeps LanceDB tables from degrading as they grow one small append at a time.
+
+    Every append creates a new data fragment and a new table version, so scans and count_rows() get slower over
+    time. A background thread checks each registered table periodically and, once it has more than max_fragments
+    fragments or hasn't been maintained for max_interval_secs, compacts its fragments, prunes versions older than
+    keep_versions_secs and hands it to its reindex callback, if any. Fragment counts, version counts and scan latency
+    are recorded before and after every run, so the effect can be confirmed.
+    """
+    def __init__( self, max_fragments=64, max_interval_secs=24 * 60 * 60, check_interval_secs=5 * 60, keep_versions_secs=60 * 60,
+                  debug=False, verbose=False ):
+
+        self.debug               = debug
+        self.verbose             = verbose
+        self.max_fragments       = max_fragments
+        self.max_interval_secs   = max_interval_secs
+        self.check_interval_secs = check_interval_secs
+        self.keep_versions_secs  = keep_versions_secs
+
+        self._tables_by_name     = { }
+        self._lock               = threading.Lock()
+        self._wake_up            = threading.Event()
+        self._history            = deque( maxlen=50 )
+        self._stopped            = False
+
+        self._thread = threading.Thread( target=self._enter_maintenance_loop, name="LanceDbMaintenanceScheduler", daemon=True )
+        self._thread.start()
+
+    def register_table( self, name, table, scan_column, on_compacted=None ):
+        """
+        Adds a table to the maintenance schedule. Registering the same name again replaces the previous entry.
+
+        :param scan_column: A cheap, scalar column that's read in full to measure scan latency
+
+        :param on_compacted: Optional callback, e.g. to rebuild the table's indexes once its fragments have been merged
+        """
+        with self._lock:
+            self._tables_by_name[ name ] = {
+                "table"           : table,
+                "scan_column"     : scan_column,
+                "on_compacted"    : on_compacted,
+                "last_maintained" : time.monotonic(),
+            }
+
+    def run_now( self, name=None ):
+        """
+        Maintains one (or every) registered table right away, in the calling thread.
+
+        :return: List of before/after reports, one per table
+        """
+        with self._lock:
+            names = [ name ] if name is not None else list( self._tables_by_name.keys() )
+
+        return [ self._maintain_table( name ) for name in names ]
+
+    def get_stats( self ):
+        """
+        Current fragment counts for each table and the before/after reports of recent maintenance runs.
+        """
+        with self._lock:
+            entries = dict( self._tables_by_name )
+
+        return {
+            "max_fragments"     : self.max_fragments,
+            "max_interval_secs" : self.max_interval_secs,
+            "tables"            : { name: self._get_table_stats( entry ) for name, entry in entries.items() },
+            "history"           : list( self._history ),
+        }
+
+    def stop( self ):
+
+        self._stopped = True
+        self._wake_up.set()
+
+    def _enter_maintenance_loop( self ):
+
+        while not self._stopped:
+
+            self._wake_up.wait( timeout=self.check_interval_secs )
+            if self._stopped: return
+
+            with self._lock:
+                entries = dict( self._tables_by_name )
+
+            for name, entry in entries.items():
+                try:
+                    fragments  = self._get_fragment_count( entry[ "table" ] )
+                    is_overdue = time.monotonic() - entry[ "last_maintained" ] >= self.max_interval_secs
+                    if ( fragments is not None and fragments > self.max_fragments ) or is_overdue:
+                        self._maintain_table( name )
+                except Exception as e:
+                    du.print_stack_trace( e, explanation=f"Maintenance of [{name}] failed", caller="LanceDbMaintenanceScheduler._enter_maintenance_loop()" )
+
+    def _maintain_table( self, name ):
+
+        with self._lock:
+            entry = self._tables_by_name[ name ]
+
+        timer  = Stopwatch( msg=f"Maintaining LanceDB table [{name}]...", silent=not self.debug )
+        table  = entry[ "table" ]
+        before = self._get_table_stats( entry )
+
+        # Newer lancedb versions do compaction and cleanup natively. Older ones need the optional pylance package
+        keep_versions = timedelta( seconds=self.keep_versions_secs )
+        if hasattr( table, "optimize" ):
+            table.optimize( cleanup_older_than=keep_versions )
+        else:
+            table.compact_files()
+            table.cleanup_old_versions( older_than=keep_versions )
+
+        if entry[ "on_compacted" ] is not None: entry[ "on_compacted" ]()
+
+        after  = self._get_table_stats( entry )
+        report = {
+            "table"  : name,
+            "date"   : du.get_current_datetime(),
+            "secs"   : timer.get_delta_ms() / 1000.0,
+            "before" : before,
+            "after"  : after,
+        }
+        with self._lock:
+            entry[ "last_maintained" ] = time.monotonic()
+            self._history.append( report )
+
+        timer.print( f"Done! Fragments [{before[ 'fragments' ]}] -> [{after[ 'fragments' ]}], scan [{before[ 'scan_ms' ]}] -> [{after[ 'scan_ms' ]}] ms", use_millis=True )
+
+        return report
+
+    def _get_table_stats( self, entry ):
+
+        table = entry[ "table" ]
+
+        scan_start = time.perf_counter()
+        rows       = table.count_rows()
+        table.search().select( [ entry[ "scan_column" ] ] ).limit( max( 1, rows ) ).to_arrow()
+        scan_ms    = round( ( time.perf_counter() - scan_start ) * 1000, 3 )
+
+        return {
+            "rows"      : rows,
+            "fragments" : self._get_fragment_count( table ),
+            "versions"  : len( table.list_versions() ) if hasattr( table, "list_versions" ) else None,
+            "scan_ms"   : scan_ms,
+        }
+
+    def _get_fragment_count( self, table ):
+
+        if hasattr( table, "stats" ): return table.stats()[ "fragment_stats" ][ "num_fragments" ]
+
+        try:
+            return len( table.to_lance().get_fragments() )
+        except ImportError:
+            return None
@@ -0,0 +1,107 @@
+import threading
+
+import lancedb
+
+import lib.utils.util as du
+from lib.app.configuration_manager import ConfigurationManager
+
+
+class LanceDbRegistry:
+    """
+    Process wide registry of the LanceDB connection, raw table handles and the table wrappers built on top of them.
+
+    Everything is opened lazily, the first time it's asked for, and then reused by every caller, from any thread. In
+    particular, agents that are created for every question no longer pay to open the database, or start yet another
+    background writer, index builder and in-memory question index, every time.
+    """
+    def __init__( self, uri=None, debug=False, verbose=False ):
+
+        self.debug    = debug
+        self.verbose  = verbose
+        self._uri     = uri
+
+        # Reentrant: the I/O table asks for the question embeddings table while it's being created under this lock
+        self._lock                    = threading.RLock()
+        self._connection              = None
+        self._tables_by_name          = { }
+        self._input_and_output_tbl    = None
+        self._question_embeddings_tbl = None
+
+    def _get_uri( self ):
+
+        if self._uri is None:
+            config_mgr = ConfigurationManager( env_var_name="GIB_CONFIG_MGR_CLI_ARGS" )
+            self._uri  = du.get_project_root() + config_mgr.get( "database_path_wo_root" )
+
+        return self._uri
+
+    def get_connection( self ):
+
+        with self._lock:
+            if self._connection is None:
+                if self.debug: print( f"Connecting to LanceDB at [{self._get_uri()}]..." )
+                self._connection = lancedb.connect( self._get_uri() )
+
+            return self._connection
+
+    def open_table( self, name ):
+        """
+        :return: The raw LanceDB table handle, opened the first time it's asked for
+        """
+        with self._lock:
+            if name not in self._tables_by_name:
+                self._tables_by_name[ name ] = self.get_connection().open_table( name )
+
+            return self._tables_by_name[ name ]
+
+    def get_question_embeddings_table( self ):
+
+        from lib.memory.question_embeddings_table import QuestionEmbeddingsTable
+
+        with self._lock:
+            if self._question_embeddings_tbl is None:
+                self._question_embeddings_tbl = QuestionEmbeddingsTable( debug=self.debug, verbose=self.verbose )
+
+            return self._question_embeddings_tbl
+
+    def get_input_and_output_table( self ):
+
+        from lib.memory.input_and_output_table import InputAndOutputTable
+
+        with self._lock:
+            if self._input_and_output_tbl is None:
+                self._input_and_output_tbl = InputAndOutputTable( debug=self.debug, verbose=self.verbose )
+
+            return self._input_and_output_tbl
+
+    def refresh( self, uri=None ):
+        """
+        Drops every cached handle, e.g. after the configuration has changed, so that they're reopened the next time
+        they're asked for. Rows still queued for the I/O table are written before its handle is let go.
+        """
+        with self._lock:
+            if self._input_and_output_tbl is not None: self._input_and_output_tbl.close()
+
+            self._uri                     = uri
+            self._connection              = None
+            self._tables_by_name          = { }
+            self._input_and_output_tbl    = None
+            self._question_embeddings_tbl = None
+
+        print( "LanceDB registry refreshed, handles will be reopened on demand" )
+
+
+_lancedb_registry      = None
+_lancedb_registry_lock = threading.Lock()
+
+def get_lancedb_registry():
+    """
+    Returns the process wide LanceDB registry, creating it the first time it's asked for.
+    """
+    global _lancedb_registry
+
+    with _lancedb_registry_lock:
+        if _lancedb_registry is None:
+            _lancedb_registry = LanceDbRegistry()
+
+    return _lancedb_registry
@@ -0,0 +1,99 @@
+import math
+import threading
+from collections import OrderedDict
+from datetime import date as dt_date, timedelta
+
+import lib.utils.util as du
+from lib.utils.util_stopwatch import Stopwatch
+
+
+class MemoryRetriever:
+    """
+    Picks the past questions and answers worth putting in front of an agent, instead of all of them.
+
+    Candidates are the nearest neighbors of the current question in the I/O table, plus everything from the last
+    few days. Each is scored by similarity to the question plus a recency bonus that halves every half_life_days,
+    and the best ones are kept until either k fragments or token_budget (estimated) tokens have been used. Rendered
+    fragments are cached across questions, and across instances, since agents are created fresh for every question.
+    """
+    FRAGMENT_TEMPLATE = "<memory-fragment> <date>{date}</date/> <human-queried>{input}</human-queried> <ai-answered>{output_final}</ai-answered> </memory-fragment>"
+
+    _rendered_fragments      = OrderedDict()
+    _rendered_fragments_lock = threading.Lock()
+    MAX_RENDERED_FRAGMENTS   = 10000
+
+    def __init__( self, io_tbl, k=20, token_budget=2000, candidates=100, recent_days=3, recency_weight=0.15, half_life_days=7.0, debug=False, verbose=False ):
+
+        self.debug          = debug
+        self.verbose        = verbose
+        self.io_tbl         = io_tbl
+        self.k              = k
+        self.token_budget   = token_budget
+        self.candidates     = candidates
+        self.recent_days    = recent_days
+        self.recency_weight = recency_weight
+        self.half_life_days = half_life_days
+
+    def get_memory_fragments( self, question ):
+        """
+        :return: The selected memory fragments, rendered and sorted chronologically, joined by newlines
+        """
+        timer = Stopwatch( msg=f"Retrieving memories for [{du.truncate_string( question )}]...", silent=not self.debug )
+
+        # Similar questions, whenever they were asked, plus recent ones, whatever they were about
+        rows_by_key = { }
+        for row in self.io_tbl.get_knn_qnr( question, k=self.candidates ):
+            rows_by_key[ MemoryRetriever._get_key( row ) ] = row
+        since_date = ( dt_date.today() - timedelta( days=self.recent_days ) ).isoformat()
+        for row in self.io_tbl.get_qnr_since( since_date, max_rows=self.candidates ):
+            rows_by_key.setdefault( MemoryRetriever._get_key( row ), row )
+
+        scored = sorted( ( ( self._get_score( row ), key, row ) for key, row in rows_by_key.items() ), key=lambda item: item[ 0 ], reverse=True )
+
+        selected = [ ]
+        tokens   = 0
+        for score, key, row in scored:
+            if len( selected ) == self.k: break
+            fragment        = MemoryRetriever._render_fragment( key, row )
+            fragment_tokens = len( fragment ) // 4 + 1
+            if tokens + fragment_tokens > self.token_budget: continue
+            tokens += fragment_tokens
+            selected.append( ( row[ "date" ], row.get( "time", "" ), fragment ) )
+            if self.debug and self.verbose: print( f"[{score:.3f}] {fragment}" )
+
+        timer.print( f"Done! Selected [{len( selected )}] of [{len( scored )}] candidates, ~[{tokens}] tokens", use_millis=True )
+
+        return "\n".join( fragment for _, _, fragment in sorted( selected ) )
+
+    def _get_score( self, row ):
+
+        # Lance's dot "distance" is 1 - dot product. Rows that only turned up because they're recent have no distance
+        similarity = 1.0 - row[ "_distance" ] if row.get( "_distance" ) is not None else 0.0
+
+        try:
+            age_days = max( 0, ( dt_date.today() - dt_date.fromisoformat( row[ "date" ] ) ).days )
+        except ValueError:
+            age_days = math.inf
+
+        return similarity + self.recency_weight * math.pow( 0.5, age_days / self.half_life_days )
+
+    @staticmethod
+    def _get_key( row ):
+
+        return ( row[ "date" ], row.get( "time", "" ), row[ "input" ] )
+
+    @classmethod
+    def _render_fragment( cls, key, row ):
+
+        with cls._rendered_fragments_lock:
+            if key in cls._rendered_fragments:
+                cls._rendered_fragments.move_to_end( key )
+                return cls._rendered_fragments[ key ]
+
+        fragment = cls.FRAGMENT_TEMPLATE.format( date=row[ "date" ], input=row[ "input" ], output_final=row[ "output_final" ] )
+
+        with cls._rendered_fragments_lock:
+            cls._rendered_fragments[ key ] = fragment
+            while len( cls._rendered_fragments ) > cls.MAX_RENDERED_FRAGMENTS: cls._rendered_fragments.popitem( last=False )
+
+        return fragment
@@ -1,9 +1,13 @@
 import lib.utils.util as du
 
 from lib.memory.solution_snapshot  import SolutionSnapshot as ss
+from lib.memory.embedding_provider import get_embedding_provider
+from lib.memory.lancedb_registry   import get_lancedb_registry
 from lib.app.configuration_manager import ConfigurationManager
 from lib.utils.util_stopwatch      import Stopwatch
 
+import threading
+
 import lancedb
 
 
@@ -31,13 +35,71 @@ class QuestionEmbeddingsTable():
         self.verbose     = verbose
         self._config_mgr = ConfigurationManager( env_var_name="GIB_CONFIG_MGR_CLI_ARGS" )
         
-        uri = du.get_project_root() + self._config_mgr.get( "database_path_wo_root" )
+        # One connection per process, shared w/ every other table
+        registry = get_lancedb_registry()
+        db       = registry.get_connection()
+        
+        # Each embedding provider gets its own table, since vectors from different models can't be compared
+        provider   = get_embedding_provider()
+        table_name = provider.get_table_name( "question_embeddings_tbl" )
+        if table_name not in db.table_names():
+            import pyarrow as pa
+            schema = pa.schema(
+                [
+                    pa.field( "question", pa.string() ),
+                    pa.field( "embedding", pa.list_( pa.float32(), provider.dimensions ) )
+                ]
+            )
+            db.create_table( table_name, schema=schema )
+            print( f"Created {table_name} for embedding provider [{provider.get_namespace()}]" )
+        
+        self._question_embeddings_tbl = registry.open_table( table_name )
+        
+        # Warm, in-memory index of every question in the table, so that lookups are a dict hit rather than a table scan.
+        # Shared by the request handlers, the job threads and the I/O table's writer thread, hence the lock
+        self._lock                    = threading.Lock()
+        self._embeddings_by_question  = self._load_embeddings_by_question()
+        
+        # Single flight: the first thread to ask get_or_create_embedding() for a question that's not in the table yet
+        # generates and inserts it, everybody else asking for the same question meanwhile waits for that one
+        self._creates_by_question     = { }
+        self._insert_lock             = threading.Lock()
+        self.coalesced_creates        = 0
+        
+        print( f"Opened {table_name} w/ [{self._question_embeddings_tbl.count_rows()}] rows" )
         
-        db = lancedb.connect( uri )
+    def _load_embeddings_by_question( self ):
         
-        self._question_embeddings_tbl = db.open_table( "question_embeddings_tbl" )
+        timer = Stopwatch( msg="Loading question embeddings index...", silent=not self.debug )
+        rows  = self._question_embeddings_tbl.to_arrow().select( [ "question", "embedding" ] ).to_pydict()
+        embeddings_by_question = dict( zip( rows[ "question" ], rows[ "embedding" ] ) )
+        timer.print( f"Done! [{len( embeddings_by_question )}] questions indexed", use_millis=True )
         
-        print( f"Opened question_embeddings_tbl w/ [{self._question_embeddings_tbl.count_rows()}] rows" )
+        return embeddings_by_question
+    
+    @staticmethod
+    def quote_sql_string( value ):
+        """
+        Quotes a string for use as a literal in a LanceDB where clause: single quotes are escaped by doubling them.
+        """
+        return "'" + value.replace( "'", "''" ) + "'"
+    
+    def _get_embedding_from_table( self, question ):
+        
+        # Another instance of this class may have added the question since we loaded our index
+        if self.debug: timer = Stopwatch( msg=f"_get_embedding_from_table( '{question}' )", silent=True )
+        try:
+            rows_returned = self._question_embeddings_tbl.search().where( f"question = {self.quote_sql_string( question )}" ).limit( 1 ).select( [ "embedding" ] ).to_list()
+        except Exception as e:
+            du.print_stack_trace( e, explanation="search() failed", caller="QuestionEmbeddingsTable._get_embedding_from_table()" )
+            rows_returned = [ ]
+        if self.debug: timer.print( f"Done! w/ {len( rows_returned )} rows returned", use_millis=True )
+        
+        if not rows_returned: return None
+        
+        embedding = rows_returned[ 0 ][ "embedding" ]
+        with self._lock:
+            return self._embeddings_by_question.setdefault( question, embedding )
         
     def has( self, question ):
         """
@@ -49,11 +111,7 @@ class QuestionEmbeddingsTable():
         Returns:
             bool: True if the question exists, False otherwise.
         """
-        if self.debug: timer = Stopwatch( msg=f"has( '{question}' )" )
-        synonyms = self._question_embeddings_tbl.search().where( f"question = '{question}'" ).limit( 1 ).select( [ "question" ] ).to_list()
-        if self.debug: timer.print( "Done!", use_millis=True )
-        
-        return len( synonyms ) > 0
+        return self.get_cached_embedding( question ) is not None or self._get_embedding_from_table( question ) is not None
     
     def get_embedding( self, question ):
         """
@@ -67,23 +125,83 @@ class QuestionEmbeddingsTable():
         Returns:
             embedding: The embedding for the given question.
         """
-        if self.debug: timer = Stopwatch( msg=f"get_embedding( '{question}' )", silent=True )
+        embedding = self.get_cached_embedding( question )
+        if embedding is None: embedding = self._get_embedding_from_table( question )
+        if embedding is None: embedding = ss.generate_embedding( question )
+        
+        return embedding
+    
+    def get_cached_embedding( self, question ):
+        """
+        Get the embedding for the given question string, but only if it's already in memory: never queries the table or generates it.
+
+        Parameters:
+            question (str): The input question to get the embedding for.
+
+        Returns:
+            embedding: The embedding for the given question, or None.
+        """
+        with self._lock:
+            return self._embeddings_by_question.get( question )
+    
+    def get_or_create_embedding( self, question ):
+        """
+        Get the embedding for the given question string, generating it and adding it to the table if it's not there yet.
+
+        Parameters:
+            question (str): The input question to get the embedding for.
+
+        Returns:
+            embedding: The embedding for the given question.
+        """
+        embedding = self.get_cached_embedding( question )
+        if embedding is not None: return embedding
+        
+        with self._lock:
+            created = self._creates_by_question.get( question )
+            leader  = created is None
+            if leader: created = self._creates_by_question[ question ] = threading.Event()
+            else:      self.coalesced_creates += 1
+        
+        if not leader:
+            created.wait()
+            embedding = self.get_cached_embedding( question )
+            # ¡OJO! If the leader failed, it's our turn to try
+            return embedding if embedding is not None else self.get_or_create_embedding( question )
+        
         try:
-            rows_returned = self._question_embeddings_tbl.search().where( f"question = '{question}'" ).limit( 1 ).select( [ "embedding" ] ).to_list()
-        except Exception as e:
-            du.print_stack_trace( e, explanation="search() failed", caller="QuestionEmbeddingsTable.get_embedding()" )
-            rows_returned = []
-        if self.debug: timer.print( f"Done! w/ {len( rows_returned )} rows returned", use_millis=True )
+            embedding = self._get_embedding_from_table( question )
+            if embedding is None:
+                embedding = ss.generate_embedding( question )
+                embedding = self.add_embedding( question, embedding )
+        finally:
+            with self._lock:
+                del self._creates_by_question[ question ]
+            created.set()
         
-        if not rows_returned:
-            return ss.generate_embedding( question )
-        else:
-            return rows_returned[ 0 ][ "embedding"]
+        return embedding
         
+    def get_table( self ):
+        
+        return self._question_embeddings_tbl
+    
     def add_embedding( self, question, embedding ):
+        """
+        Adds the question to the table, unless it's already there.
+        
+        :return: The question's embedding, i.e. the one already in the table if there was one
+        """
+        # Checked and inserted under one lock, so two threads adding the same question can't both insert it
+        with self._insert_lock:
+            existing = self.get_cached_embedding( question )
+            if existing is not None: return existing
+            
+            new_row = [ { "question": question, "embedding": embedding } ]
+            self._question_embeddings_tbl.add( new_row )
+            with self._lock:
+                self._embeddings_by_question[ question ] = embedding
         
-        new_row = [ { "question": question, "embedding": embedding } ]
-        self._question_embeddings_tbl.add( new_row )
+        return embedding
     
     # def _init_tbl( self ):
     #
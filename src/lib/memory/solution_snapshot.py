@@ -13,12 +13,20 @@ import lib.utils.util_xml as dux
 
 from lib.agents.runnable_code        import RunnableCode
 from lib.agents.raw_output_formatter import RawOutputFormatter
+from lib.app.job_context             import job_stage
+from lib.memory.embedding_client     import get_embedding_client
+from lib.memory.embedding_provider   import get_embedding_provider, EmbeddingProvider
 
-import openai
 import numpy as np
 
 class SolutionSnapshot( RunnableCode ):
     
+    # Embeddings that are moved out of the JSON file and into a float32 .npy sidecar when using the "sidecar" storage format
+    EMBEDDING_FIELDS       = [ "question_embedding", "code_embedding", "solution_embedding", "thoughts_embedding" ]
+    
+    # Either "json", with the embeddings inlined as float lists, or "sidecar". Overridden at startup by the app's configuration
+    default_storage_format = "json"
+    
     @staticmethod
     def get_timestamp():
         
@@ -35,16 +43,14 @@ class SolutionSnapshot( RunnableCode ):
     @staticmethod
     def generate_embedding( text ):
         
-        timer = sw.Stopwatch( msg=f"Generating embedding for [{du.truncate_string( text )}]...", silent=True )
-        openai.api_key = du.get_api_key( "openai" )
-        
-        response = openai.embeddings.create(
-            input=text,
-            model="text-embedding-ada-002"
-        )
-        timer.print( "Done!", use_millis=True )
+        # Every embedding in the app comes through here. The client checks the shared cache, and otherwise gathers
+        # concurrent requests, from any thread, into batched calls to the current embedding provider
+        return get_embedding_client().embed( text )
+    
+    @staticmethod
+    def generate_embeddings( texts ):
         
-        return response.data[ 0 ].embedding
+        return get_embedding_client().embed_batch( texts )
     
     @staticmethod
     def generate_id_hash( push_counter, run_date ):
@@ -70,7 +76,8 @@ class SolutionSnapshot( RunnableCode ):
                   id_hash="", solution_summary="", code=[], code_returns="", code_example="", code_type="raw", thoughts="",
                   programming_language="Python", language_version="3.10",
                   question_embedding=[ ], solution_embedding=[ ], code_embedding=[ ], thoughts_embedding=[ ],
-                  solution_directory="/src/conf/long-term-memory/solutions/", solution_file=None, debug=False, verbose=False
+                  solution_directory="/src/conf/long-term-memory/solutions/", solution_file=None, storage_format=None, embedding_namespace=None, embeddings_by_namespace=None, embedding_sidecars=None,
+                  debug=False, verbose=False
         ):
         
         super().__init__( debug=debug, verbose=verbose )
@@ -118,52 +125,138 @@ class SolutionSnapshot( RunnableCode ):
         self.language_version      = language_version
         self.solution_directory    = solution_directory
         self.solution_file         = solution_file
-        
-        # If the question embedding is empty, generate it
-        if question != "" and not question_embedding:
-            self.question_embedding = self.generate_embedding( question )
+        self.storage_format        = storage_format if storage_format is not None else SolutionSnapshot.default_storage_format
+        
+        # Embeddings from one provider can't be compared to those from another. The embedding fields always hold the
+        # current provider's embeddings, while those from other providers are set aside by namespace, rather than thrown
+        # away, and written back out w/ the snapshot, so that switching providers back and forth doesn't cost a full
+        # re-embed each time. Embeddings passed in w/o a namespace are taken to be the current provider's: only
+        # resolve_sidecar() knows where they came from, and it always fills the namespace in
+        self.embedding_namespace     = get_embedding_provider().get_namespace()
+        self.embeddings_by_namespace = dict( embeddings_by_namespace or { } )
+        self.embedding_sidecars      = dict( embedding_sidecars or { } )
+        if embedding_namespace is not None and embedding_namespace != self.embedding_namespace:
+            
+            if debug: print( f"Swapping [{self.question}]'s embeddings from [{embedding_namespace}] to [{self.embedding_namespace}]" )
+            embeddings = { "question_embedding": question_embedding, "code_embedding": code_embedding, "solution_embedding": solution_embedding, "thoughts_embedding": thoughts_embedding }
+            embeddings = { field: embedding for field, embedding in embeddings.items() if len( embedding ) > 0 }
+            if embeddings: self.embeddings_by_namespace[ embedding_namespace ] = embeddings
+            
+            embeddings = self.embeddings_by_namespace.pop( self.embedding_namespace, { } )
+            question_embedding = embeddings.get( "question_embedding", [ ] )
+            code_embedding     = embeddings.get( "code_embedding",     [ ] )
+            solution_embedding = embeddings.get( "solution_embedding", [ ] )
+            thoughts_embedding = embeddings.get( "thoughts_embedding", [ ] )
+        
+        # ¡OJO! Embeddings can be either lists or (memory mapped) numpy arrays, so we test them using len() rather than truthiness
+        # Any embeddings that are missing get generated in a single batch, rather than one round trip apiece
+        texts_by_field = { }
+        if question != "" and len( question_embedding ) == 0:   texts_by_field[ "question_embedding" ] = question
+        if code and len( code_embedding ) == 0:                 texts_by_field[ "code_embedding"     ] = " ".join( code )
+        if solution_summary and len( solution_embedding ) == 0: texts_by_field[ "solution_embedding" ] = solution_summary
+        if thoughts and len( thoughts_embedding ) == 0:         texts_by_field[ "thoughts_embedding" ] = thoughts
+        
+        embeddings_by_field = { }
+        if texts_by_field:
+            embeddings_by_field = dict( zip( texts_by_field.keys(), self.generate_embeddings( list( texts_by_field.values() ) ) ) )
             dirty = True
-        else:
-            self.question_embedding = question_embedding
         
-        # If the code embedding is empty, generate it
-        if code and not code_embedding:
-            self.code_embedding     = self.generate_embedding( " ".join( code ) )
-            dirty = True
-        else:
-            self.code_embedding     = code_embedding
-    
-        # If the solution embedding is empty, generate it
-        if solution_summary and not solution_embedding:
-            self.solution_embedding = self.generate_embedding( solution_summary )
-            dirty = True
-        else:
-            self.solution_embedding = solution_embedding
-
-        # If the thoughts embedding is empty, generate it
-        if thoughts and not thoughts_embedding:
-            self.thoughts_embedding = self.generate_embedding( thoughts )
-            dirty = True
-        else:
-            self.thoughts_embedding = thoughts_embedding
-            
-        # Save changes if we've made any change as while loading
-        if dirty: self.write_current_state_to_file()
+        self.question_embedding = embeddings_by_field.get( "question_embedding", question_embedding )
+        self.code_embedding     = embeddings_by_field.get( "code_embedding",     code_embedding )
+        self.solution_embedding = embeddings_by_field.get( "solution_embedding", solution_embedding )
+        self.thoughts_embedding = embeddings_by_field.get( "thoughts_embedding", thoughts_embedding )
+        
+        # ¡OJO! We never write to disk from here: that would put file I/O on the job thread for new snapshots, and write
+        # out throwaway ones, e.g. those built just to compare questions. Whoever keeps the snapshot, i.e. the snapshot
+        # manager, checks this flag and queues a write w/ its SolutionSnapshotWriter
+        self.embeddings_generated = dirty
         
     @classmethod
     def from_json_file( cls, filename, debug=False ):
         
         if debug: print( f"Reading {filename}..." )
+        data = SolutionSnapshot.read_json_file( filename )
+        
+        return cls( **SolutionSnapshot.resolve_sidecar( data, os.path.dirname( filename ) ) )
+    
+    @staticmethod
+    def read_json_file( filename ):
+        """
+        Parses a snapshot file into a dictionary of constructor arguments without instantiating anything, which makes it
+        safe to call from worker processes and cheap to pickle: inlined embeddings are converted into float64 arrays.
+        
+        :param filename: Fully qualified path to the snapshot's JSON file
+        
+        :return: Dictionary of constructor arguments. Sidecar embeddings are NOT resolved, see resolve_sidecar()
+        """
         with open( filename, "r" ) as f:
             data = json.load( f )
         
-        return cls( **data )
+        for embeddings in [ data ] + list( data.get( "embeddings_by_namespace", { } ).values() ):
+            for field in SolutionSnapshot.EMBEDDING_FIELDS:
+                if isinstance( embeddings.get( field ), list ) and len( embeddings[ field ] ) > 0:
+                    embeddings[ field ] = np.asarray( embeddings[ field ], dtype=np.float64 )
+        
+        return data
+    
+    @staticmethod
+    def resolve_sidecar( data, directory, mmap=True ):
+        """
+        Snapshots stored in the sidecar format keep their embeddings in float32 .npy files next to the JSON file, one
+        per embedding namespace. This loads the current provider's file, memory mapped by default, and plugs its rows
+        back into the constructor arguments. The other namespaces' files are left on disk, untouched.
+        
+        It also fills in the namespace of the snapshot's embeddings: those that predate embedding providers were all
+        OpenAI's, while ad-hoc snapshots, which never come through here, are assumed to be in the current namespace.
+        
+        ¡OJO! Every memory map holds on to a file descriptor, so bulk loaders should pass mmap=False or they'll run
+        into the open files limit after a thousand or so snapshots. Either way the rows come back read only, which is
+        how _write_sidecar_file() knows that it doesn't need to rewrite them.
+        """
+        namespace = get_embedding_provider().get_namespace()
+        data[ "embedding_namespace" ] = data.get( "embedding_namespace" ) or EmbeddingProvider.DEFAULT_NAMESPACE
+        
+        # Snapshots written before embeddings were kept by namespace point at a single sidecar
+        sidecars         = dict( data.get( "embedding_sidecars" ) or { } )
+        sidecar_file     = data.pop( "embeddings_sidecar", None )
+        embedding_fields = data.pop( "embedding_fields", [ ] )
+        if sidecar_file is not None: sidecars.setdefault( data[ "embedding_namespace" ], { "file": sidecar_file, "fields": embedding_fields } )
+        data[ "embedding_sidecars" ] = sidecars
+        
+        sidecar = sidecars.get( namespace )
+        if sidecar is not None:
+            
+            # Anything still inlined belongs to another namespace, so set it aside w/ the others
+            if data[ "embedding_namespace" ] != namespace:
+                inlined = { field: data.pop( field ) for field in SolutionSnapshot.EMBEDDING_FIELDS if len( data.get( field, [ ] ) ) > 0 }
+                if inlined: data[ "embeddings_by_namespace" ] = { **data.get( "embeddings_by_namespace", { } ), data[ "embedding_namespace" ]: inlined }
+                data[ "embedding_namespace" ] = namespace
+            
+            embeddings = np.load( os.path.join( directory, sidecar[ "file" ] ), mmap_mode="r" if mmap else None )
+            embeddings.flags.writeable = False
+            for row, field in enumerate( sidecar[ "fields" ] ):
+                data[ field ] = embeddings[ row ]
+        
+        return data
+    
+    @staticmethod
+    def get_sidecar_file( solution_file, namespace=None ):
+        """
+        :return: The name of the sidecar holding a namespace's embeddings, e.g. "what-time-is-it-0.npy" for OpenAI's
+        and "what-time-is-it-0.local_all_minilm_l6_v2.npy" for a local model's
+        """
+        base = os.path.splitext( solution_file )[ 0 ]
+        if namespace is None or namespace == EmbeddingProvider.DEFAULT_NAMESPACE: return base + ".npy"
+        
+        return f"{base}.{EmbeddingProvider.get_namespace_slug( namespace )}.npy"
     
     @classmethod
     def create( cls, agent ):
         
         print( "(create_solution_snapshot) TODO: Reconcile how we're going to get a dynamic path to the solution file's directory" )
         
+        # ¡OJO! This doesn't touch the disk: the new snapshot gets its file name, and is written, when it's handed to
+        # SolutionSnapshotManager.add_snapshot()
         # Instantiate a new SolutionSnapshot object using the contents of the calendaring or function mapping agent
         return SolutionSnapshot(
                          question=agent.question,
@@ -226,20 +319,20 @@ class SolutionSnapshot( RunnableCode ):
     
     def get_question_similarity( self, other_snapshot ):
         
-        if not self.question_embedding or not other_snapshot.question_embedding:
+        if len( self.question_embedding ) == 0 or len( other_snapshot.question_embedding ) == 0:
             raise ValueError( "Both snapshots must have a question embedding to compare." )
         return np.dot( self.question_embedding, other_snapshot.question_embedding ) * 100
     
     def get_solution_summary_similarity( self, other_snapshot ):
         
-        if not self.solution_embedding or not other_snapshot.solution_embedding:
+        if len( self.solution_embedding ) == 0 or len( other_snapshot.solution_embedding ) == 0:
             raise ValueError( "Both snapshots must have a solution summary embedding to compare." )
         
         return np.dot( self.solution_embedding, other_snapshot.solution_embedding ) * 100
     
     def get_code_similarity( self, other_snapshot ):
         
-        if not self.code_embedding or not other_snapshot.code_embedding:
+        if len( self.code_embedding ) == 0 or len( other_snapshot.code_embedding ) == 0:
             raise ValueError( "Both snapshots must have a code embedding to compare." )
         
         return np.dot( self.code_embedding, other_snapshot.code_embedding ) * 100
@@ -248,9 +341,72 @@ class SolutionSnapshot( RunnableCode ):
         
         # TODO: decide what we're going to exclude from serialization, and why or why not!
         # Right now I'm just doing this for the sake of expediency as I'm playing with class inheritance for agents
-        fields_to_exclude = [ "prompt_response", "prompt_response_dict", "code_response_dict", "phind_tgi_url", "config_mgr" ]
+        fields_to_exclude = [ "prompt_response", "prompt_response_dict", "code_response_dict", "phind_tgi_url", "config_mgr", "embeddings_generated" ]
+        
+        if self.storage_format == "sidecar":
+            fields_to_exclude += SolutionSnapshot.EMBEDDING_FIELDS + [ "embeddings_by_namespace" ]
+        
         data = { field: value for field, value in self.__dict__.items() if field not in fields_to_exclude }
+        
+        if self.storage_format == "sidecar":
+            data[ "embedding_sidecars" ] = self._get_embedding_sidecars()
+        else:
+            # The current namespace's embeddings are inlined, so a sidecar left over from the sidecar format is stale
+            data[ "embedding_sidecars" ] = { namespace: sidecar for namespace, sidecar in self.embedding_sidecars.items() if namespace != self.embedding_namespace }
+            
+            # Embeddings read from a sidecar are numpy arrays, which json can't serialize
+            data[ "embeddings_by_namespace" ] = { namespace: dict( embeddings ) for namespace, embeddings in self.embeddings_by_namespace.items() }
+            for embeddings in [ data ] + list( data[ "embeddings_by_namespace" ].values() ):
+                for field in SolutionSnapshot.EMBEDDING_FIELDS:
+                    if isinstance( embeddings.get( field ), np.ndarray ): embeddings[ field ] = embeddings[ field ].tolist()
+        
         return json.dumps( data )
+    
+    def _get_embeddings_by_namespace( self ):
+        """
+        :return: Dictionary of populated embeddings by field, by namespace, starting w/ the current one
+        """
+        embeddings_by_namespace = { self.embedding_namespace: { field: getattr( self, field ) for field in SolutionSnapshot.EMBEDDING_FIELDS } }
+        embeddings_by_namespace.update( self.embeddings_by_namespace )
+        
+        return {
+            namespace: { field: embedding for field, embedding in embeddings.items() if len( embedding ) > 0 }
+            for namespace, embeddings in embeddings_by_namespace.items()
+        }
+    
+    def _get_embedding_sidecars( self ):
+        
+        sidecars = dict( self.embedding_sidecars )
+        for namespace, embeddings in self._get_embeddings_by_namespace().items():
+            if embeddings: sidecars[ namespace ] = { "file": SolutionSnapshot.get_sidecar_file( self.solution_file, namespace ), "fields": list( embeddings.keys() ) }
+        
+        return sidecars
+    
+    def _write_sidecar_files( self, directory ):
+        
+        # The current namespace's embeddings, plus any from other namespaces that were inlined, e.g. before this snapshot
+        # was switched to the sidecar format. Sidecars for namespaces that weren't loaded are left alone
+        for namespace, embeddings in self._get_embeddings_by_namespace().items():
+            if embeddings: self._write_sidecar_file( directory, namespace, embeddings )
+    
+    def _write_sidecar_file( self, directory, namespace, embeddings_by_field ):
+        
+        file_path  = f"{directory}{SolutionSnapshot.get_sidecar_file( self.solution_file, namespace )}"
+        
+        # Skip the rewrite when every embedding is still the read only array loaded from this snapshot's sidecar, e.g.
+        # when we're only updating runtime stats. Freshly generated embeddings are lists, so they always get written
+        unchanged  = all( isinstance( embedding, np.ndarray ) and not embedding.flags.writeable for embedding in embeddings_by_field.values() )
+        if unchanged and os.path.isfile( file_path ): return
+        
+        embeddings = np.stack( [ np.asarray( embedding, dtype=np.float32 ) for embedding in embeddings_by_field.values() ] )
+        
+        # ¡OJO! Write to a temp file and rename it into place: truncating a file that's currently memory mapped by a
+        # loaded snapshot would pull the rug out from under it, whereas a rename leaves the old mapping intact
+        temp_path  = file_path + ".tmp"
+        with open( temp_path, "wb" ) as f:
+            np.save( f, embeddings )
+        os.replace( temp_path, file_path )
+        os.chmod( file_path, 0o666 )
         
     def get_copy( self ):
         return copy.copy( self )
@@ -266,6 +422,8 @@ class SolutionSnapshot( RunnableCode ):
         # Define the directory where the file will be saved
         directory = f"{project_root}{self.solution_directory}"
         
+        # Snapshots persisted via SolutionSnapshotWriter already have a file name from its in-memory index, so this glob
+        # only runs when we're called directly, e.g. from a script
         if self.solution_file is None:
             
             print( "NO solution_file value provided (Must be a new object). Generating a unique file name..." )
@@ -287,9 +445,14 @@ class SolutionSnapshot( RunnableCode ):
         file_path = f"{directory}{self.solution_file}"
         # Print the file path for debugging purposes
         print( f"File path: {file_path}", end="\n\n" )
-        # Write the JSON string to the file
-        with open( file_path, "w" ) as f:
+        # Embeddings go first, so that the JSON file never points at a sidecar that doesn't exist yet
+        if self.storage_format == "sidecar": self._write_sidecar_files( directory )
+        
+        # Write the JSON string to a temp file and rename it into place, so that a crash mid write can't leave a truncated snapshot behind
+        temp_path = file_path + ".tmp"
+        with open( temp_path, "w" ) as f:
             f.write( self.to_jsons() )
+        os.replace( temp_path, file_path )
         
         # Set the file permissions to world-readable and writable
         os.chmod( file_path, 0o666 )
@@ -304,6 +467,15 @@ class SolutionSnapshot( RunnableCode ):
             print( f"Deleted file [{file_path}]" )
         else:
             print( f"File [{file_path}] does not exist" )
+        
+        # Every namespace's sidecar, whether or not its embeddings were loaded
+        sidecar_files = { sidecar[ "file" ] for sidecar in self._get_embedding_sidecars().values() }
+        sidecar_files.add( SolutionSnapshot.get_sidecar_file( self.solution_file, self.embedding_namespace ) )
+        for sidecar_file in sidecar_files:
+            sidecar_path = f"{du.get_project_root()}{self.solution_directory}{sidecar_file}"
+            if os.path.isfile( sidecar_path ):
+                os.remove( sidecar_path )
+                print( f"Deleted file [{sidecar_path}]" )
             
     def update_runtime_stats( self, timer ) -> None:
         """
@@ -326,6 +498,7 @@ class SolutionSnapshot( RunnableCode ):
             self.runtime_stats[ "last_run_ms"   ]  = delta_ms
             self.runtime_stats[ "time_saved_ms" ]  = ( self.runtime_stats[ "first_run_ms" ] * self.runtime_stats[ "run_count" ] ) - self.runtime_stats[ "total_ms" ]
     
+    @job_stage( "code" )
     def run_code( self, debug=False, verbose=False ):
         
         if self.routing_command == "agent router go to todo list":
@@ -347,6 +520,7 @@ class SolutionSnapshot( RunnableCode ):
         
         return self.code_response_dict
     
+    @job_stage( "formatter" )
     def format_output( self ):
         
         formatter                  = RawOutputFormatter( self.last_question_asked, self.answer, self.routing_command, debug=self.debug, verbose=self.verbose )
@@ -1,29 +1,74 @@
 import os
+import pickle
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
 
 import lib.utils.util as du
 from lib.memory import solution_snapshot as ss
 # from lib.memory.question_embeddings_dict import QuestionEmbeddingsDict
-from lib.memory.question_embeddings_table import QuestionEmbeddingsTable
+from lib.memory.lancedb_registry          import get_lancedb_registry
+from lib.memory.solution_snapshot_writer  import SolutionSnapshotWriter
+from lib.memory.embedding_provider        import get_embedding_provider
+from lib.memory.ann_embedding_index       import get_embedding_index, get_recall_report, print_recall_report
+from lib.utils.util_stopwatch             import Stopwatch
 
 
 class SolutionSnapshotManager:
-    def __init__( self, path, debug=False, verbose=False ):
+    
+    # Worst case disagreement, on a 0-100 scale, between float32 matrix scores and float64 snapshot scores
+    FLOAT32_SCORE_SLACK = 0.01
+    
+    # Below this many files to parse, spinning up worker processes costs more than it saves
+    MIN_FILES_FOR_PARALLEL_LOAD = 256
+    
+    def __init__( self, path, similarity_backend="exact", similarity_nprobe=8, similarity_ef=64, exact_search_threshold=10000,
+                  load_workers=None, use_manifest_cache=True, debug=False, verbose=False ):
         
         self.debug                             = debug
         self.verbose                           = verbose
         self.path                              = path
+        self.load_workers                      = load_workers if load_workers is not None else os.cpu_count()
+        
+        # Pre-parsed snapshot files, keyed by file path and validated by modification time and size
+        self.manifest_path                     = os.path.join( os.path.dirname( path.rstrip( "/" ) ), "solutions-manifest.pkl" ) if use_manifest_cache else None
        
         self.snapshots_by_question             = None
         self.snapshots_by_synomymous_questions = None
         self.question_embeddings_tbl           = None
         
+        # Similarity indexes for question and code embeddings, persisted next to the solutions directory. The exact
+        # backend is a contiguous float32 matrix, the approximate ones (ivf, hnsw) fall back to it below a size threshold.
+        # Each embedding provider gets its own indexes, since both their dimensions and their vectors differ
+        provider     = get_embedding_provider()
+        ann_path     = os.path.join( os.path.dirname( path.rstrip( "/" ) ), provider.get_table_name( "solutions-ann" ) )
+        index_kwargs = dict( dimensions=provider.dimensions, nprobe=similarity_nprobe, ef=similarity_ef, exact_search_threshold=exact_search_threshold, debug=debug )
+        self.question_embeddings_idx           = get_embedding_index( similarity_backend, save_path=os.path.join( ann_path, "question" ), **index_kwargs )
+        self.code_embeddings_idx               = get_embedding_index( similarity_backend, save_path=os.path.join( ann_path, "code" ), **index_kwargs )
+        # Reverse index of blacklisted (non synonymous) questions
+        self.snapshot_questions_by_non_synonymous_question = { }
+        
+        # Retraining the IVF centroids, or saving the HNSW graph, takes seconds on a big index, so after the initial load
+        # it's done by a single background thread. Requests made while one's already queued are folded into that one
+        self._index_maintenance                = ThreadPoolExecutor( max_workers=1, thread_name_prefix="SnapshotIndexMaintenance" )
+        self._index_maintenance_lock           = threading.Lock()
+        self._index_maintenance_queued         = False
+        
+        # Snapshots are persisted in the background, so that the job run loop never waits on the disk
+        self.snapshot_writer                   = SolutionSnapshotWriter( path, debug=debug, verbose=verbose )
+        
         self.load_snapshots()
         
     def load_snapshots( self ):
         
         self.snapshots_by_question             = self.load_snapshots_by_question()
         self.snapshots_by_synomymous_questions = self.get_snapshots_by_synomymous_questions( self.snapshots_by_question )
-        self.question_embeddings_tbl           = QuestionEmbeddingsTable()
+        self.question_embeddings_tbl           = get_lancedb_registry().get_question_embeddings_table()
+        
+        self._rebuild_indexes()
+        self.snapshot_writer.refresh_file_index()
         
         if self.debug:
             print( self )
@@ -32,18 +77,98 @@ class SolutionSnapshotManager:
     def load_snapshots_by_question( self ):
         
         snapshots_by_question = { }
-        if self.debug: print( f"Loading snapshots from [{self.path}]..." )
+        timer = Stopwatch( msg=f"Loading snapshots from [{self.path}]...", silent=not self.debug )
         
         filtered_files = [ file for file in os.listdir( self.path ) if not file.startswith( "._" ) and file.endswith( ".json" ) ]
-        if self.debug: du.print_list( filtered_files )
+        if self.debug and self.verbose: du.print_list( filtered_files )
         
+        # Only the files that are new or have changed since the manifest was written need to be parsed
+        manifest      = self._read_manifest()
+        new_manifest  = { }
+        files_to_read = [ ]
         for file in filtered_files:
             json_file = os.path.join( self.path, file )
-            snapshot = ss.SolutionSnapshot.from_json_file( json_file, debug=self.debug )
+            signature = self._get_file_signature( json_file )
+            if json_file in manifest and manifest[ json_file ][ 0 ] == signature:
+                new_manifest[ json_file ] = manifest[ json_file ]
+            else:
+                files_to_read.append( ( json_file, signature ) )
+        
+        signatures = dict( files_to_read )
+        for json_file, data in self._read_snapshot_files( list( signatures.keys() ) ):
+            new_manifest[ json_file ] = ( signatures[ json_file ], self._to_float32( data ) )
+        
+        for file in filtered_files:
+            json_file = os.path.join( self.path, file )
+            data      = ss.SolutionSnapshot.resolve_sidecar( dict( new_manifest[ json_file ][ 1 ] ), self.path, mmap=False )
+            snapshot  = ss.SolutionSnapshot( **data )
             snapshots_by_question[ snapshot.question ] = snapshot
-    
+            
+            # Embeddings that were missing from the file, and generated while loading, are written back in the background
+            if snapshot.embeddings_generated: self.save_snapshot( snapshot )
+        
+        # Only rewrite the manifest if something was added, changed or removed
+        if files_to_read or len( new_manifest ) != len( manifest ): self._write_manifest( new_manifest )
+        
+        timer.print( f"Done! [{len( filtered_files )}] snapshots, [{len( files_to_read )}] parsed, [{len( filtered_files ) - len( files_to_read )}] from manifest", use_millis=True )
+        
         return snapshots_by_question
     
+    def _read_snapshot_files( self, json_files ):
+        
+        if len( json_files ) < self.MIN_FILES_FOR_PARALLEL_LOAD or self.load_workers <= 1:
+            return [ ( json_file, ss.SolutionSnapshot.read_json_file( json_file ) ) for json_file in json_files ]
+        
+        if self.debug: print( f"Parsing [{len( json_files )}] snapshot files using [{self.load_workers}] worker processes..." )
+        chunksize = max( 1, len( json_files ) // ( self.load_workers * 4 ) )
+        with ProcessPoolExecutor( max_workers=self.load_workers ) as executor:
+            return list( zip( json_files, executor.map( ss.SolutionSnapshot.read_json_file, json_files, chunksize=chunksize ) ) )
+    
+    def _get_file_signature( self, json_file ):
+        
+        # Sidecar embeddings live in a separate file, one per namespace, so the current namespace's has to be part of the signature too
+        stat         = os.stat( json_file )
+        sidecar_file = os.path.join( self.path, ss.SolutionSnapshot.get_sidecar_file( os.path.basename( json_file ), get_embedding_provider().get_namespace() ) )
+        sidecar_stat = os.stat( sidecar_file ) if os.path.isfile( sidecar_file ) else None
+        
+        return ( stat.st_mtime_ns, stat.st_size, None if sidecar_stat is None else ( sidecar_stat.st_mtime_ns, sidecar_stat.st_size ) )
+    
+    @staticmethod
+    def _to_float32( data ):
+        """
+        Inlined embeddings are parsed into float64 arrays, which would double the size of the manifest, and of the time
+        it takes to unpickle it, for digits that the float32 similarity matrix and sidecar files drop anyway.
+        Sidecar embeddings aren't in the manifest at all, just the names of their files.
+        """
+        for embeddings in [ data ] + list( data.get( "embeddings_by_namespace", { } ).values() ):
+            for field in ss.SolutionSnapshot.EMBEDDING_FIELDS:
+                if isinstance( embeddings.get( field ), np.ndarray ): embeddings[ field ] = embeddings[ field ].astype( np.float32, copy=False )
+        
+        return data
+    
+    def _read_manifest( self ):
+        
+        if self.manifest_path is None or not os.path.isfile( self.manifest_path ): return { }
+        
+        try:
+            with open( self.manifest_path, "rb" ) as f:
+                return pickle.load( f )
+        except Exception as e:
+            du.print_stack_trace( e, explanation="Reading manifest failed, ignoring it", caller="SolutionSnapshotManager._read_manifest()" )
+            return { }
+    
+    def _write_manifest( self, manifest ):
+        
+        if self.manifest_path is None: return
+        
+        # Write to a temp file and rename it into place so that a crash mid write can't leave a corrupt manifest behind
+        temp_path = self.manifest_path + ".tmp"
+        with open( temp_path, "wb" ) as f:
+            pickle.dump( manifest, f, protocol=pickle.HIGHEST_PROTOCOL )
+        os.replace( temp_path, self.manifest_path )
+        
+        if self.debug: print( f"Wrote manifest w/ [{len( manifest )}] snapshots to [{self.manifest_path}]" )
+    
     def get_snapshots_by_synomymous_questions( self, snapshots_by_question ):
         
         snapshots_by_synomymous_questions = { }
@@ -60,10 +185,76 @@ class SolutionSnapshotManager:
         print()
         return snapshots_by_synomymous_questions
     
+    def _rebuild_indexes( self ):
+        
+        # Approximate indexes reuse what they've persisted, if it's still current, and (re)build it otherwise
+        snapshots = list( self.snapshots_by_question.values() )
+        self.question_embeddings_idx.rebuild( ( snapshot.question, snapshot.question_embedding ) for snapshot in snapshots )
+        self.code_embeddings_idx.rebuild( ( snapshot.question, snapshot.code_embedding ) for snapshot in snapshots )
+        
+        self.snapshot_questions_by_non_synonymous_question = { }
+        for snapshot in snapshots:
+            for question in snapshot.non_synonymous_questions:
+                self.snapshot_questions_by_non_synonymous_question.setdefault( question, set() ).add( snapshot.question )
+            
+        if self.debug: print( f"Indexed [{len( self.question_embeddings_idx )}] question and [{len( self.code_embeddings_idx )}] code embeddings" )
+    
+    def _index_snapshot( self, snapshot ):
+        
+        self.question_embeddings_idx.add( snapshot.question, snapshot.question_embedding )
+        self.code_embeddings_idx.add( snapshot.question, snapshot.code_embedding )
+        
+        for question in snapshot.non_synonymous_questions:
+            self.snapshot_questions_by_non_synonymous_question.setdefault( question, set() ).add( snapshot.question )
+    
+    def _unindex_snapshot( self, snapshot ):
+        
+        self.question_embeddings_idx.remove( snapshot.question )
+        self.code_embeddings_idx.remove( snapshot.question )
+        
+        for question in snapshot.non_synonymous_questions:
+            blacklisted_by = self.snapshot_questions_by_non_synonymous_question.get( question, set() )
+            blacklisted_by.discard( snapshot.question )
+            if not blacklisted_by: self.snapshot_questions_by_non_synonymous_question.pop( question, None )
+    
     def add_snapshot( self, snapshot ):
         
+        # If we're replacing an existing snapshot, then drop its stale index entries first
+        if snapshot.question in self.snapshots_by_question:
+            self._unindex_snapshot( self.snapshots_by_question[ snapshot.question ] )
+        
         self.snapshots_by_question[ snapshot.question ] = snapshot
-        snapshot.write_current_state_to_file()
+        self._index_snapshot( snapshot )
+        self._schedule_index_maintenance()
+        self.save_snapshot( snapshot )
+    
+    def _schedule_index_maintenance( self ):
+        
+        with self._index_maintenance_lock:
+            if self._index_maintenance_queued: return
+            self._index_maintenance_queued = True
+        
+        self._index_maintenance.submit( self._maintain_indexes )
+    
+    def _maintain_indexes( self ):
+        
+        # Cleared before we start, so that changes made while we're at it get a pass of their own
+        with self._index_maintenance_lock:
+            self._index_maintenance_queued = False
+        
+        for idx in [ self.question_embeddings_idx, self.code_embeddings_idx ]:
+            try:
+                idx.maintain()
+            except Exception as e:
+                du.print_stack_trace( e, explanation="Similarity index maintenance failed", caller="SolutionSnapshotManager._maintain_indexes()" )
+    
+    def save_snapshot( self, snapshot ):
+        """
+        Queues the snapshot's current state to be written to disk in the background. Repeated saves of the same
+        snapshot are coalesced, and writes are atomic.
+        """
+        self.snapshot_writer.enqueue( snapshot )
+        snapshot.embeddings_generated = False
     
     # ¡OJO! Doesn't appear to be called by anything
     # get the questions embedding if it exists otherwise generate it and add it to the dictionary
@@ -87,15 +278,19 @@ class SolutionSnapshotManager:
         question = ss.SolutionSnapshot.remove_non_alphabetics( question )
         
         if self.question_exists( question ):
+            snapshot = self.snapshots_by_question[ question ]
+            # Don't let a queued write resurrect the file that we're about to delete
+            self.snapshot_writer.discard( snapshot )
             if delete_file:
                 print( f"Deleting snapshot file [{question}]...", end="" )
-                snapshot = self.snapshots_by_question[ question ]
                 snapshot.delete_file()
                 print( "Done!" )
-            return True
             print( f"Deleting snapshot from manager [{question}]...", end="" )
+            self._unindex_snapshot( snapshot )
             del self.snapshots_by_question[ question ]
+            self._schedule_index_maintenance()
             print( "Done!" )
+            return True
         else:
             print( f"Snapshot with question [{question}] does not exist!" )
             return False
@@ -104,32 +299,36 @@ class SolutionSnapshotManager:
         
         print( f"get_snapshots_by_question_similarity( '{question}' )..." )
         # Generate the embedding for the question, if it doesn't already exist
-        if not self.question_embeddings_tbl.has( question ):
-            question_embedding = ss.SolutionSnapshot.generate_embedding( question )
-            self.question_embeddings_tbl.add_embedding( question, question_embedding )
-        else:
-            print( f"Embedding for question [{question}] already exists!" )
-            question_embedding = self.question_embeddings_tbl.get_embedding( question )
-            
-        question_snapshot  = ss.SolutionSnapshot( question=question, question_embedding=question_embedding )
-        similar_snapshots  = [ ]
+        question_embedding = self.question_embeddings_tbl.get_or_create_embedding( question )
         
-        for snapshot in self.snapshots_by_question.values():
-            
-            if exclude_non_synonymous_questions and question in snapshot.non_synonymous_questions:
-                if self.debug:
+        # ¡OJO! The embedding came from the current provider, so say so, lest the snapshot set it aside and re-embed the question
+        question_snapshot  = ss.SolutionSnapshot( question=question, question_embedding=question_embedding, embedding_namespace=get_embedding_provider().get_namespace() )
+        
+        exclude_questions  = set()
+        if exclude_non_synonymous_questions:
+            exclude_questions = self.snapshot_questions_by_non_synonymous_question.get( question, set() )
+            if self.debug:
+                for snapshot_question in exclude_questions:
                     du.print_banner( f"Snapshot [{question}] is in the NON synonymous list!", prepend_nl=True)
-                    print( f"Snapshot [{question}] has been blacklisted by [{snapshot.question}]" )
-                    print( "Continuing to next snapshot..." )
-                continue
-                
+                    print( f"Snapshot [{question}] has been blacklisted by [{snapshot_question}]" )
+        
+        # One matrix-vector product over all question embeddings, followed by a partial sort. ¡OJO! We over fetch a bit
+        # and loosen the threshold because the float32 matrix can disagree in the last few digits with the float64 dot
+        # products calculated by SolutionSnapshot, which we use below to score the survivors so that results don't change
+        candidates = self.question_embeddings_idx.get_top_k(
+            question_embedding, threshold=threshold - self.FLOAT32_SCORE_SLACK, k=limit * 2 if limit > 0 else -1, exclude_keys=exclude_questions
+        )
+        similar_snapshots = [ ]
+        for _, snapshot_question in candidates:
+            
+            snapshot         = self.snapshots_by_question[ snapshot_question ]
             similarity_score = snapshot.get_question_similarity( question_snapshot )
             
             if similarity_score >= threshold:
                 similar_snapshots.append( ( similarity_score, snapshot ) )
                 if self.debug and self.verbose: print( f"Score [{similarity_score:.1f}]% for question [{snapshot.question}] IS similar enough to [{question}]" )
-            else:
-                if self.debug: print( f"Score [{similarity_score:.1f}]% for question [{snapshot.question}] is NOT similar enough to [{question}]" )
+        
+        if self.debug: print( f"[{len( self.question_embeddings_idx ) - len( similar_snapshots )}] snapshots are NOT similar enough to [{question}]" )
         
         # Sort by similarity score, descending
         similar_snapshots.sort( key=lambda x: x[ 0 ], reverse=True )
@@ -156,8 +355,16 @@ class SolutionSnapshotManager:
             for line in exemplar_snapshot.code: print( line )
             print()
         
-        for snapshot in self.snapshots_by_question.values():
+        if len( exemplar_snapshot.code_embedding ) == 0:
+            raise ValueError( "Both snapshots must have a code embedding to compare." )
+        
+        # Same approach as get_snapshots_by_question_similarity(): a vectorized search for candidates, followed by exact rescoring
+        candidates = self.code_embeddings_idx.get_top_k(
+            exemplar_snapshot.code_embedding, threshold=threshold - self.FLOAT32_SCORE_SLACK, k=limit * 2 if limit > 0 else -1
+        )
+        for _, snapshot_question in candidates:
             
+            snapshot           = self.snapshots_by_question[ snapshot_question ]
             similarity_score   = snapshot.get_code_similarity( exemplar_snapshot )
             question_truncated = du.truncate_string( snapshot.question, max_len=32 )
             
@@ -169,9 +376,6 @@ class SolutionSnapshotManager:
                     for line in snapshot.code:
                         print( line )
                     print()
-            else:
-                if self.debug:
-                    print( f"Code score [{similarity_score}] for snapshot [{question_truncated}] is NOT similar to the provided code", end="\n" )
             
         # Sort by similarity score, descending
         similar_snapshots.sort( key=lambda x: x[ 0 ], reverse=True )
@@ -218,6 +422,22 @@ class SolutionSnapshotManager:
             
         return similar_snapshots
         
+    def get_similarity_recall_report( self, sample_size=100, thresholds=( 85.0, 90.0, 92.5, 95.0 ), k=7, seed=42 ):
+        """
+        Measures how closely the approximate question index agrees with an exact scan, using a sample of the snapshots'
+        own question embeddings as queries. Use it to tune snapshot_similiarity_threshold and the nprobe/ef settings.
+        
+        :return: List of dictionaries, one per threshold
+        """
+        questions = list( self.snapshots_by_question.keys() )
+        random.Random( seed ).shuffle( questions )
+        queries   = [ self.snapshots_by_question[ question ].question_embedding for question in questions[ :sample_size ] ]
+        
+        report    = get_recall_report( self.question_embeddings_idx, queries, thresholds=thresholds, k=k )
+        print_recall_report( report )
+        
+        return report
+    
     def __str__( self ):
         
         return f"[{len( self.snapshots_by_question )}] snapshots by question loaded from [{self.path}]"
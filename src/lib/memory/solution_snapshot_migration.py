@@ -0,0 +1,94 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+import lib.utils.util as du
+from lib.memory.embedding_provider import EmbeddingProvider
+from lib.memory.solution_snapshot  import SolutionSnapshot
+from lib.utils.util_stopwatch      import Stopwatch
+
+
+def migrate_to_sidecar( path, dry_run=False, debug=False ):
+    """
+    One-shot migration of a solutions directory from JSON files with inlined embeddings to the sidecar format: JSON
+    metadata plus float32 .npy files holding the embeddings, one file per embedding namespace and one row per
+    populated embedding field.
+
+    This operates on the raw JSON, it doesn't instantiate SolutionSnapshot objects, so it never generates embeddings
+    or touches anything but the files themselves. Files that have already been migrated are skipped.
+
+    :param path: Fully qualified path to the solutions directory
+
+    :param dry_run: Report what would be migrated without writing anything
+
+    :return: Dictionary of counts and byte sizes, before and after
+    """
+    timer = Stopwatch( msg=f"Migrating solution snapshots in [{path}] to the sidecar format..." )
+    stats = { "migrated": 0, "skipped": 0, "bytes_before": 0, "bytes_after": 0 }
+
+    filtered_files = [ file for file in os.listdir( path ) if not file.startswith( "._" ) and file.endswith( ".json" ) ]
+
+    for file in filtered_files:
+
+        json_path = os.path.join( path, file )
+        with open( json_path, "r" ) as f:
+            data = json.load( f )
+
+        if data.get( "storage_format" ) == "sidecar" or "embeddings_sidecar" in data:
+            stats[ "skipped" ] += 1
+            continue
+
+        # The inlined embeddings, which are OpenAI's if they don't say otherwise, plus any set aside from other namespaces
+        embeddings_by_namespace = { data.get( "embedding_namespace" ) or EmbeddingProvider.DEFAULT_NAMESPACE: data }
+        embeddings_by_namespace.update( data.pop( "embeddings_by_namespace", { } ) )
+
+        sidecars     = dict( data.get( "embedding_sidecars" ) or { } )
+        sidecar_rows = { }
+        for namespace, embeddings in embeddings_by_namespace.items():
+            fields = [ field for field in SolutionSnapshot.EMBEDDING_FIELDS if len( embeddings.get( field, [ ] ) ) > 0 ]
+            if not fields: continue
+            sidecars[ namespace ]     = { "file": SolutionSnapshot.get_sidecar_file( file, namespace ), "fields": fields }
+            sidecar_rows[ namespace ] = [ embeddings[ field ] for field in fields ]
+
+        for field in SolutionSnapshot.EMBEDDING_FIELDS: data.pop( field, None )
+        data[ "storage_format"     ] = "sidecar"
+        data[ "embedding_sidecars" ] = sidecars
+
+        stats[ "bytes_before" ] += os.path.getsize( json_path )
+        stats[ "migrated"     ] += 1
+        if debug: print( f"Migrating [{file}] w/ embeddings { { namespace: sidecar[ 'fields' ] for namespace, sidecar in sidecars.items() } }" )
+        if dry_run: continue
+
+        # Sidecars first, then the JSON that points to them, all written via rename so a crash can't leave half a file
+        sidecar_paths = [ ]
+        for namespace, rows in sidecar_rows.items():
+            sidecar_path = os.path.join( path, sidecars[ namespace ][ "file" ] )
+            with open( sidecar_path + ".tmp", "wb" ) as f:
+                np.save( f, np.asarray( rows, dtype=np.float32 ) )
+            os.replace( sidecar_path + ".tmp", sidecar_path )
+            sidecar_paths.append( sidecar_path )
+
+        with open( json_path + ".tmp", "w" ) as f:
+            f.write( json.dumps( data ) )
+        os.replace( json_path + ".tmp", json_path )
+
+        for file_path in [ json_path ] + sidecar_paths: os.chmod( file_path, 0o666 )
+        stats[ "bytes_after" ] += sum( os.path.getsize( file_path ) for file_path in [ json_path ] + sidecar_paths )
+
+    timer.print( f"Done! Migrated [{stats[ 'migrated' ]}], skipped [{stats[ 'skipped' ]}]", use_millis=True )
+    if not dry_run and stats[ "migrated" ] > 0:
+        print( f"Bytes on disk before [{stats[ 'bytes_before' ]:,}] after [{stats[ 'bytes_after' ]:,}]" )
+
+    return stats
+
+
+if __name__ == "__main__":
+
+    # Usage: python -m lib.memory.solution_snapshot_migration [path_to_solutions_dir] [--dry-run]
+    args    = [ arg for arg in sys.argv[ 1: ] if not arg.startswith( "--" ) ]
+    path    = args[ 0 ] if args else du.get_project_root() + "/src/conf/long-term-memory/solutions/"
+    dry_run = "--dry-run" in sys.argv
+
+    migrate_to_sidecar( path, dry_run=dry_run, debug=True )
@@ -0,0 +1,155 @@
+import atexit
+import os
+import threading
+from collections import OrderedDict
+
+import lib.utils.util as du
+
+
+class SolutionSnapshotWriter:
+    """
+    Write-behind persistence for solution snapshots.
+
+    Callers enqueue a snapshot and return immediately, while a background thread writes it to disk. Repeated writes
+    of the same snapshot file that pile up before the thread gets to them are coalesced into a single write of the
+    most recent state. Unique file names for new snapshots come from an in-memory index of the solutions directory,
+    rather than from a glob of the directory per new snapshot.
+    """
+    def __init__( self, path, debug=False, verbose=False ):
+
+        self.debug            = debug
+        self.verbose          = verbose
+        self.path             = path
+
+        self._pending         = OrderedDict()
+        self._condition       = threading.Condition()
+        self._in_flight       = 0
+        self._stopped         = False
+
+        self.writes_requested = 0
+        self.writes_completed = 0
+
+        self._file_counts_by_base = self._get_file_counts_by_base()
+
+        self._thread = threading.Thread( target=self._enter_write_loop, name="SolutionSnapshotWriter", daemon=True )
+        self._thread.start()
+
+        # Don't lose queued writes when the server shuts down
+        atexit.register( self.stop )
+
+    def _get_file_counts_by_base( self ):
+
+        # Mirrors the naming scheme in SolutionSnapshot.write_current_state_to_file(): "{filename_base}-{count}.json"
+        file_counts_by_base = { }
+        if not os.path.isdir( self.path ): return file_counts_by_base
+
+        for file in os.listdir( self.path ):
+            if file.startswith( "._" ) or not file.endswith( ".json" ) or "-" not in file: continue
+            filename_base, count = file[ :-len( ".json" ) ].rsplit( "-", 1 )
+            if count.isdigit():
+                file_counts_by_base[ filename_base ] = max( file_counts_by_base.get( filename_base, 0 ), int( count ) + 1 )
+
+        return file_counts_by_base
+
+    def refresh_file_index( self ):
+        """
+        Rebuilds the file name index from the solutions directory, e.g. after files were added behind our back.
+        """
+        file_counts_by_base = self._get_file_counts_by_base()
+        with self._condition:
+            # Never hand out a name that we've already given to a snapshot whose write is still pending
+            for filename_base, count in self._file_counts_by_base.items():
+                file_counts_by_base[ filename_base ] = max( file_counts_by_base.get( filename_base, 0 ), count )
+            self._file_counts_by_base = file_counts_by_base
+    
+    def assign_solution_file( self, snapshot ):
+        """
+        Gives a new snapshot a unique file name, without touching the file system.
+
+        :return: The snapshot's solution file name
+        """
+        if snapshot.solution_file is None:
+
+            filename_base = du.truncate_string( snapshot.question, max_len=64 ).replace( " ", "-" )
+            with self._condition:
+                file_count = self._file_counts_by_base.get( filename_base, 0 )
+                self._file_counts_by_base[ filename_base ] = file_count + 1
+
+            snapshot.solution_file = f"{filename_base}-{file_count}.json"
+
+        return snapshot.solution_file
+
+    def enqueue( self, snapshot ):
+        """
+        Queues the snapshot's current state to be written to disk by the background thread.
+
+        :return: None
+        """
+        self.assign_solution_file( snapshot )
+
+        # Snapshot the snapshot: the run loop keeps mutating the live object, e.g. its runtime stats and synonymous
+        # questions, so we hand a private copy of the mutable bits to the writer thread
+        state = snapshot.get_copy()
+        state.runtime_stats            = dict( snapshot.runtime_stats )
+        state.synonymous_questions     = OrderedDict( snapshot.synonymous_questions )
+        state.non_synonymous_questions = list( snapshot.non_synonymous_questions )
+
+        with self._condition:
+            # Coalesce: only the most recent state of each file gets written
+            self._pending.pop( state.solution_file, None )
+            self._pending[ state.solution_file ] = state
+            self.writes_requested += 1
+            self._condition.notify()
+
+    def discard( self, snapshot ):
+        """
+        Drops any queued writes for this snapshot, e.g. because it's being deleted.
+        """
+        with self._condition:
+            self._pending.pop( snapshot.solution_file, None )
+
+    def flush( self, timeout=None ):
+        """
+        Blocks until every queued write has hit the disk.
+
+        :return: True if the queue was drained, False if we timed out
+        """
+        with self._condition:
+            return self._condition.wait_for( lambda: not self._pending and self._in_flight == 0, timeout=timeout )
+
+    def stop( self, timeout=10 ):
+
+        self.flush( timeout=timeout )
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def get_stats( self ):
+
+        with self._condition:
+            return {
+                "pending"  : len( self._pending ),
+                "requested": self.writes_requested,
+                "completed": self.writes_completed,
+                "coalesced": self.writes_requested - self.writes_completed - len( self._pending ) - self._in_flight
+            }
+
+    def _enter_write_loop( self ):
+
+        while True:
+
+            with self._condition:
+                self._condition.wait_for( lambda: self._pending or self._stopped )
+                if self._stopped and not self._pending: return
+                _, state = self._pending.popitem( last=False )
+                self._in_flight += 1
+
+            try:
+                state.write_current_state_to_file()
+            except Exception as e:
+                du.print_stack_trace( e, explanation=f"Writing [{state.solution_file}] failed", caller="SolutionSnapshotWriter._enter_write_loop()" )
+            finally:
+                with self._condition:
+                    self._in_flight       -= 1
+                    self.writes_completed += 1
+                    self._condition.notify_all()
@@ -1,6 +1,8 @@
 import os
+import tempfile
+import threading
 from collections import Counter
-from subprocess import PIPE, run
+from subprocess import PIPE, CompletedProcess, Popen, TimeoutExpired
 
 debug = os.getenv( "GIB_CODE_EXEC_DEBUG", "False" ) == "True"
 
@@ -10,6 +12,7 @@ debug = os.getenv( "GIB_CODE_EXEC_DEBUG", "False" ) == "True"
 #     for path in sys.path: print( path )
 
 import lib.utils.util as du
+from lib.app.job_context import get_current_job_context
 
 @staticmethod
 def initialize_code_response_dict():
@@ -207,7 +210,39 @@ def _remove_consecutive_empty_strings( strings ):
             
     return result
 
-def assemble_and_run_solution( solution_code, example_code, path_to_df=None, solution_code_returns="string", python_runtime="python3", debug=False, verbose=False, inject_bugs=False ):
+# Code that reads and rewrites the same data file, e.g. todo.csv, whether it's an agent's or a cached solution's, runs
+# one at a time, so that one run can't read the file while another's halfway through rewriting it
+_data_file_locks      = { }
+_data_file_locks_lock = threading.Lock()
+
+def _get_data_file_lock( path_to_df ):
+    
+    with _data_file_locks_lock:
+        return _data_file_locks.setdefault( path_to_df, threading.Lock() )
+
+def remove_code_file( code_path ):
+    """
+    Removes a file kept by assemble_and_run_solution( keep_code=True ), once whoever asked for it is done w/ it.
+    
+    :param code_path: The "code_path" from the response dictionary, relative to the project root
+    """
+    # Hang on to the code when debugging, so that it can be rerun by hand
+    if debug or code_path is None: return
+    
+    try:
+        os.remove( du.get_project_root() + code_path )
+    except FileNotFoundError:
+        pass
+
+def assemble_and_run_solution( solution_code, example_code, path_to_df=None, solution_code_returns="string", python_runtime="python3", debug=False, verbose=False, inject_bugs=False, keep_code=False ):
+    """
+    Assembles the solution code into a runnable script, runs it in its own process and returns what it printed.
+    
+    :param keep_code: Leave the script on disk after it's run, e.g. for the iterative debugger, which reads it back from
+    the response dictionary's "code_path". The caller removes it w/ remove_code_file() when it's done
+    
+    :return: Dictionary w/ the "return_code", the "output" and the "code_path" of the script, relative to the project root
+    """
     
     if debug and verbose:
         du.print_banner( "Solution code BEFORE:", prepend_nl=True)
@@ -231,17 +266,47 @@ def assemble_and_run_solution( solution_code, example_code, path_to_df=None, sol
         response_dict = bug_injector.run_prompt()
         solution_code = response_dict[ "code" ]
         
-    code_path = du.get_project_root() + "/io/code.py"
+    # Every run gets its own file: jobs run concurrently, and a shared io/code.py could be overwritten by another job
+    # between being written and being run
+    io_path       = du.get_project_root() + "/io"
+    fd, code_path = tempfile.mkstemp( prefix="code-", suffix=".py", dir=io_path )
+    os.close( fd )
     du.write_lines_to_file( code_path, solution_code )
     
-    # Stash current working directory, so we can return to it after code has finished executing
-    original_wd = os.getcwd()
-    os.chdir( du.get_project_root() + "/io" )
-    
     if debug: print( "Code runner executing [{}]... ".format( code_path ), end="" )
     
-    # ¡OJO! Hardcoded value of python runtime... Make this runtime configurable
-    results = run( [ python_runtime, code_path ], stdout=PIPE, stderr=PIPE, universal_newlines=True )
+    # Run from the io directory via cwd, rather than os.chdir(), which is process wide and would pull the rug out from
+    # under any other job running at the same time. If we're running as part of a job, the job's code stage deadline
+    # applies, and cancelling the job kills the process
+    job_context = get_current_job_context()
+    timeout     = None if job_context is None else job_context.get_remaining_secs()
+    
+    # Waiting for another run of code that uses the same data file counts against the deadline too
+    data_file_lock = None if path_to_df is None else _get_data_file_lock( path_to_df )
+    locked         = False
+    try:
+        if data_file_lock is not None:
+            locked = data_file_lock.acquire( timeout=-1 if timeout is None else timeout )
+            if not locked: raise TimeoutError( f"Code [{code_path}] waited longer than [{timeout:.1f}] secs for [{path_to_df}], not run" )
+        try:
+            # ¡OJO! Hardcoded value of python runtime... Make this runtime configurable
+            process = Popen( [ python_runtime, code_path ], cwd=io_path, stdout=PIPE, stderr=PIPE, universal_newlines=True )
+            if job_context is not None: job_context.set_process( process )
+            try:
+                stdout, stderr = process.communicate( timeout=None if job_context is None else job_context.get_remaining_secs() )
+            except TimeoutExpired:
+                process.kill()
+                process.communicate()
+                raise TimeoutError( f"Code [{code_path}] ran longer than [{timeout:.1f}] secs, killed" )
+            finally:
+                if job_context is not None: job_context.set_process( None )
+        finally:
+            if locked: data_file_lock.release()
+    finally:
+        # Hang on to the code when debugging, so that it can be rerun by hand
+        if not debug and not keep_code: os.remove( code_path )
+    
+    results = CompletedProcess( process.args, process.returncode, stdout=stdout, stderr=stderr )
     
     if debug: print( f"results.returncode = [{results.returncode}]...", end="" )
     
@@ -258,14 +323,12 @@ def assemble_and_run_solution( solution_code, example_code, path_to_df=None, sol
     results_dict = initialize_code_response_dict()
     results_dict[ "return_code" ] = results.returncode
     results_dict[ "output"      ] = output
+    results_dict[ "code_path"   ] = "/io/" + os.path.basename( code_path )
     
     if debug and verbose:
         du.print_banner( "assemble_and_run_solution() output:", prepend_nl=True )
         print( results_dict[ "output" ] )
     
-    # Return to original working directory
-    os.chdir( original_wd )
-    
     return results_dict
 
 def test_assemble_and_run_solution( debug=False, verbose=False):
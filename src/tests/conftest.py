@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+# The code imports everything as lib.*, relative to src/
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import lib.memory.embedding_cache    as embedding_cache
+import lib.memory.embedding_client   as embedding_client
+import lib.memory.embedding_provider as embedding_provider
+
+
+@pytest.fixture
+def project_root( tmp_path, monkeypatch ):
+    """
+    Points du.get_project_root() at an empty scratch directory w/ the usual solutions directory in it.
+    """
+    os.makedirs( tmp_path / "src/conf/long-term-memory/solutions" )
+    monkeypatch.setenv( "GENIE_IN_THE_BOX_ROOT", str( tmp_path ) )
+
+    return tmp_path
+
+
+@pytest.fixture
+def stub_embeddings( monkeypatch ):
+    """
+    Swaps in the offline stub embedding provider and an in-memory embedding cache, so nothing calls the API or
+    touches the cache on disk, and puts the process wide provider, cache and clients back afterwards.
+    """
+    monkeypatch.setattr( embedding_cache,    "_embedding_cache",    embedding_cache.EmbeddingCache() )
+    monkeypatch.setattr( embedding_client,   "_embedding_clients",  { } )
+    monkeypatch.setattr( embedding_provider, "_embedding_provider", embedding_provider.StubEmbeddingProvider() )
+
+    return embedding_provider.get_embedding_provider()
@@ -0,0 +1,50 @@
+from lib.memory.embedding_cache import EmbeddingCache
+
+
+def test_lru_evicts_the_least_recently_used_entry():
+
+    cache = EmbeddingCache( max_memory_entries=2 )
+    cache.put( "model", "a", [ 1.0 ] )
+    cache.put( "model", "b", [ 2.0 ] )
+    assert cache.get( "model", "a" ) == [ 1.0 ]
+
+    cache.put( "model", "c", [ 3.0 ] )
+
+    assert cache.get( "model", "b" ) is None
+    assert cache.get( "model", "a" ) == [ 1.0 ]
+    assert cache.get( "model", "c" ) == [ 3.0 ]
+    assert cache.get_stats()[ "memory_entries" ] == 2
+
+def test_entries_are_keyed_by_model_and_text():
+
+    cache = EmbeddingCache()
+    cache.put( "model-1", "what time is it", [ 1.0 ] )
+
+    assert cache.get( "model-2", "what time is it" ) is None
+    assert cache.get( "model-1", "what time is it?" ) is None
+
+def test_disk_tier_outlives_the_process_and_is_bit_for_bit( tmp_path ):
+
+    db_path   = str( tmp_path / "cache/embedding-cache.sqlite" )
+    embedding = [ 0.1, 1 / 3, -2.718281828459045 ]
+    EmbeddingCache( db_path=db_path ).put( "model", "what time is it", embedding )
+
+    cache = EmbeddingCache( db_path=db_path, max_memory_entries=1 )
+    assert cache.get( "model", "what time is it" ) == embedding
+    assert cache.get( "model", "what time is it" ) == embedding
+
+    stats = cache.get_stats()
+    assert ( stats[ "disk_hits" ], stats[ "memory_hits" ], stats[ "misses" ] ) == ( 1, 1, 0 )
+
+def test_get_or_generate_only_generates_on_a_miss():
+
+    cache = EmbeddingCache()
+    calls = [ ]
+    def generate( text ):
+        calls.append( text )
+        return [ float( len( text ) ) ]
+
+    assert cache.get_or_generate( "model", "abc", generate ) == [ 3.0 ]
+    assert cache.get_or_generate( "model", "abc", generate ) == [ 3.0 ]
+    assert calls == [ "abc" ]
+    assert cache.get_stats()[ "hit_rate" ] == 0.5
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from lib.memory.embedding_matrix_index import EmbeddingMatrixIndex
+
+
+def get_unit_vectors( count, dimensions=8, seed=42 ):
+
+    vectors = np.random.default_rng( seed ).standard_normal( ( count, dimensions ) ).astype( np.float32 )
+
+    return vectors / np.linalg.norm( vectors, axis=1, keepdims=True )
+
+def get_index( vectors, initial_capacity=2 ):
+
+    index = EmbeddingMatrixIndex( dimensions=vectors.shape[ 1 ], initial_capacity=initial_capacity )
+    for i, vector in enumerate( vectors ): index.add( f"key-{i}", vector )
+
+    return index
+
+def assert_rows_match_keys( index, vectors ):
+
+    # Every key's row holds that key's embedding, wherever swap-remove has moved it
+    for row, key in enumerate( index.get_keys() ):
+        assert index._row_by_key[ key ] == row
+        assert np.array_equal( index.get_matrix()[ row ], vectors[ int( key.split( "-" )[ 1 ] ) ] )
+
+
+def test_add_grows_the_matrix_past_its_initial_capacity():
+
+    vectors = get_unit_vectors( 10 )
+    index   = get_index( vectors, initial_capacity=1 )
+
+    assert len( index ) == 10
+    assert index.get_matrix().shape == ( 10, 8 )
+    assert_rows_match_keys( index, vectors )
+
+def test_remove_swaps_the_last_row_into_the_hole():
+
+    vectors = get_unit_vectors( 5 )
+    index   = get_index( vectors )
+
+    assert index.remove( "key-1" )
+    assert index.get_keys() == [ "key-0", "key-4", "key-2", "key-3" ]
+    assert not index.remove( "key-1" )
+    assert "key-1" not in index
+
+    # Removing the last row doesn't swap anything
+    assert index.remove( "key-3" )
+    assert index.get_keys() == [ "key-0", "key-4", "key-2" ]
+    assert_rows_match_keys( index, vectors )
+
+def test_add_replaces_in_place_and_empty_embeddings_remove():
+
+    vectors = get_unit_vectors( 3 )
+    index   = get_index( vectors )
+
+    index.add( "key-0", vectors[ 2 ] )
+    assert index.get_keys()[ 0 ] == "key-0"
+    assert np.array_equal( index.get_matrix()[ 0 ], vectors[ 2 ] )
+
+    index.add( "key-0", [ ] )
+    assert "key-0" not in index and len( index ) == 2
+
+@pytest.mark.parametrize( "k", [ -1, 1, 3, 10 ] )
+def test_get_top_k_matches_a_brute_force_ranking( k ):
+
+    vectors = get_unit_vectors( 20 )
+    index   = get_index( vectors )
+    for i in [ 3, 7, 11 ]: index.remove( f"key-{i}" )
+    query   = vectors[ 5 ]
+
+    expected = sorted(
+        ( ( float( np.dot( vectors[ i ], query ) * 100 ), f"key-{i}" ) for i in range( 20 ) if i not in [ 3, 7, 11 ] ),
+        key=lambda result: -result[ 0 ]
+    )
+    expected = [ result for result in expected if result[ 0 ] >= 0.0 ]
+    if k > 0: expected = expected[ :k ]
+
+    results = index.get_top_k( query, threshold=0.0, k=k )
+    assert [ key for _, key in results ] == [ key for _, key in expected ]
+    assert results[ 0 ] == ( pytest.approx( 100.0, abs=1e-3 ), "key-5" )
+
+def test_get_top_k_skips_excluded_keys_and_empty_indexes():
+
+    vectors = get_unit_vectors( 4 )
+    index   = get_index( vectors )
+
+    assert "key-2" not in [ key for _, key in index.get_top_k( vectors[ 2 ], threshold=-100.0, exclude_keys={ "key-2" } ) ]
+    assert EmbeddingMatrixIndex( dimensions=8 ).get_top_k( vectors[ 0 ] ) == [ ]
+
+def test_rebuild_replaces_the_contents():
+
+    vectors = get_unit_vectors( 4 )
+    index   = get_index( vectors )
+
+    index.rebuild( [ ( "key-3", vectors[ 3 ] ), ( "key-1", vectors[ 1 ] ) ] )
+    assert index.get_keys() == [ "key-3", "key-1" ]
+    assert_rows_match_keys( index, vectors )
+
+def test_an_ivf_search_for_everything_above_the_threshold_is_exact():
+
+    from lib.memory.ann_embedding_index import IvfEmbeddingIndex
+
+    vectors = get_unit_vectors( 200 )
+    index   = IvfEmbeddingIndex( dimensions=8, nprobe=1, exact_search_threshold=0 )
+    for i, vector in enumerate( vectors ): index.add( f"key-{i}", vector )
+    index.train( nlist=16 )
+
+    exact = get_index( vectors )
+    assert index.get_top_k( vectors[ 5 ], threshold=0.0, k=-1 ) == exact.get_top_k( vectors[ 5 ], threshold=0.0, k=-1 )
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from lib.memory.embedding_provider import (
+    EmbeddingProvider, OpenAiEmbeddingProvider, StubEmbeddingProvider,
+    get_embedding_provider, get_embedding_provider_by_name, set_embedding_provider
+)
+import lib.memory.embedding_provider as embedding_provider
+
+
+def test_get_embedding_provider_by_name_picks_the_provider():
+
+    assert isinstance( get_embedding_provider_by_name( "openai" ), OpenAiEmbeddingProvider )
+
+    provider = get_embedding_provider_by_name( "stub", dimensions=8 )
+    assert isinstance( provider, StubEmbeddingProvider )
+    assert provider.dimensions == 8
+
+def test_get_embedding_provider_by_name_rejects_unknown_names():
+
+    with pytest.raises( ValueError, match="Unknown embedding provider" ):
+        get_embedding_provider_by_name( "nope" )
+
+def test_process_wide_provider_defaults_to_openai_and_can_be_swapped( monkeypatch ):
+
+    monkeypatch.setattr( embedding_provider, "_embedding_provider", None )
+    assert get_embedding_provider().get_namespace() == EmbeddingProvider.DEFAULT_NAMESPACE
+
+    stub = StubEmbeddingProvider()
+    set_embedding_provider( stub )
+    assert get_embedding_provider() is stub
+
+def test_get_table_name_keeps_default_names_and_namespaces_the_rest():
+
+    assert OpenAiEmbeddingProvider().get_table_name( "question_embeddings_tbl" ) == "question_embeddings_tbl"
+    assert StubEmbeddingProvider().get_table_name( "question_embeddings_tbl" ) == "question_embeddings_tbl_stub_sha256"
+
+    # Different models from the same provider don't share tables either
+    assert OpenAiEmbeddingProvider( model="text-embedding-3-small" ).get_table_name( "io_tbl" ) == "io_tbl_openai_text_embedding_3_small"
+
+def test_stub_embeddings_are_deterministic_unit_vectors():
+
+    provider = StubEmbeddingProvider( dimensions=64 )
+
+    embedding = provider.embed( "what time is it" )
+    assert len( embedding ) == 64
+    assert np.linalg.norm( embedding ) == pytest.approx( 1.0 )
+    assert provider.embed( "what time is it" ) == embedding
+    assert provider.embed_batch( [ "what time is it", "what day is it" ] )[ 0 ] == embedding
+    assert abs( np.dot( embedding, provider.embed( "what day is it" ) ) ) < 0.5
@@ -0,0 +1,104 @@
+import queue
+
+import pytest
+
+from lib.app.fifo_queue import FifoQueue
+
+
+class Job:
+
+    def __init__( self, id_hash ):
+
+        self.id_hash = id_hash
+
+    def get_html( self ):
+
+        return f"<li>{self.id_hash}</li>"
+
+
+def get_queue( id_hashes, **kwargs ):
+
+    fifo_queue = FifoQueue( **kwargs )
+    for id_hash in id_hashes: fifo_queue.push( Job( id_hash ) )
+
+    return fifo_queue
+
+def get_id_hashes( fifo_queue ):
+
+    return [ job.id_hash for job in fifo_queue ]
+
+
+def test_push_pop_and_head_are_first_in_first_out():
+
+    fifo_queue = get_queue( [ "a", "b", "c" ] )
+
+    assert fifo_queue.head().id_hash == "a"
+    assert fifo_queue.pop().id_hash == "a"
+    assert fifo_queue.pop().id_hash == "b"
+    assert fifo_queue.size() == 1
+    assert fifo_queue.pop().id_hash == "c"
+    assert fifo_queue.pop() is None
+    assert fifo_queue.head() is None
+    assert fifo_queue.is_empty()
+
+def test_jobs_can_be_popped_from_anywhere_by_id_hash():
+
+    fifo_queue = get_queue( [ "a", "b", "c" ] )
+
+    assert fifo_queue.get_by_id_hash( "b" ).id_hash == "b"
+    assert fifo_queue.pop_by_id_hash( "b" ).id_hash == "b"
+    assert fifo_queue.pop_by_id_hash( "b" ) is None
+    assert get_id_hashes( fifo_queue ) == [ "a", "c" ]
+
+def test_pop_first_takes_the_oldest_job_that_satisfies_the_predicate():
+
+    fifo_queue = get_queue( [ "a", "b", "c", "d" ] )
+
+    assert fifo_queue.pop_first( lambda job: job.id_hash in [ "c", "d" ] ).id_hash == "c"
+    assert fifo_queue.pop_first( lambda job: False ) is None
+    assert get_id_hashes( fifo_queue ) == [ "a", "b", "d" ]
+
+def test_bounded_queue_drops_the_oldest_job_or_rejects_the_new_one():
+
+    fifo_queue = get_queue( [ "a", "b" ], max_size=2, overflow_policy=FifoQueue.OVERFLOW_DROP_OLDEST )
+    assert fifo_queue.push( Job( "c" ) ).id_hash == "a"
+    assert get_id_hashes( fifo_queue ) == [ "b", "c" ]
+    assert fifo_queue.overflow_counter == 1
+
+    fifo_queue = get_queue( [ "a", "b" ], max_size=2 )
+    with pytest.raises( queue.Full ):
+        fifo_queue.push( Job( "c" ) )
+    assert get_id_hashes( fifo_queue ) == [ "a", "b" ]
+
+    with pytest.raises( ValueError, match="Unknown overflow policy" ):
+        FifoQueue( overflow_policy="drop_newest" )
+
+def test_callbacks_see_pushes_and_pops_but_not_dropped_jobs():
+
+    pushed, popped = [ ], [ ]
+    fifo_queue     = FifoQueue( max_size=2, overflow_policy=FifoQueue.OVERFLOW_DROP_OLDEST )
+    fifo_queue.add_push_callback( lambda job: pushed.append( job.id_hash ) )
+    fifo_queue.add_pop_callback( lambda job: popped.append( job.id_hash ) )
+
+    for id_hash in [ "a", "b", "c" ]: fifo_queue.push( Job( id_hash ) )
+    fifo_queue.pop()
+    fifo_queue.pop_by_id_hash( "c" )
+    fifo_queue.pop_by_id_hash( "missing" )
+
+    assert pushed == [ "a", "b", "c" ]
+    assert popped == [ "b", "c" ]
+
+def test_html_list_is_only_rendered_again_after_a_change():
+
+    fifo_queue = get_queue( [ "a", "b" ] )
+
+    html_list = fifo_queue.get_html_list()
+    assert html_list == [ "<li>a</li>", "<li>b</li>" ]
+    assert fifo_queue.get_html_list( descending=True ) == [ "<li>b</li>", "<li>a</li>" ]
+
+    version = fifo_queue._html_version
+    fifo_queue.get_html_list()
+    assert fifo_queue._html_version == version
+
+    fifo_queue.pop()
+    assert fifo_queue.get_html_list() == [ "<li>b</li>" ]
@@ -0,0 +1,118 @@
+import lancedb
+import pytest
+
+from lib.memory.input_and_output_table import InputAndOutputTable
+
+
+@pytest.fixture
+def io_tbl( tmp_path ):
+    """
+    Just enough of an InputAndOutputTable to page through: a real Lance table, w/o the indexes, writer and embeddings.
+    """
+    # Appended out of order, and w/ plenty of rows that share a date and time
+    rows = [
+        { "date": f"2024-01-0{1 + i % 3}", "time": f"10:00:0{i % 4}", "input_type": "agent router go to date and time" if i % 2 else "ask",
+          "input": f"question {i}", "output_final": f"answer {i}" }
+        for i in range( 60 )
+    ]
+    db  = lancedb.connect( str( tmp_path ) )
+    tbl = db.create_table( "input_and_output_tbl", data=rows[ :40 ] )
+    tbl.add( rows[ 40: ] )
+
+    io_tbl = object.__new__( InputAndOutputTable )
+    io_tbl._input_and_output_tbl = tbl
+
+    return io_tbl
+
+def get_all_pages( io_tbl, page_size, **filters ):
+
+    pages, cursor = [ ], None
+    while True:
+        rows, cursor = io_tbl.get_io_page( cursor=cursor, page_size=page_size, **filters )
+        pages.append( rows )
+        if cursor is None: return pages
+
+
+@pytest.mark.parametrize( "page_size", [ 1, 4, 7, 59, 60, 100 ] )
+def test_pages_cover_every_row_once_in_date_and_time_order( io_tbl, page_size ):
+
+    pages = get_all_pages( io_tbl, page_size )
+    rows  = [ row for page in pages for row in page ]
+
+    assert all( len( page ) == page_size for page in pages[ :-1 ] )
+    assert sorted( row[ "input" ] for row in rows ) == sorted( f"question {i}" for i in range( 60 ) )
+    assert [ ( row[ "date" ], row[ "time" ] ) for row in rows ] == sorted( ( row[ "date" ], row[ "time" ] ) for row in rows )
+    assert set( rows[ 0 ].keys() ) == set( InputAndOutputTable.IO_COLUMNS )
+
+def test_pages_respect_the_filters( io_tbl ):
+
+    rows = [ row for page in get_all_pages( io_tbl, 4, start_date="2024-01-02", input_type="ask" ) for row in page ]
+
+    assert len( rows ) == 20
+    assert all( row[ "input_type" ] == "ask" and row[ "date" ] >= "2024-01-02" for row in rows )
+
+def test_rows_written_after_a_page_dont_shift_the_next_one( io_tbl ):
+
+    first_page, cursor = io_tbl.get_io_page( page_size=10 )
+    io_tbl._input_and_output_tbl.add( [ { "date": "2023-12-31", "time": "09:00:00", "input_type": "ask", "input": "late", "output_final": "" } ] )
+    second_page, _ = io_tbl.get_io_page( cursor=cursor, page_size=10 )
+
+    assert not { row[ "input" ] for row in first_page } & { row[ "input" ] for row in second_page }
+    assert "late" not in [ row[ "input" ] for row in second_page ]
+
+def test_invalid_cursors_are_rejected( io_tbl ):
+
+    with pytest.raises( ValueError, match="Invalid cursor" ):
+        io_tbl.get_io_page( cursor="42" )
+
+def test_only_missing_or_stale_indexes_are_built_on_boot( io_tbl ):
+
+    io_tbl.debug, io_tbl._table_name, io_tbl.index_rebuild_rows = False, "input_and_output_tbl", 10
+    tbl   = io_tbl._input_and_output_tbl
+    built = [ ]
+    for method in [ "create_scalar_index", "create_fts_index" ]:
+        create_index = getattr( tbl, method )
+        setattr( tbl, method, lambda column, create_index=create_index, **kwargs: built.append( column ) or create_index( column, **kwargs ) )
+
+    io_tbl._build_indexes( only_stale=True )
+    assert built == InputAndOutputTable.SCALAR_INDEX_COLUMNS + InputAndOutputTable.FTS_INDEX_COLUMNS
+    assert io_tbl._rows_at_last_index_build == 60
+
+    # A few rows behind is fine...
+    rows = [ { "date": "2024-01-04", "time": "10:00:00", "input_type": "ask", "input": f"new {i}", "output_final": "" } for i in range( 10 ) ]
+    tbl.add( rows[ :5 ] )
+    built.clear()
+    io_tbl._build_indexes( only_stale=True )
+    assert built == [ ] and io_tbl._rows_at_last_index_build == 60
+
+    # ...too many isn't
+    tbl.add( rows[ 5: ] )
+    io_tbl._build_indexes( only_stale=True )
+    assert built == InputAndOutputTable.SCALAR_INDEX_COLUMNS + InputAndOutputTable.FTS_INDEX_COLUMNS
+    assert io_tbl._rows_at_last_index_build == 70
+
+def get_search_row( i, **scores ):
+
+    return { "date": "2024-01-01", "time": f"10:00:0{i}", "input": f"question {i}", **scores }
+
+def test_rank_fusion_rewards_rows_found_by_both_searches():
+
+    lexical = [ get_search_row( i, _score=10.0 - i ) for i in [ 1, 2, 3 ] ]
+    vector  = [ get_search_row( i, _distance=float( i ) ) for i in [ 3, 4, 1 ] ]
+
+    results = InputAndOutputTable._fuse_ranks( [ lexical, vector ], k=10 )
+    k       = InputAndOutputTable.RRF_K
+
+    # 1 is ranked 1st and 3rd, 3 is ranked 3rd and 1st: a tie, broken by whoever was seen first
+    assert [ row[ "input" ] for row in results ] == [ "question 1", "question 3", "question 2", "question 4" ]
+    assert results[ 0 ][ "_rrf_score" ] == pytest.approx( 1 / ( k + 1 ) + 1 / ( k + 3 ) )
+    assert results[ 2 ][ "_rrf_score" ] == pytest.approx( 1 / ( k + 2 ) )
+
+    # Rows found by both keep both searches' scores
+    assert results[ 0 ][ "_score" ] == 9.0 and results[ 0 ][ "_distance" ] == 1.0
+
+def test_rank_fusion_returns_at_most_k_rows():
+
+    results = InputAndOutputTable._fuse_ranks( [ [ get_search_row( i ) for i in range( 5 ) ], [ ] ], k=2 )
+
+    assert [ row[ "input" ] for row in results ] == [ "question 0", "question 1" ]
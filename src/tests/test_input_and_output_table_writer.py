@@ -0,0 +1,70 @@
+from lib.memory.input_and_output_table_writer import InputAndOutputTableWriter
+
+
+class FlakyTable:
+    """
+    Fails the first failures add()s, like a table whose embeddings can't be generated while the API is down.
+    """
+    def __init__( self, failures=0 ):
+
+        self.failures = failures
+        self.rows     = [ ]
+
+    def add( self, rows ):
+
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError( "Embedding API down" )
+
+        self.rows.extend( rows )
+
+
+def get_row( i ):
+
+    return { "input": f"question {i}", "input_embedding": [ 1.0 ], "output_final": f"answer {i}", "output_final_embedding": [ 1.0 ] }
+
+def get_writer( table, **kwargs ):
+
+    return InputAndOutputTableWriter( table, None, max_delay_secs=0.01, **kwargs )
+
+
+def test_rows_are_written_in_batches_and_reported_to_callbacks():
+
+    table   = FlakyTable()
+    writer  = get_writer( table, max_batch_rows=4 )
+    flushed = [ ]
+    writer.add_flush_callback( lambda rows: flushed.append( len( rows ) ) )
+
+    for i in range( 10 ): writer.enqueue( get_row( i ) )
+
+    assert writer.flush( timeout=10 )
+    assert [ row[ "input" ] for row in table.rows ] == [ f"question {i}" for i in range( 10 ) ]
+    assert sum( flushed ) == 10 and max( flushed ) <= 4
+    writer.stop()
+
+def test_a_failed_batch_is_retried_rather_than_dropped():
+
+    table  = FlakyTable( failures=1 )
+    writer = get_writer( table, max_retry_delay_secs=0.1 )
+
+    writer.enqueue( get_row( 0 ) )
+    assert writer.flush( timeout=10 )
+    writer.enqueue( get_row( 1 ) )
+    assert writer.flush( timeout=10 )
+
+    assert [ row[ "input" ] for row in table.rows ] == [ "question 0", "question 1" ]
+    stats = writer.get_stats()
+    assert ( stats[ "written" ], stats[ "failed" ], stats[ "failures_in_row" ], stats[ "retrying" ] ) == ( 2, 1, 0, False )
+    writer.stop()
+
+def test_a_failing_callback_doesnt_write_the_rows_again():
+
+    table  = FlakyTable()
+    writer = get_writer( table )
+    writer.add_flush_callback( lambda rows: 1 / 0 )
+
+    writer.enqueue( get_row( 0 ) )
+    assert writer.flush( timeout=10 )
+
+    assert len( table.rows ) == 1
+    writer.stop()
@@ -0,0 +1,147 @@
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+from lib.app.job_context import (
+    JobContext, check_current_job, get_current_job_context, get_current_job_remaining_secs, job_stage, set_current_job_context
+)
+
+
+class StubProcess:
+
+    def __init__( self ):
+
+        self.killed = False
+
+    def poll( self ):
+
+        return -9 if self.killed else None
+
+    def kill( self ):
+
+        self.killed = True
+
+
+@pytest.fixture
+def job_context():
+
+    job_context = JobContext( "abc123", "AgentType", { "prompt": 0.05, "code": 10 } )
+    set_current_job_context( job_context )
+    yield job_context
+    set_current_job_context( None )
+
+
+def test_each_stage_gets_its_own_deadline( job_context ):
+
+    previous = job_context.enter_stage( "code" )
+    assert 9 < job_context.get_remaining_secs() <= 10
+    job_context.exit_stage( previous )
+
+    assert job_context.stage is None and job_context.get_remaining_secs() is None
+    job_context.check()
+
+def test_an_overdue_stage_times_out( job_context ):
+
+    job_context.enter_stage( "prompt" )
+    time.sleep( 0.1 )
+
+    assert job_context.is_overdue()
+    assert not job_context.is_overdue( grace_secs=10 )
+    assert job_context.get_remaining_secs() == 0.0
+    with pytest.raises( TimeoutError, match=r"\[prompt\] stage" ):
+        check_current_job()
+
+def test_nested_calls_in_the_same_stage_dont_restart_the_clock( job_context ):
+
+    @job_stage( "code" )
+    def run_code( depth ):
+        deadline = get_current_job_context().deadline
+        return [ deadline ] + ( run_code( depth - 1 ) if depth > 0 else [ ] )
+
+    deadlines = run_code( 2 )
+    assert len( set( deadlines ) ) == 1
+    assert job_context.stage is None
+
+def test_an_inner_stage_hands_back_what_was_left_of_the_outer_ones_clock( job_context ):
+
+    @job_stage( "prompt" )
+    def ask_debugger():
+        return get_current_job_context().stage
+
+    @job_stage( "code" )
+    def run_code():
+        deadline = get_current_job_context().deadline
+        assert ask_debugger() == "prompt"
+        return get_current_job_context().stage, get_current_job_context().deadline == deadline
+
+    assert run_code() == ( "code", True )
+
+def test_job_stage_is_a_no_op_outside_of_a_job():
+
+    assert get_current_job_context() is None
+
+    @job_stage( "code" )
+    def run_code(): return "ran"
+
+    assert run_code() == "ran"
+    assert get_current_job_remaining_secs() is None
+    check_current_job()
+
+def test_cancel_kills_the_process_and_fails_the_next_check( job_context ):
+
+    process = StubProcess()
+    job_context.set_process( process )
+    job_context.cancel( "asked to by the user" )
+
+    assert process.killed
+    with pytest.raises( CancelledError, match="asked to by the user" ):
+        job_context.check()
+
+    # Processes started after the job was cancelled don't get to run either
+    late_process = StubProcess()
+    job_context.set_process( late_process )
+    assert late_process.killed
+
+def test_contexts_are_per_thread( job_context ):
+
+    seen = [ ]
+    thread = threading.Thread( target=lambda: seen.append( get_current_job_context() ) )
+    thread.start()
+    thread.join()
+
+    assert seen == [ None ]
+    assert get_current_job_context() is job_context
+
+def test_only_the_first_release_frees_the_slot( job_context ):
+
+    assert job_context.release()
+    assert not job_context.release()
+
+def test_a_timeout_swallowed_by_the_agent_is_still_seen_after_the_stage( job_context ):
+
+    @job_stage( "prompt" )
+    def run_prompt():
+        time.sleep( 0.1 )
+        try:
+            check_current_job()
+        except TimeoutError:
+            pass
+
+    run_prompt()
+
+    assert job_context.stage is None and job_context.deadline is None
+    assert job_context.timed_out_stage == "prompt"
+    with pytest.raises( TimeoutError, match=r"\[prompt\] stage" ):
+        check_current_job()
+
+def test_a_stage_that_runs_over_without_checking_in_is_caught_on_the_way_out( job_context ):
+
+    @job_stage( "prompt" )
+    def run_prompt(): time.sleep( 0.1 )
+
+    run_prompt()
+
+    with pytest.raises( TimeoutError ):
+        check_current_job()
@@ -0,0 +1,105 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from lib.app.fifo_queue  import FifoQueue
+from lib.app.job_journal import JobJournal
+
+
+def get_job( id_hash ):
+
+    return SimpleNamespace( id_hash=id_hash, question=f"question {id_hash}", last_question_asked=f"question {id_hash}", run_date=None )
+
+def get_journal( tmp_path ):
+
+    return JobJournal( str( tmp_path / "jobs-journal.jsonl" ) )
+
+
+def test_replay_recovers_the_jobs_still_queued_in_order( tmp_path ):
+
+    journal = get_journal( tmp_path )
+    queue   = FifoQueue()
+    journal.attach( "todo", queue )
+    for id_hash in [ "a", "b", "c", "d" ]: queue.push( get_job( id_hash ) )
+    queue.pop()
+    queue.pop_by_id_hash( "c" )
+    journal.close()
+
+    journal = get_journal( tmp_path )
+    assert [ entry[ "id_hash" ] for entry in journal.take_recovered( "todo" ) ] == [ "b", "d" ]
+    assert journal.take_recovered( "todo" ) == [ ]
+    journal.close()
+
+def test_replay_compacts_the_journal_down_to_the_live_jobs( tmp_path ):
+
+    journal = get_journal( tmp_path )
+    queue   = FifoQueue()
+    journal.attach( "todo", queue )
+    for id_hash in range( 100 ): queue.push( get_job( str( id_hash ) ) )
+    for _ in range( 99 ): queue.pop()
+    journal.close()
+
+    get_journal( tmp_path ).close()
+    with open( tmp_path / "jobs-journal.jsonl" ) as f:
+        assert len( f.readlines() ) == 1
+
+def test_replay_skips_a_line_torn_by_a_crash( tmp_path ):
+
+    journal = get_journal( tmp_path )
+    journal.record_push( "todo", get_job( "a" ) )
+    journal.close()
+    with open( tmp_path / "jobs-journal.jsonl", "a" ) as f:
+        f.write( '{"queue": "todo", "op": "po' )
+
+    journal = get_journal( tmp_path )
+    assert [ entry[ "id_hash" ] for entry in journal.take_recovered( "todo" ) ] == [ "a" ]
+    journal.close()
+
+def test_concurrent_pushes_are_group_committed_and_journaled_outside_the_queue_lock( tmp_path ):
+
+    journal = get_journal( tmp_path )
+    queue   = FifoQueue()
+    journal.attach( "todo", queue )
+
+    lock_held = [ ]
+    queue.add_push_callback( lambda job: lock_held.append( queue._lock._is_owned() ) )
+    queue.add_pop_callback( lambda job: lock_held.append( queue._lock._is_owned() ) )
+
+    def push_jobs( thread_id ):
+        for i in range( 50 ): queue.push( get_job( f"{thread_id}-{i}" ) )
+
+    threads = [ threading.Thread( target=push_jobs, args=( thread_id, ) ) for thread_id in range( 8 ) ]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    queue.pop_first( lambda job: True )
+
+    assert journal.flush( timeout=10 )
+    stats = journal.get_stats()
+    assert stats[ "lines_written" ] == 401
+    assert stats[ "batches_written" ] <= stats[ "lines_written" ]
+    assert not any( lock_held )
+    journal.close()
+
+def test_a_failed_write_is_reported_to_waiting_pushes_and_retried( tmp_path ):
+
+    journal     = JobJournal( str( tmp_path / "jobs-journal.jsonl" ), max_retry_delay_secs=0.05 )
+    write_lines = journal._write_lines
+    failures    = [ OSError( "No space left on device" ) ]
+    def fail_once( lines ):
+        if failures: raise failures.pop()
+        write_lines( lines )
+    journal._write_lines = fail_once
+
+    with pytest.raises( OSError, match="No space left on device" ):
+        journal.record_push( "todo", get_job( "a" ) )
+    assert journal.get_stats()[ "failures" ] == 1
+
+    # ...but the line wasn't dropped, it goes out w/ the next one
+    journal.record_push( "todo", get_job( "b" ) )
+    assert journal.get_stats()[ "last_error" ] is None
+    journal.close()
+
+    journal = get_journal( tmp_path )
+    assert [ entry[ "id_hash" ] for entry in journal.take_recovered( "todo" ) ] == [ "a", "b" ]
+    journal.close()
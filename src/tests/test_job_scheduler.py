@@ -0,0 +1,133 @@
+from types import SimpleNamespace
+
+import pytest
+
+import lib.app.todo_fifo_queue as todo_fifo_queue
+from lib.app.job_scheduler   import AgingJobScheduler, FifoJobScheduler, ShortestJobFirstScheduler, get_job_scheduler_by_name
+from lib.app.todo_fifo_queue import TodoFifoQueue
+
+
+class StubConfigManager:
+
+    def __init__( self, **values ):
+
+        self.values = values
+
+    def get( self, key, default=None, return_type=None ):
+
+        return self.values.get( key, default )
+
+
+class Job:
+
+    def __init__( self, id_hash, mean_run_ms ):
+
+        self.id_hash       = id_hash
+        self.runtime_stats = { "run_count": 1, "mean_run_ms": mean_run_ms }
+
+
+def get_todo_queue( monkeypatch, scheduler_name, **values ):
+
+    # A clock that only moves when we say so
+    clock = SimpleNamespace( now=1000.0 )
+    monkeypatch.setattr( todo_fifo_queue, "time", SimpleNamespace( monotonic=lambda: clock.now ) )
+
+    config_mgr = StubConfigManager( jobs_todo_scheduler=scheduler_name, jobs_run_max_concurrent=1, **values )
+
+    return TodoFifoQueue( None, None, None, config_mgr=config_mgr ), clock
+
+def pop_all( queue, predicate=lambda job: True ):
+
+    id_hashes = [ ]
+    while ( job := queue.pop_next( predicate ) ) is not None: id_hashes.append( job.id_hash )
+
+    return id_hashes
+
+
+def test_get_job_scheduler_by_name():
+
+    assert isinstance( get_job_scheduler_by_name( "fifo" ), FifoJobScheduler )
+    assert isinstance( get_job_scheduler_by_name( "sjf" ), ShortestJobFirstScheduler )
+    assert get_job_scheduler_by_name( "aging", aging_weight=2.0 ).aging_weight == 2.0
+
+    with pytest.raises( ValueError, match="Unknown job scheduler" ):
+        get_job_scheduler_by_name( "lifo" )
+
+def test_expected_run_ms_falls_back_from_snapshot_to_type_mean_to_default():
+
+    scheduler = ShortestJobFirstScheduler( default_run_ms=5000 )
+    job       = SimpleNamespace( id_hash="a", runtime_stats={ "run_count": 0, "mean_run_ms": 1 } )
+
+    assert scheduler.get_expected_run_ms( job ) == 5000
+    scheduler.record_run_ms( job, 1000 )
+    scheduler.record_run_ms( job, 3000 )
+    assert scheduler.get_expected_run_ms( job ) == 2000
+    assert scheduler.get_expected_run_ms( Job( "b", 42 ) ) == 42
+
+def test_fifo_runs_jobs_in_push_order( monkeypatch ):
+
+    queue, _ = get_todo_queue( monkeypatch, "fifo" )
+    for id_hash, mean_run_ms in [ ( "a", 900 ), ( "b", 100 ), ( "c", 500 ) ]: queue.push( Job( id_hash, mean_run_ms ) )
+
+    assert pop_all( queue ) == [ "a", "b", "c" ]
+
+def test_sjf_runs_the_shortest_job_first_and_ties_in_push_order( monkeypatch ):
+
+    queue, _ = get_todo_queue( monkeypatch, "sjf" )
+    for id_hash, mean_run_ms in [ ( "a", 900 ), ( "b", 100 ), ( "c", 500 ), ( "d", 100 ) ]: queue.push( Job( id_hash, mean_run_ms ) )
+
+    assert pop_all( queue ) == [ "b", "d", "c", "a" ]
+
+def test_sjf_skips_jobs_the_predicate_rejects_without_losing_their_place( monkeypatch ):
+
+    queue, _ = get_todo_queue( monkeypatch, "sjf" )
+    for id_hash, mean_run_ms in [ ( "a", 900 ), ( "b", 100 ), ( "c", 500 ) ]: queue.push( Job( id_hash, mean_run_ms ) )
+
+    assert queue.pop_next( lambda job: job.id_hash != "b" ).id_hash == "c"
+    assert pop_all( queue ) == [ "b", "a" ]
+
+def test_sjf_ignores_jobs_popped_by_id_hash( monkeypatch ):
+
+    queue, _ = get_todo_queue( monkeypatch, "sjf" )
+    for id_hash, mean_run_ms in [ ( "a", 900 ), ( "b", 100 ), ( "c", 500 ) ]: queue.push( Job( id_hash, mean_run_ms ) )
+    queue.pop_by_id_hash( "b" )
+
+    assert pop_all( queue ) == [ "c", "a" ]
+    assert queue.is_empty()
+
+def test_aging_lets_a_long_job_that_has_waited_long_enough_go_first( monkeypatch ):
+
+    queue, clock = get_todo_queue( monkeypatch, "aging", jobs_todo_scheduler_aging_weight=1.0 )
+    queue.push( Job( "long", 5000 ) )
+    clock.now += 2
+    queue.push( Job( "short", 1000 ) )
+
+    # Waited 2s, so 5000 - 2000 = 3000ms > 1000ms, the short job still goes first
+    assert queue.pop_next().id_hash == "short"
+
+    clock.now += 10
+    queue.push( Job( "short-2", 1000 ) )
+
+    # The long job's waited 12s now: 5000 - 12000 < 1000 - 0
+    assert pop_all( queue ) == [ "long", "short-2" ]
+
+def test_expected_wait_counts_only_the_jobs_ahead( monkeypatch ):
+
+    queue, _ = get_todo_queue( monkeypatch, "sjf" )
+    jobs     = [ Job( "a", 4000 ), Job( "b", 1000 ), Job( "c", 2000 ) ]
+    for job in jobs: queue.push( job )
+
+    assert queue.get_expected_wait_secs() == 7.0
+    assert queue.get_expected_wait_secs( jobs[ 0 ] ) == 3.0
+    assert queue.get_expected_wait_secs( jobs[ 1 ] ) == 0.0
+    assert queue.get_expected_wait_secs( Job( "d", 2000 ) ) == 3.0
+
+def test_jobs_ahead_follow_the_schedule_not_the_queue_size( monkeypatch ):
+
+    queue, _ = get_todo_queue( monkeypatch, "sjf" )
+    jobs     = [ Job( "a", 4000 ), Job( "b", 1000 ), Job( "c", 2000 ) ]
+    for job in jobs: queue.push( job )
+
+    assert queue.get_jobs_ahead_count() == 3
+    assert [ queue.get_jobs_ahead_count( job ) for job in jobs ] == [ 2, 0, 1 ]
+    assert queue.get_jobs_ahead_count( Job( "d", 500 ) ) == 0
@@ -0,0 +1,90 @@
+import threading
+import time
+
+import lancedb
+import pytest
+
+import lib.memory.question_embeddings_table as question_embeddings_table
+from lib.memory.question_embeddings_table import QuestionEmbeddingsTable
+
+
+class StubLanceDbRegistry:
+
+    def __init__( self, path ):
+
+        self.db = lancedb.connect( path )
+
+    def get_connection( self ):
+
+        return self.db
+
+    def open_table( self, table_name ):
+
+        return self.db.open_table( table_name )
+
+
+@pytest.fixture
+def question_tbl( tmp_path, stub_embeddings, monkeypatch ):
+
+    monkeypatch.setattr( question_embeddings_table, "get_lancedb_registry", lambda: StubLanceDbRegistry( str( tmp_path ) ) )
+    monkeypatch.setattr( question_embeddings_table, "ConfigurationManager", lambda **kwargs: None )
+
+    return QuestionEmbeddingsTable()
+
+def count_generate_calls( monkeypatch, stub_embeddings, delay_secs=0.0 ):
+
+    calls = [ ]
+    def generate_embedding( question ):
+        calls.append( question )
+        time.sleep( delay_secs )
+        return stub_embeddings.embed( question )
+
+    monkeypatch.setattr( question_embeddings_table.ss, "generate_embedding", generate_embedding )
+
+    return calls
+
+
+def test_get_or_create_embedding_generates_and_inserts_once( question_tbl, stub_embeddings, monkeypatch ):
+
+    calls = count_generate_calls( monkeypatch, stub_embeddings )
+
+    embedding = question_tbl.get_or_create_embedding( "what time is it" )
+    assert question_tbl.get_or_create_embedding( "what time is it" ) == embedding
+    assert question_tbl.has( "what time is it" )
+    assert calls == [ "what time is it" ]
+    assert question_tbl.get_table().count_rows() == 1
+
+def test_concurrent_creates_of_the_same_question_are_single_flight( question_tbl, stub_embeddings, monkeypatch ):
+
+    calls   = count_generate_calls( monkeypatch, stub_embeddings, delay_secs=0.2 )
+    results = [ None ] * 8
+
+    def create( i ): results[ i ] = question_tbl.get_or_create_embedding( "what day is it" )
+
+    threads = [ threading.Thread( target=create, args=( i, ) ) for i in range( len( results ) ) ]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    assert calls == [ "what day is it" ]
+    assert question_tbl.get_table().count_rows() == 1
+    assert all( result == results[ 0 ] for result in results )
+    assert question_tbl.coalesced_creates == len( results ) - 1
+
+def test_a_failed_create_lets_the_next_caller_try_again( question_tbl, stub_embeddings, monkeypatch ):
+
+    def fail( question ): raise RuntimeError( "API down" )
+    monkeypatch.setattr( question_embeddings_table.ss, "generate_embedding", fail )
+    with pytest.raises( RuntimeError ):
+        question_tbl.get_or_create_embedding( "what time is it" )
+
+    calls = count_generate_calls( monkeypatch, stub_embeddings )
+    assert question_tbl.get_or_create_embedding( "what time is it" ) is not None
+    assert calls == [ "what time is it" ]
+
+def test_add_embedding_doesnt_insert_a_question_twice( question_tbl, stub_embeddings ):
+
+    embedding = stub_embeddings.embed( "what time is it" )
+
+    assert question_tbl.add_embedding( "what time is it", embedding ) == embedding
+    assert question_tbl.add_embedding( "what time is it", stub_embeddings.embed( "something else" ) ) == embedding
+    assert question_tbl.get_table().count_rows() == 1
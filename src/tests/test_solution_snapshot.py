@@ -0,0 +1,126 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import lib.memory.embedding_provider as embedding_provider
+from lib.memory.embedding_provider import EmbeddingProvider, OpenAiEmbeddingProvider
+from lib.memory.solution_snapshot  import SolutionSnapshot
+
+SOLUTION_FILE = "what-time-is-it-0.json"
+
+
+def get_solutions_dir( project_root ):
+
+    return str( project_root / "src/conf/long-term-memory/solutions" ) + "/"
+
+def write_openai_snapshot_file( project_root ):
+    """
+    Writes a snapshot file the way they were written before embedding providers: inlined embeddings, no namespace.
+    """
+    rng  = np.random.default_rng( 42 )
+    data = {
+        "question"        : "what time is it",
+        "code"            : [ "solution = 42" ],
+        "solution_summary": "Returns the time",
+        "thoughts"        : "Look at the clock",
+        "solution_file"   : SOLUTION_FILE,
+    }
+    for field in SolutionSnapshot.EMBEDDING_FIELDS:
+        embedding     = rng.standard_normal( 1536 )
+        data[ field ] = ( embedding / np.linalg.norm( embedding ) ).tolist()
+
+    with open( get_solutions_dir( project_root ) + SOLUTION_FILE, "w" ) as f:
+        json.dump( data, f )
+
+    return data
+
+def use_provider( monkeypatch, provider ):
+
+    monkeypatch.setattr( embedding_provider, "_embedding_provider", provider )
+
+
+def test_query_snapshot_trusts_its_embedding_and_never_touches_the_disk( project_root, stub_embeddings ):
+
+    question_embedding = stub_embeddings.embed( "what time is it" )
+
+    # Just like SolutionSnapshotManager.get_snapshots_by_question_similarity(), w/ and w/o an explicit namespace
+    for namespace in [ None, stub_embeddings.get_namespace() ]:
+        snapshot = SolutionSnapshot( question="what time is it", question_embedding=question_embedding, embedding_namespace=namespace )
+
+        assert not snapshot.embeddings_generated
+        assert snapshot.question_embedding is question_embedding
+
+    assert os.listdir( get_solutions_dir( project_root ) ) == [ ]
+
+def test_new_snapshot_generates_embeddings_but_leaves_persistence_to_the_caller( project_root, stub_embeddings ):
+
+    snapshot = SolutionSnapshot( question="what time is it", code=[ "solution = 42" ] )
+
+    assert snapshot.embeddings_generated
+    assert snapshot.question_embedding == stub_embeddings.embed( "what time is it" )
+    assert snapshot.code_embedding == stub_embeddings.embed( "solution = 42" )
+    assert snapshot.solution_file is None
+    assert os.listdir( get_solutions_dir( project_root ) ) == [ ]
+    assert "embeddings_generated" not in json.loads( snapshot.to_jsons() )
+
+@pytest.mark.parametrize( "storage_format", [ "json", "sidecar" ] )
+def test_switching_providers_keeps_each_namespaces_embeddings( project_root, stub_embeddings, monkeypatch, storage_format ):
+
+    monkeypatch.setattr( SolutionSnapshot, "default_storage_format", storage_format )
+    original  = write_openai_snapshot_file( project_root )
+    file_path = get_solutions_dir( project_root ) + SOLUTION_FILE
+
+    # Under the stub provider, the OpenAI embeddings are set aside, not compared against, and the stub's generated
+    stub_snapshot = SolutionSnapshot.from_json_file( file_path )
+    assert stub_snapshot.embedding_namespace == stub_embeddings.get_namespace()
+    assert stub_snapshot.embeddings_generated
+    assert stub_snapshot.question_embedding == stub_embeddings.embed( "what time is it" )
+    stub_snapshot.write_current_state_to_file()
+
+    # ...and are loaded back, rather than regenerated, the next time around
+    stub_snapshot = SolutionSnapshot.from_json_file( file_path )
+    assert not stub_snapshot.embeddings_generated
+    assert np.allclose( stub_snapshot.question_embedding, stub_embeddings.embed( "what time is it" ), atol=1e-6 )
+
+    # Switching back to OpenAI gets the original embeddings back, w/o a single call to the API
+    use_provider( monkeypatch, OpenAiEmbeddingProvider() )
+    openai_snapshot = SolutionSnapshot.from_json_file( file_path )
+    assert openai_snapshot.embedding_namespace == EmbeddingProvider.DEFAULT_NAMESPACE
+    assert not openai_snapshot.embeddings_generated
+    for field in SolutionSnapshot.EMBEDDING_FIELDS:
+        assert np.allclose( getattr( openai_snapshot, field ), original[ field ], atol=1e-6 )
+
+def test_sidecar_files_are_named_by_namespace():
+
+    assert SolutionSnapshot.get_sidecar_file( SOLUTION_FILE ) == "what-time-is-it-0.npy"
+    assert SolutionSnapshot.get_sidecar_file( SOLUTION_FILE, EmbeddingProvider.DEFAULT_NAMESPACE ) == "what-time-is-it-0.npy"
+    assert SolutionSnapshot.get_sidecar_file( SOLUTION_FILE, "stub/sha256" ) == "what-time-is-it-0.stub_sha256.npy"
+
+def test_delete_file_removes_every_namespaces_sidecar( project_root, stub_embeddings, monkeypatch ):
+
+    monkeypatch.setattr( SolutionSnapshot, "default_storage_format", "sidecar" )
+    write_openai_snapshot_file( project_root )
+    file_path = get_solutions_dir( project_root ) + SOLUTION_FILE
+
+    use_provider( monkeypatch, OpenAiEmbeddingProvider() )
+    SolutionSnapshot.from_json_file( file_path ).write_current_state_to_file()
+    use_provider( monkeypatch, stub_embeddings )
+    snapshot = SolutionSnapshot.from_json_file( file_path )
+    snapshot.write_current_state_to_file()
+    assert sorted( os.listdir( get_solutions_dir( project_root ) ) ) == [ "what-time-is-it-0.json", "what-time-is-it-0.npy", "what-time-is-it-0.stub_sha256.npy" ]
+
+    snapshot.delete_file()
+    assert os.listdir( get_solutions_dir( project_root ) ) == [ ]
+
+def test_the_manifest_keeps_inlined_embeddings_as_float32( project_root ):
+
+    from lib.memory.solution_snapshot_mgr import SolutionSnapshotManager
+
+    expected = write_openai_snapshot_file( project_root )
+    data     = SolutionSnapshotManager._to_float32( SolutionSnapshot.read_json_file( get_solutions_dir( project_root ) + SOLUTION_FILE ) )
+
+    for field in SolutionSnapshot.EMBEDDING_FIELDS:
+        assert data[ field ].dtype == np.float32
+        assert np.allclose( data[ field ], expected[ field ], atol=1e-7 )